@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+"""
+Per-connection statistics for every TCP flow in a capture, in one pass.
+
+Usage: ./flow_stats.py path/to/net.cap [-o net.cap.flows] [--interval 1]
+
+For each connection, and each direction of it, this counts packets, payload
+bytes, retransmitted and out-of-order segments and zero-window events,
+estimates the round trip time from the handshake and from data/ACK pairs,
+and tracks the peak throughput over fixed intervals of capture time; the
+throughput of the whole capture over the same intervals is kept too.
+
+Flow state is held column-wise, in one `array` per statistic with a row per
+connection, rather than as an object per connection: that costs a few
+hundred bytes per flow, so millions of them fit in memory, and the columns
+are written straight out to a summary file in the same shape (see
+`write_summary` and `load_summary`).
+"""
+
+import argparse
+from array import array
+import math
+import socket
+import struct
+import sys
+
+from pcap_filter import compile_filter
+from pcap_solution import PcapReader, TCP_FLAG_BITS
+from tcp_reassembly import SEQ_MODULUS
+
+
+CLIENT, SERVER = 0, 1
+DIRECTIONS = ('client', 'server')
+
+SYN, ACK, FIN, RST = (TCP_FLAG_BITS[name] for name in
+                      ('SYN', 'ACK', 'FIN', 'RST'))
+
+# closing flags seen on a connection, after which a new SYN starts a new one
+CLIENT_FIN, SERVER_FIN, RESET = 1, 2, 4
+
+# the columns of a flow table, and of its summary; `client_` and `server_`
+# columns count what was sent in that direction. Their typecodes are all of
+# a fixed width, since the summary holds their bytes: 'I' is 4 bytes wherever
+# this runs, where 'L' is 4 or 8 depending on the platform.
+assert array('I').itemsize == 4
+FLOW_COLUMNS = [
+    ('client_ip', 'I'), ('client_port', 'H'),
+    ('server_ip', 'I'), ('server_port', 'H'),
+    ('first_seen', 'd'), ('last_seen', 'd'),
+    ('handshake_rtt', 'd'),
+    ('rtt_samples', 'I'), ('rtt_min', 'd'), ('rtt_mean', 'd'),
+    ('rtt_max', 'd'),
+] + [
+    (direction + '_' + name, typecode)
+    for direction in DIRECTIONS
+    for name, typecode in (('packets', 'Q'), ('bytes', 'Q'),
+                           ('retransmits', 'I'), ('out_of_order', 'I'),
+                           ('zero_windows', 'I'),
+                           ('peak_rate', 'd'))
+]
+
+
+def _signed(delta):
+    """A difference of two sequence numbers, allowing for wrap around"""
+    delta %= SEQ_MODULUS
+    return delta - SEQ_MODULUS if delta >= SEQ_MODULUS // 2 else delta
+
+
+class FlowTable(object):
+    """
+    Statistics of every TCP connection in a capture, fed packets in capture
+    order with `add`.
+
+    Connections are told apart by their endpoints, regardless of direction.
+    The client is whichever end sent the first SYN, or if the handshake was
+    not captured, whichever end was seen first. A SYN after the connection
+    was reset or closed in both directions starts a new row.
+
+    Byte counts include every payload byte sent, retransmitted or not. A
+    segment sent below the highest sequence number already seen counts as
+    out of order if it follows that segment within the round trip time,
+    since it cannot then be a response to loss, and otherwise as a
+    retransmission.
+
+    Round trip times are measured at the capture point: the handshake RTT is
+    the time from SYN to SYN-ACK, and further samples time one unacknowledged
+    segment per direction at a time until it is ACKed, discarding any sample
+    whose segment was retransmitted (Karn's algorithm). Times are NaN where
+    there were no samples.
+    """
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.rows = {}  # canonical pair of endpoints to current row
+        self.start = None  # capture time at which intervals are counted from
+        self.throughput = array('Q')  # payload bytes per interval
+        self.skipped = 0  # packets too short to hold their TCP headers
+
+        for name, typecode in FLOW_COLUMNS:
+            setattr(self, name, array(typecode))
+        self.rtt_sum = array('d')
+        self.syn_time = array('d')
+        self.closing = array('B')
+
+        # working state per direction, as (client column, server column)
+        def per_direction(typecode):
+            return array(typecode), array(typecode)
+        self.packets = (self.client_packets, self.server_packets)
+        self.bytes = (self.client_bytes, self.server_bytes)
+        self.retransmits = (self.client_retransmits, self.server_retransmits)
+        self.out_of_order = (self.client_out_of_order,
+                             self.server_out_of_order)
+        self.zero_windows = (self.client_zero_windows,
+                             self.server_zero_windows)
+        self.peak_rate = (self.client_peak_rate, self.server_peak_rate)
+        # sequence number just past the highest sent, or -1 before any, and
+        # when it was sent
+        self.high_seq = per_direction('q')
+        self.high_time = per_direction('d')
+        # sequence number whose ACK completes the RTT sample being timed, or
+        # -1 if none is, and when that sample started
+        self.sample_seq = per_direction('q')
+        self.sample_time = per_direction('d')
+        self.in_zero_window = per_direction('B')
+        # the interval being counted towards the peak rate, and its bytes
+        self.interval_index = per_direction('q')
+        self.interval_bytes = per_direction('Q')
+
+    def __len__(self):
+        return len(self.first_seen)
+
+    def _new_row(self, client, server, timestamp):
+        row = len(self)
+        self.client_ip.append(client >> 16)
+        self.client_port.append(client & 0xffff)
+        self.server_ip.append(server >> 16)
+        self.server_port.append(server & 0xffff)
+        self.first_seen.append(timestamp)
+        self.last_seen.append(timestamp)
+        for column in (self.handshake_rtt, self.rtt_min, self.rtt_mean,
+                       self.rtt_max, self.syn_time):
+            column.append(math.nan)
+        self.rtt_samples.append(0)
+        self.rtt_sum.append(0.0)
+        self.closing.append(0)
+        for d in (CLIENT, SERVER):
+            for column in (self.packets, self.bytes, self.retransmits,
+                           self.out_of_order, self.zero_windows,
+                           self.in_zero_window, self.interval_index,
+                           self.interval_bytes):
+                column[d].append(0)
+            for column in (self.peak_rate, self.high_time, self.sample_time):
+                column[d].append(0.0)
+            self.high_seq[d].append(-1)
+            self.sample_seq[d].append(-1)
+        return row
+
+    def add(self, packet):
+        """Account for a `Packet` known to carry TCP over IPv4"""
+        try:
+            ip_header, tcp_header = packet.ip_header, packet.tcp_header
+            payload_length = len(packet.payload)
+        except (struct.error, IndexError):
+            self.skipped += 1
+            return
+        self.add_segment(
+            packet.timestamp,
+            ip_header.source_address << 16 | tcp_header.source_port,
+            ip_header.destination_address << 16 | tcp_header.destination_port,
+            tcp_header.seq_number, tcp_header.ack_number,
+            tcp_header.flag_bits, tcp_header.window_size, payload_length)
+
+    def add_segment(self, timestamp, source, destination, seq, ack, flags,
+                    window_size, payload_length):
+        """
+        Account for one segment from endpoint `source` to `destination`, each
+        an IPv4 address and port packed into an int as ip << 16 | port, with
+        `flags` the TCP control bits
+        """
+        syn, ack_flag, fin, rst = \
+            flags & SYN, flags & ACK, flags & FIN, flags & RST
+        key = (source, destination) if source < destination \
+            else (destination, source)
+        row = self.rows.get(key)
+        if row is not None and syn and not ack_flag and (
+                self.closing[row] & RESET or
+                self.closing[row] & (CLIENT_FIN | SERVER_FIN) ==
+                CLIENT_FIN | SERVER_FIN):
+            row = None  # the endpoints are being reused
+        if row is None:
+            if syn and ack_flag:
+                row = self._new_row(destination, source, timestamp)
+            else:
+                row = self._new_row(source, destination, timestamp)
+            self.rows[key] = row
+        d = CLIENT if source == self.client_ip[row] << 16 | \
+            self.client_port[row] else SERVER
+        self.last_seen[row] = timestamp
+        self.packets[d][row] += 1
+
+        if syn:
+            if not ack_flag:
+                self.syn_time[row] = timestamp
+            elif math.isnan(self.handshake_rtt[row]):
+                self.handshake_rtt[row] = timestamp - self.syn_time[row]
+            self.high_seq[d][row] = (seq + 1) % SEQ_MODULUS
+        elif payload_length:
+            self._add_data(row, d, timestamp, seq, payload_length)
+        if ack_flag:
+            self._add_ack(row, 1 - d, timestamp, ack)
+
+        if rst:
+            self.closing[row] |= RESET
+        else:
+            if fin:
+                self.closing[row] |= CLIENT_FIN if d == CLIENT else SERVER_FIN
+            if not syn and window_size == 0:
+                if not self.in_zero_window[d][row]:
+                    self.zero_windows[d][row] += 1
+                    self.in_zero_window[d][row] = 1
+            else:
+                self.in_zero_window[d][row] = 0
+
+    def _add_data(self, row, d, timestamp, seq, payload_length):
+        end = (seq + payload_length) % SEQ_MODULUS
+        high_seq = self.high_seq[d][row]
+        if high_seq != -1 and _signed(end - high_seq) <= 0:
+            if timestamp - self.high_time[d][row] < self._rtt(row):
+                self.out_of_order[d][row] += 1
+            else:
+                self.retransmits[d][row] += 1
+                self.sample_seq[d][row] = -1
+        else:
+            self.high_seq[d][row] = end
+            self.high_time[d][row] = timestamp
+            if self.sample_seq[d][row] == -1:
+                self.sample_seq[d][row] = end
+                self.sample_time[d][row] = timestamp
+
+        self.bytes[d][row] += payload_length
+        if self.start is None:
+            self.start = timestamp
+        i = max(0, int((timestamp - self.start) // self.interval))
+        if i >= len(self.throughput):
+            self.throughput.extend([0] * (i + 1 - len(self.throughput)))
+        self.throughput[i] += payload_length
+        if i != self.interval_index[d][row]:
+            self._end_interval(row, d)
+            self.interval_index[d][row] = i
+        self.interval_bytes[d][row] += payload_length
+
+    def _rtt(self, row):
+        """The best round trip time estimate so far, or 0 if there is none"""
+        if self.rtt_samples[row]:
+            return self.rtt_min[row]
+        rtt = self.handshake_rtt[row]
+        return 0.0 if math.isnan(rtt) else rtt
+
+    def _add_ack(self, row, d, timestamp, ack):
+        """Account for an ACK of data sent in direction `d`"""
+        sample_seq = self.sample_seq[d][row]
+        if sample_seq != -1 and _signed(ack - sample_seq) >= 0:
+            rtt = timestamp - self.sample_time[d][row]
+            self.sample_seq[d][row] = -1
+            n = self.rtt_samples[row]
+            self.rtt_samples[row] = n + 1
+            self.rtt_sum[row] += rtt
+            self.rtt_min[row] = rtt if not n else min(rtt, self.rtt_min[row])
+            self.rtt_max[row] = rtt if not n else max(rtt, self.rtt_max[row])
+
+    def _end_interval(self, row, d):
+        rate = self.interval_bytes[d][row] / self.interval
+        if rate > self.peak_rate[d][row]:
+            self.peak_rate[d][row] = rate
+        self.interval_bytes[d][row] = 0
+
+    def finish(self):
+        """
+        Complete the statistics once every packet has been added: count the
+        last interval towards peak rates, and average round trip times
+        """
+        for row in range(len(self)):
+            for d in (CLIENT, SERVER):
+                self._end_interval(row, d)
+            n = self.rtt_samples[row]
+            if n:
+                self.rtt_mean[row] = self.rtt_sum[row] / n
+
+    def columns(self):
+        """The summary columns, as a dict of name to array"""
+        columns = {name: getattr(self, name) for name, _ in FLOW_COLUMNS}
+        columns['throughput'] = self.throughput
+        return columns
+
+
+def flow_stats(path, interval=1.0):
+    """Build the `FlowTable` of the capture at `path` in a single pass"""
+    table = FlowTable(interval)
+    with PcapReader(path) as reader:
+        is_tcp = compile_filter('tcp', reader.link_type)
+        for packet in reader.packets(frame_filter=is_tcp):
+            table.add(packet)
+    table.finish()
+    return table
+
+
+# magic, version, number of columns
+SUMMARY_HEADER = struct.Struct('<4sHH')
+# name, array typecode, bytes per value, number of values
+SUMMARY_COLUMN = struct.Struct('<32scB6xq')
+SUMMARY_MAGIC = b'PCFS'
+SUMMARY_VERSION = 2
+
+
+def write_summary(columns, path):
+    """
+    Write a dict of name to `array` as a columnar summary file: a header,
+    then for each column its name, type, width and length followed by its
+    values packed contiguously in little-endian order
+    """
+    with open(path, 'wb') as f:
+        f.write(SUMMARY_HEADER.pack(SUMMARY_MAGIC, SUMMARY_VERSION,
+                                    len(columns)))
+        for name, column in columns.items():
+            f.write(SUMMARY_COLUMN.pack(name.encode(),
+                                        column.typecode.encode(),
+                                        column.itemsize, len(column)))
+            if sys.byteorder == 'big':
+                column = array(column.typecode, column)
+                column.byteswap()
+            column.tofile(f)
+
+
+def load_summary(path):
+    """Read back a summary file as a dict of name to `array`"""
+    columns = {}
+    with open(path, 'rb') as f:
+        magic, version, n_columns = SUMMARY_HEADER.unpack(
+            f.read(SUMMARY_HEADER.size))
+        if magic != SUMMARY_MAGIC or version != SUMMARY_VERSION:
+            raise ValueError('{} is not a flow summary'.format(path))
+        for _ in range(n_columns):
+            name, typecode, itemsize, length = SUMMARY_COLUMN.unpack(
+                f.read(SUMMARY_COLUMN.size))
+            column = array(typecode.decode())
+            if column.itemsize != itemsize:
+                raise ValueError(
+                    '{} holds {}-byte {!r} values, but they are {} bytes '
+                    'here'.format(path, itemsize, column.typecode,
+                                  column.itemsize))
+            column.fromfile(f, length)
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns[name.rstrip(b'\0').decode()] = column
+    return columns
+
+
+def _format_endpoint(ip, port):
+    return '{}:{}'.format(socket.inet_ntoa(ip.to_bytes(4, 'big')), port)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Summarize every TCP connection in a capture')
+    parser.add_argument('path', help='path to capture to be summarized')
+    parser.add_argument('-o', '--output',
+                        help='summary path, default <path>.flows')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds per throughput interval, default 1')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of busiest flows to show, default 10')
+    args = parser.parse_args()
+
+    table = flow_stats(args.path, args.interval)
+    write_summary(table.columns(), args.output or args.path + '.flows')
+
+    print('{} flows, {} intervals of {}s'.format(
+        len(table), len(table.throughput), table.interval))
+    busiest = sorted(range(len(table)), reverse=True,
+                     key=lambda i: table.client_bytes[i] + table.server_bytes[i])
+    for i in busiest[:args.top]:
+        print('{:>21} -> {:<21} {:>10}B {:>10}B  rtt {:.1f}ms  '
+              'retransmits {}/{}  out of order {}/{}  '
+              'zero windows {}/{}'.format(
+                  _format_endpoint(table.client_ip[i], table.client_port[i]),
+                  _format_endpoint(table.server_ip[i], table.server_port[i]),
+                  table.client_bytes[i], table.server_bytes[i],
+                  table.handshake_rtt[i] * 1000,
+                  table.client_retransmits[i], table.server_retransmits[i],
+                  table.client_out_of_order[i], table.server_out_of_order[i],
+                  table.client_zero_windows[i], table.server_zero_windows[i]))
@@ -0,0 +1,160 @@
+"""
+Extract the body of an HTTP response incrementally, as its bytes arrive.
+
+The response head is buffered only until the blank line that ends it is
+found. From then on, body bytes are written straight through to an output
+file as they are fed in, de-chunked if the response uses chunked
+transfer-encoding, so extracting a large object never holds more than the
+most recent chunk of it in memory.
+"""
+
+
+class HttpResponseExtractor(object):
+    """
+    Call `feed` with sequential pieces of a single HTTP response; its body is
+    written to `output` as soon as it can be.
+
+    The body is framed by chunked transfer-encoding if used, otherwise by
+    Content-Length, otherwise by the end of the stream: call `close` once the
+    stream ends. Any bytes following a complete response are ignored.
+    """
+    HEAD_TERMINATOR = b'\r\n\r\n'
+    MAX_LINE = 8192  # for chunk size and trailer lines
+
+    def __init__(self, output):
+        self.output = output
+        self.status_line = None
+        self.headers = []
+        self.body_length = 0
+        self.complete = False
+        self._head = bytearray()
+        self._remaining = None  # body (or current chunk) bytes still to come
+        self._chunked = False
+        self._chunk_state = None
+        self._line = bytearray()
+
+    @property
+    def header_bytes(self):
+        """The raw response head, without its terminating blank line"""
+        return b'\r\n'.join(
+            [self.status_line] + [k + b': ' + v for k, v in self.headers])
+
+    def get_header(self, name, default=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    def feed(self, data):
+        if self.complete or not data:
+            return
+        if self.status_line is None:
+            data = self._feed_head(data)
+            if data is None:
+                return
+        if self._chunked:
+            self._feed_chunked(memoryview(data))
+        else:
+            self._feed_body(data)
+
+    def close(self):
+        """Signal the end of the stream, which ends an unframed body"""
+        if self.status_line is not None and self._remaining is None and \
+                not self._chunked:
+            self.complete = True
+
+    def _feed_head(self, data):
+        """
+        Buffer `data` into the head, returning whatever follows the head once
+        it is complete, else None
+        """
+        # only the tail of what we had could begin a terminator split across
+        # the boundary, so avoid rescanning the rest
+        search_from = max(0, len(self._head) - len(self.HEAD_TERMINATOR) + 1)
+        self._head += data
+        end = self._head.find(self.HEAD_TERMINATOR, search_from)
+        if end == -1:
+            return None
+        lines = bytes(self._head[:end]).split(b'\r\n')
+        rest = self._head[end + len(self.HEAD_TERMINATOR):]
+        self._head = None
+        self.status_line = lines[0]
+        for line in lines[1:]:
+            k, v = line.split(b':', 1)
+            self.headers.append((k.strip(), v.strip()))
+
+        encoding = self.get_header(b'Transfer-Encoding', b'').lower()
+        if b'chunked' in encoding:
+            self._chunked = True
+            self._chunk_state = 'size'
+        else:
+            length = self.get_header(b'Content-Length')
+            if length is not None:
+                self._remaining = int(length)
+                if not self._remaining:
+                    self.complete = True
+        return rest
+
+    def _write(self, data):
+        self.output.write(data)
+        self.body_length += len(data)
+
+    def _feed_body(self, data):
+        if self._remaining is None:
+            self._write(data)
+            return
+        data = data[:self._remaining]
+        self._write(data)
+        self._remaining -= len(data)
+        if not self._remaining:
+            self.complete = True
+
+    def _read_line(self, data):
+        """
+        Accumulate a CRLF terminated line from the front of `data`, returning
+        it and whatever follows, or None if the line is not yet complete
+        """
+        window = bytes(data[:self.MAX_LINE])
+        end = window.find(b'\n')
+        if end == -1:
+            self._line += window
+            if len(self._line) > self.MAX_LINE:
+                raise ValueError('chunked encoding line too long')
+            return None, data[len(window):]
+        self._line += window[:end + 1]
+        line = bytes(self._line).rstrip(b'\r\n')
+        self._line = bytearray()
+        return line, data[end + 1:]
+
+    def _feed_chunked(self, data):
+        while data and not self.complete:
+            if self._chunk_state == 'size':
+                line, data = self._read_line(data)
+                if line is None:
+                    return
+                # ignore any chunk extensions following a ';'
+                size = int(line.split(b';', 1)[0], 16)
+                if size:
+                    self._remaining = size
+                    self._chunk_state = 'data'
+                else:
+                    self._chunk_state = 'trailer'
+            elif self._chunk_state == 'data':
+                piece = data[:self._remaining]
+                self._write(piece)
+                self._remaining -= len(piece)
+                data = data[len(piece):]
+                if not self._remaining:
+                    self._chunk_state = 'data_end'
+            elif self._chunk_state == 'data_end':
+                line, data = self._read_line(data)
+                if line is None:
+                    return
+                self._chunk_state = 'size'
+            elif self._chunk_state == 'trailer':
+                line, data = self._read_line(data)
+                if line is None:
+                    return
+                if not line:
+                    self.complete = True
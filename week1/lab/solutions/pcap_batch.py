@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Decode an entire pcap savefile into columnar NumPy arrays.
+
+Usage: ./pcap_batch.py path/to/net.cap
+
+Rather than building one namedtuple per packet, a cheap pass over the pcap
+packet headers first indexes where every record starts. Each header layout
+(see the classes in pcap_solution.py) is then described as a NumPy structured
+dtype, gathered for a whole chunk of packets at once and split into fields
+with vectorized bit operations.
+"""
+
+import argparse
+
+import numpy as np
+
+from pcap_solution import (EthernetFrameHeader, LINKTYPE_ETHERNET,
+                           PcapPacketHeader, PcapReader, TCP_FLAG_BITS,
+                           TcpHeader, VLAN_ETHER_TYPES)
+
+
+# The same layouts as PcapPacketHeader, EthernetFrameHeader, IpDatagramHeader
+# and TcpHeader parse, as structured dtypes. Packed bit fields are kept whole
+# here and split apart in bulk.
+PCAP_PACKET_HEADER_DTYPE = np.dtype([
+    ('ts_seconds', '=u4'), ('ts_micro_nano', '=u4'),
+    ('payload_length', '=u4'), ('untruncated_length', '=u4')
+])
+# as written by a capturing host of either byte order
+PCAP_PACKET_HEADER_DTYPES = {
+    order: PCAP_PACKET_HEADER_DTYPE.newbyteorder(order) for order in '<>'
+}
+ETHERNET_HEADER_DTYPE = np.dtype([
+    ('destination_mac', 'V6'), ('source_mac', 'V6'), ('ether_type', '>u2')
+])
+# a VLAN tag is the tag's ether type, then the tag control information, and
+# is followed by the ether type of what it tags
+ETHER_TYPE_DTYPE = np.dtype('>u2')
+IP_DATAGRAM_HEADER_DTYPE = np.dtype([
+    ('version_ihl', 'u1'), ('dscp_ecn', 'u1'), ('total_length', '>u2'),
+    ('identification', '>u2'), ('flags_fragment_offset', '>u2'),
+    ('ttl', 'u1'), ('protocol', 'u1'), ('checksum', '>u2'),
+    ('source_ip', '>u4'), ('destination_ip', '>u4')
+])
+TCP_HEADER_DTYPE = np.dtype([
+    ('source_port', '>u2'), ('destination_port', '>u2'),
+    ('seq_number', '>u4'), ('ack_number', '>u4'),
+    ('data_offset_flags', '>u2'), ('window_size', '>u2'),
+    ('checksum', '>u2'), ('urgent_pointer', '>u2')
+])
+
+ETHER_TYPE_IPV4 = 0x0800
+PROTOCOL_TCP = 6
+
+# Output columns and their types. IP addresses are unsigned 32 bit integers
+# in host order, so e.g. ipaddress.IPv4Address(int(x)) recovers them, and
+# tcp_flags is the 9 bit control field: test it against TCP_FLAG_BITS.
+COLUMNS = [
+    ('offset', np.int64),  # of the frame within the savefile
+    ('ts_seconds', np.uint32), ('ts_micro_nano', np.uint32),
+    ('payload_length', np.uint32), ('untruncated_length', np.uint32),
+    ('ether_type', np.uint16),
+    ('ihl', np.uint8), ('total_length', np.uint16),
+    ('identification', np.uint16), ('ip_flags', np.uint8),
+    ('fragment_offset', np.uint16), ('ttl', np.uint8),
+    ('protocol', np.uint8), ('source_ip', np.uint32),
+    ('destination_ip', np.uint32),
+    ('source_port', np.uint16), ('destination_port', np.uint16),
+    ('seq_number', np.uint32), ('ack_number', np.uint32),
+    ('data_offset', np.uint8), ('tcp_flags', np.uint16),
+    ('window_size', np.uint16),
+]
+
+
+def _gather(buf, starts, dtype):
+    """
+    Copy a `dtype` sized record from each of `starts` in `buf`, returning
+    them as a structured array. Starts too close to the end of the buffer
+    are clamped, so callers must mask out rows whose frame is too short.
+    """
+    starts = np.minimum(starts, len(buf) - dtype.itemsize)
+    index = starts[:, np.newaxis] + np.arange(dtype.itemsize)
+    return buf[index].view(dtype).ravel()
+
+
+def decode_chunk(buf, offsets, columns, pcap_dtype=PCAP_PACKET_HEADER_DTYPE):
+    """
+    Decode the pcap records starting at each of `offsets` in `buf`, writing
+    each field into the matching slice of `columns`. `pcap_dtype` is the
+    packet header layout in the byte order of the savefile.
+    """
+    pcap = _gather(buf, offsets, pcap_dtype)
+    frame = offsets + PcapPacketHeader.LENGTH
+    captured = np.minimum(pcap['payload_length'], len(buf) - frame)
+    columns['offset'][:] = frame
+    for field in PCAP_PACKET_HEADER_DTYPE.names:
+        columns[field][:] = pcap[field]
+
+    is_ethernet = captured >= EthernetFrameHeader.LENGTH
+    ether_type = _gather(buf, frame, ETHERNET_HEADER_DTYPE)['ether_type']
+    # step over any 802.1Q and 802.1ad tags, a layer of them at a time for
+    # all the frames with that many, to the ether type of the network layer
+    link_length = np.full(len(frame), EthernetFrameHeader.LENGTH, np.int64)
+    tagged = is_ethernet & np.isin(ether_type, VLAN_ETHER_TYPES)
+    while tagged.any():
+        tagged &= captured >= link_length + 4
+        inner = _gather(buf, frame + link_length + 2, ETHER_TYPE_DTYPE)
+        ether_type = np.where(tagged, inner, ether_type)
+        link_length += 4 * tagged
+        tagged &= np.isin(ether_type, VLAN_ETHER_TYPES)
+    columns['ether_type'][:] = np.where(is_ethernet, ether_type, 0)
+
+    ip_start = frame + link_length
+    ip = _gather(buf, ip_start, IP_DATAGRAM_HEADER_DTYPE)
+    ihl = ip['version_ihl'] & 0x0f
+    is_ipv4 = (is_ethernet & (ether_type == ETHER_TYPE_IPV4)
+               & (ip['version_ihl'] >> 4 == 4) & (ihl >= 5)
+               & (captured >= link_length + 4 * ihl))
+    columns['ihl'][:] = np.where(is_ipv4, ihl, 0)
+    columns['ip_flags'][:] = np.where(
+            is_ipv4, ip['flags_fragment_offset'] >> 13, 0)
+    columns['fragment_offset'][:] = np.where(
+            is_ipv4, ip['flags_fragment_offset'] & 0x1fff, 0)
+    for field in ('total_length', 'identification', 'ttl', 'protocol',
+                  'source_ip', 'destination_ip'):
+        columns[field][:] = np.where(is_ipv4, ip[field], 0)
+
+    tcp_start = ip_start + 4 * ihl.astype(np.int64)
+    tcp = _gather(buf, tcp_start, TCP_HEADER_DTYPE)
+    is_tcp = (is_ipv4 & (ip['protocol'] == PROTOCOL_TCP)
+              & (captured >= tcp_start - frame + TcpHeader.DEFAULT_LENGTH))
+    columns['data_offset'][:] = np.where(
+            is_tcp, tcp['data_offset_flags'] >> 12, 0)
+    columns['tcp_flags'][:] = np.where(
+            is_tcp, tcp['data_offset_flags'] & 0x1ff, 0)
+    for field in ('source_port', 'destination_port', 'seq_number',
+                  'ack_number', 'window_size'):
+        columns[field][:] = np.where(is_tcp, tcp[field], 0)
+
+
+def decode_columns(path, chunk_size=1 << 16):
+    """
+    Decode every packet in the savefile at `path` into a dict of column name
+    to 1-D array, one row per packet.
+
+    Rows for frames that are not IPv4 carry zeroes in the IP and TCP columns,
+    as do rows for datagrams that are not TCP in the TCP columns. VLAN tags
+    are skipped, and `ether_type` is that of the frame's network layer. Only pcap
+    savefiles of Ethernet frames (of either byte order) can be decoded.
+    """
+    with PcapReader(path) as reader:
+        reader.file_header.verify()
+        if reader.format != 'pcap' or reader.link_type != LINKTYPE_ETHERNET:
+            raise ValueError('can only decode pcap savefiles of Ethernet '
+                             'frames, not {} link type {}'.format(
+                                 reader.format, reader.link_type))
+        pcap_dtype = PCAP_PACKET_HEADER_DTYPES[reader.byte_order]
+        offsets = np.frombuffer(reader.record_offsets(), dtype=np.int64)
+        buf = np.frombuffer(reader.buffer, dtype=np.uint8)
+        columns = {name: np.zeros(len(offsets), dtype=dtype)
+                   for name, dtype in COLUMNS}
+        for start in range(0, len(offsets), chunk_size):
+            end = start + chunk_size
+            chunk = {name: col[start:end] for name, col in columns.items()}
+            decode_chunk(buf, offsets[start:end], chunk, pcap_dtype)
+        # drop our views of the map before the reader closes it
+        del buf
+    return columns
+
+
+def flag_mask(columns, flag):
+    """A boolean array of which packets have the named TCP flag set"""
+    return (columns['tcp_flags'] & TCP_FLAG_BITS[flag]) != 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Summarize a pcap savefile decoded in bulk')
+    parser.add_argument('path', help='path to pcap file to be parsed')
+    args = parser.parse_args()
+
+    columns = decode_columns(args.path)
+    is_tcp = columns['protocol'] == PROTOCOL_TCP
+    print('{} packets, {} TCP, {} SYN, {} FIN, {}B captured'.format(
+        len(columns['offset']), is_tcp.sum(),
+        flag_mask(columns, 'SYN').sum(), flag_mask(columns, 'FIN').sum(),
+        columns['payload_length'].sum()))
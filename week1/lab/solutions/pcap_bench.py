@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Benchmark the pcap parser against a synthetic capture.
+
+Usage: ./pcap_bench.py [-n PACKETS] [--payload-size BYTES[-BYTES]]
+                       [--flows N] [--out-of-order RATIO]
+                       [--retransmit RATIO] [--keep path.cap]
+
+Generates a valid pcap savefile of Ethernet/IPv4/TCP frames, spread over any
+number of concurrent flows and optionally with segments delivered out of
+order or retransmitted, then reports packets/sec, MB/sec and peak RSS for
+each parsing strategy in pcap_solution.py and its sibling modules.
+
+Each strategy runs in a forked process of its own where the platform allows,
+so that its peak RSS is not hidden by that of a strategy run before it.
+"""
+
+import argparse
+from functools import partial
+from itertools import islice
+import multiprocessing
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not on Windows, where peak RSS goes unreported
+    resource = None
+
+from flow_stats import flow_stats
+from pcap_solution import (EthernetFrameHeader, FileHeader, IpDatagramHeader,
+                           Packet, PcapPacketHeader, PcapReader, TcpHeader,
+                           Verifier, iter_packets)
+from pcap_filter import compile_filter
+from pcap_original import parse as parse_original
+from pcap_parallel import parse_parallel
+from tcp_reassembly import Reassembler
+
+try:
+    from pcap_batch import decode_columns
+except ImportError:  # the batch decoder needs NumPy, which is optional here
+    decode_columns = None
+
+
+def _fold(total):
+    """Fold a sum of 16 bit words into 16 bits, with end-around carry"""
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+
+ETHERNET_TEMPLATE = bytes.fromhex('a45e60df2e1b' 'c4e984876028' '0800')
+SERVER_IP = bytes((192, 30, 252, 154))
+# each flow is to a client address in 10.0.0.0/8 and a port of its own
+CLIENT_NETWORK = 10 << 24
+FIRST_CLIENT_PORT = 1024
+CLIENT_PORTS = 64000
+MAX_FLOWS = (1 << 24) - 2
+IP_TCP_HEADERS = struct.Struct('!BBHHHBBH4s4sHHIIHHHH')
+
+
+def client_address(i):
+    """The client IP address (as bytes) and port of the `i`th flow"""
+    return (CLIENT_NETWORK + i + 1).to_bytes(4, 'big'), \
+        FIRST_CLIENT_PORT + i % CLIENT_PORTS
+
+
+class _Flow(object):
+    """
+    The next segment of the `i`th synthetic flow, from 192.30.252.154:80 to
+    a client address of its own (see `client_address`). The IP header
+    checksum is summed once without the total length, which varies, so that
+    it costs just an addition per packet.
+    """
+    __slots__ = ('client_ip', 'port', 'seq', 'partial_checksum')
+
+    def __init__(self, i):
+        self.client_ip, self.port = client_address(i)
+        self.seq = 1
+        self.partial_checksum = sum(t[0] for t in struct.iter_unpack(
+            '!H', struct.pack('!BBHHHBBH4s4s', 0x45, 0, 0, 0, 0x4000, 64, 6,
+                              0, SERVER_IP, self.client_ip)))
+
+    def segment(self, payload_size, payload):
+        """The frame of the next segment, advancing the sequence number"""
+        total_length = 40 + payload_size
+        checksum = ~_fold(self.partial_checksum + total_length) & 0xffff
+        frame = ETHERNET_TEMPLATE + IP_TCP_HEADERS.pack(
+            0x45, 0, total_length, 0, 0x4000, 64, 6, checksum, SERVER_IP,
+            self.client_ip, 80, self.port, self.seq, 1, (5 << 12) | 0x18, 0xffff,
+            0, 0) + payload[:payload_size]
+        self.seq = (self.seq + payload_size) & 0xffffffff
+        return frame
+
+
+def _segments(rng, flows, payload_size, out_of_order, retransmit):
+    """
+    Generate frames endlessly from `flows` chosen at random, delaying or
+    repeating some of them (see `write_synthetic_pcap`)
+    """
+    payload = b'x' * payload_size[1]
+    held = {flow: [] for flow in flows}  # to follow the flow's next frame
+    while True:
+        flow = rng.choice(flows)
+        frame = flow.segment(rng.randint(*payload_size), payload)
+        roll = rng.random()
+        if roll < out_of_order:
+            held[flow].append(frame)
+            continue
+        yield frame
+        yield from held[flow]
+        held[flow] = [frame] if roll < out_of_order + retransmit else []
+
+
+def write_synthetic_pcap(path, n_packets, payload_size=64, flows=1,
+                         out_of_order=0.0, retransmit=0.0, seed=0):
+    """
+    Write a pcap savefile of `n_packets` TCP segments, interleaved at random
+    across `flows` concurrent flows.
+
+    `payload_size` is a number of bytes, or a (min, max) range to draw each
+    segment's size from uniformly. A fraction `out_of_order` of segments are
+    held back to follow the next one of their flow, and a fraction
+    `retransmit` are written a second time after it; retransmissions count
+    towards `n_packets`. The same `seed` always gives the same capture.
+    There can be from 1 to `MAX_FLOWS` flows.
+    """
+    if not 1 <= flows <= MAX_FLOWS:
+        raise ValueError('flows must be from 1 to {}, not {}'.format(
+            MAX_FLOWS, flows))
+    if isinstance(payload_size, int):
+        payload_size = (payload_size, payload_size)
+    flows = [_Flow(i) for i in range(flows)]
+    segments = _segments(random.Random(seed), flows, payload_size,
+                         out_of_order, retransmit)
+    pack_header = PcapPacketHeader.STRUCT.pack
+    with open(path, 'wb') as f:
+        f.write(FileHeader.STRUCT.pack(0xa1b2c3d4, 2, 4, 0, 0, 0xffff, 1))
+        for i, frame in zip(range(n_packets), segments):
+            f.write(pack_header(1473286000 + i // 1000, i % 1000 * 1000,
+                                len(frame), len(frame)))
+            f.write(frame)
+
+
+def parse_with_mmap(path):
+    """Walk a memory map, parsing each header in place with `unpack_from`"""
+    n = 0
+    with PcapReader(path) as reader:
+        reader.file_header.verify()
+        for pcap_header, frame in reader:
+            pcap_header.verify()
+            EthernetFrameHeader.unpack_from(frame).verify()
+            ip_header = IpDatagramHeader.unpack_from(
+                    frame, EthernetFrameHeader.LENGTH)
+            ip_header.verify()
+            tcp_offset = EthernetFrameHeader.LENGTH + 4 * ip_header.ihl
+            IpDatagramHeader.verify_checksum(
+                    frame[EthernetFrameHeader.LENGTH:tcp_offset])
+            tcp_header = TcpHeader.unpack_from(frame, tcp_offset)
+            tcp_header.verify()
+            frame[tcp_offset + 4 * tcp_header.data_offset:]
+            n += 1
+    return n
+
+
+def filter_lazily(path):
+    """
+    Stream lazily decoded packets, looking only at the IP destination as a
+    filter would: the TCP header is never decoded.
+    """
+    n = 0
+    for packet in iter_packets(path):
+        packet.ip_header.destination_ip
+        n += 1
+    return n
+
+
+def filter_compiled(path, expression='tcp and dst host 192.0.2.1'):
+    """
+    Test each raw frame against a compiled filter which none of them match,
+    so that no header beyond the pcap header is ever decoded
+    """
+    matches = compile_filter(expression)
+    n = 0
+    with PcapReader(path) as reader:
+        for pcap_header, frame in reader:
+            if matches(frame):
+                Packet(pcap_header, frame)
+            n += 1
+    return n
+
+
+def verify_at(path, level):
+    """Stream lazily decoded packets, verifying them at the given level"""
+    verifier = Verifier(level)
+    n = 0
+    for packet in iter_packets(path):
+        if verifier.check(packet):
+            packet.tcp_header
+        n += 1
+    return n
+
+
+def reassemble(path):
+    """Reassemble the byte stream of every flow, discarding the data"""
+    reassembler = Reassembler(lambda key, data: None)
+    n = 0
+    for packet in iter_packets(path):
+        reassembler.add(packet)
+        n += 1
+    reassembler.close()
+    return n
+
+
+def summarize_flows(path):
+    """Build the per-connection statistics of every flow"""
+    table = flow_stats(path)
+    return sum(table.client_packets) + sum(table.server_packets)
+
+
+def decode_in_bulk(path):
+    """Decode every header field into NumPy columns"""
+    return len(decode_columns(path)['offset'])
+
+
+STRATEGIES = [
+    ('read', parse_original),
+    ('mmap', parse_with_mmap),
+    ('lazy-ip', filter_lazily),
+    ('filter', filter_compiled),
+    ('v-off', partial(verify_at, level='off')),
+    ('v-sample', partial(verify_at, level='sampled')),
+    ('v-full', partial(verify_at, level='full')),
+    ('reasm', reassemble),
+    ('flows', summarize_flows),
+]
+if decode_columns is not None:
+    STRATEGIES.append(('numpy', decode_in_bulk))
+
+
+def parse_in_processes(path, workers):
+    """Decode shards of the capture in a pool of `workers` processes"""
+    # collecting the segments of the first flow
+    return parse_parallel(path, client_address(0)[0], workers)[0]
+
+
+def parallel_strategies(worker_counts):
+    return [('procs-{}'.format(n), partial(parse_in_processes, workers=n))
+            for n in worker_counts]
+
+
+def peak_rss():
+    """The peak resident set size of this process in MB, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS, but kilobytes elsewhere
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def measure(parse, path):
+    """Run one strategy, returning (packets, seconds, peak RSS in MB)"""
+    start = time.perf_counter()
+    n = parse(path)
+    elapsed = time.perf_counter() - start
+    return n, elapsed, peak_rss()
+
+
+def _measure_in_child(connection, parse, path):
+    connection.send(measure(parse, path))
+    connection.close()
+
+
+def measure_isolated(parse, path):
+    """
+    Like `measure`, but in a forked child process, so that the peak RSS is
+    that of this strategy alone (not counting any workers of its own). Falls
+    back to measuring in this process where fork is unavailable.
+    """
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return measure(parse, path)
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=_measure_in_child,
+                            args=(sender, parse, path))
+    child.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        raise RuntimeError('benchmark process exited with code {}'.format(
+            child.exitcode))
+    finally:
+        child.join()
+    return result
+
+
+def retained_per_packet(path, limit=100000):
+    """
+    Decode every header of up to `limit` packets and keep hold of them all,
+    returning the bytes and number of memory blocks they retain per packet,
+    as traced by tracemalloc
+    """
+    with PcapReader(path) as reader:
+        packets = []
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            for packet in islice(reader.packets(), limit):
+                packet.ethernet_header
+                packet.ip_header.destination_ip
+                packet.tcp_header.flags['SYN']
+                packets.append(packet)
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+        stats = after.compare_to(before, 'filename')
+        n = len(packets)
+        del packets
+    return (sum(s.size_diff for s in stats) / n,
+            sum(s.count_diff for s in stats) / n)
+
+
+def run(path, strategies=STRATEGIES, isolate=True):
+    """Time each strategy over the capture at `path`, printing a report"""
+    size = os.path.getsize(path)
+    print('{:<9}{:>12}{:>10}{:>16}{:>10}{:>12}'.format(
+        'mode', 'packets', 'seconds', 'packets/sec', 'MB/sec', 'peak RSS'))
+    for name, parse in strategies:
+        n, elapsed, rss = (measure_isolated if isolate else measure)(
+            parse, path)
+        print('{:<9}{:>12}{:>10.2f}{:>16,.0f}{:>10.1f}{:>12}'.format(
+            name, n, elapsed, n / elapsed, size / elapsed / 1e6,
+            '-' if rss is None else '{:.1f}MB'.format(rss)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark pcap parsing on a synthetic capture')
+    parser.add_argument('-n', '--packets', type=int, default=2000000,
+                        help='number of packets to generate, default 2M')
+    parser.add_argument('--payload-size', default='64',
+                        help='TCP payload bytes per packet, or a MIN-MAX '
+                             'range to draw them from, default 64')
+    parser.add_argument('--flows', type=int, default=1,
+                        help='number of concurrent TCP flows, default 1')
+    parser.add_argument('--out-of-order', type=float, default=0.0,
+                        help='fraction of segments delivered out of order')
+    parser.add_argument('--retransmit', type=float, default=0.0,
+                        help='fraction of segments retransmitted')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the random choices of the capture')
+    parser.add_argument('-j', '--workers', default='1,2,4,8',
+                        help='comma separated worker counts to benchmark the '
+                             'multi-process parser at, default 1,2,4,8')
+    parser.add_argument('--keep',
+                        help='write the capture here and leave it in place')
+    parser.add_argument('--allocations', action='store_true',
+                        help='also report the memory retained per fully '
+                             'decoded packet')
+    parser.add_argument('--no-isolate', action='store_true',
+                        help='run every strategy in this process, so that '
+                             'peak RSS accumulates over them')
+    args = parser.parse_args()
+    if not 1 <= args.flows <= MAX_FLOWS:
+        parser.error('--flows must be from 1 to {}'.format(MAX_FLOWS))
+    payload_size = tuple(int(n) for n in args.payload_size.split('-', 1))
+    if len(payload_size) == 1:
+        payload_size *= 2
+
+    if args.keep:
+        path = args.keep
+    else:
+        fd, path = tempfile.mkstemp(suffix='.cap')
+        os.close(fd)
+    try:
+        print('Generating {:,} packets to {}'.format(args.packets, path),
+              file=sys.stderr)
+        write_synthetic_pcap(path, args.packets, payload_size, args.flows,
+                             args.out_of_order, args.retransmit, args.seed)
+        workers = [int(n) for n in args.workers.split(',') if n]
+        run(path, STRATEGIES + parallel_strategies(workers),
+            isolate=not args.no_isolate)
+        if args.allocations:
+            size, blocks = retained_per_packet(path)
+            print('decoded packets retain {:.0f}B in {:.1f} blocks '
+                  'each'.format(size, blocks))
+    finally:
+        if not args.keep:
+            os.remove(path)
@@ -0,0 +1,223 @@
+"""
+A small BPF-like packet filter language, compiled to byte checks.
+
+Filters are expressions such as `tcp and dst host 192.168.0.101 and not syn`,
+built from these primitives combined with `and`, `or`, `not` and parentheses
+(`&&`, `||` and `!` are accepted too):
+
+    ip, tcp, udp, icmp          the IPv4 protocol
+    [src|dst] host A.B.C.D      either (or the given) IPv4 address
+    [src|dst] port N            either (or the given) TCP or UDP port
+    syn, ack, fin, rst, psh,    a TCP flag is set
+    urg, ece, cwr, ns
+
+An expression is compiled once into the source of a Python function which
+tests fixed offsets of the raw frame, and that function is what gets called
+per packet: no header objects are built for packets that do not match, and
+most cost only a handful of byte comparisons. Only the offsets of the IP
+header, which depends on the link layer (and any VLAN tags), and of the
+TCP/UDP header, which depends on the IP header length, are computed.
+
+A frame too short for, or not carrying, the header a primitive tests simply
+does not match that primitive, so that `not tcp` matches an ARP frame, say.
+Ports and TCP flags are only found in the first fragment of a datagram.
+"""
+
+import ipaddress
+import re
+
+from pcap_solution import (LINKTYPE_ETHERNET, LINKTYPE_LINUX_SLL,
+                           LINKTYPE_LINUX_SLL2, TCP_FLAG_BITS)
+
+
+PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17}
+
+# For each link type, code setting `e` to the ether type of the network layer
+# and `n` to its offset within the frame `f`
+LINK_PRELUDES = {
+    LINKTYPE_ETHERNET: (
+        'e = f[12] << 8 | f[13]',
+        'n = 14',
+        'while e == 0x8100 or e == 0x88a8:  # skip VLAN tags',
+        '    e = f[n + 2] << 8 | f[n + 3]',
+        '    n += 4',
+    ),
+    LINKTYPE_LINUX_SLL: ('e = f[14] << 8 | f[15]', 'n = 16'),
+    LINKTYPE_LINUX_SLL2: ('e = f[0] << 8 | f[1]', 'n = 20'),
+}
+
+# conditions that must hold for a later offset to mean what we expect,
+# in terms of the variables set by `FUNCTION_TEMPLATE`
+IS_IPV4 = 'v4'
+IS_TCP = 'first and f[n + 9] == 6 and len(f) >= t + 14'
+HAS_PORTS = 'first and f[n + 9] in (6, 17) and len(f) >= t + 4'
+
+TOKEN = re.compile(r'\s*(\(|\)|&&|\|\||!|[^\s()!]+)')
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise FilterSyntaxError('cannot parse {!r}'.format(
+                expression[position:]))
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+class _Parser(object):
+    """
+    A recursive descent parser, producing Python source for an expression
+    over a frame `f` and the offset `t` of its transport header
+    """
+    SYNONYMS = {'&&': 'and', '||': 'or', '!': 'not'}
+
+    def __init__(self, tokens):
+        self.tokens = [self.SYNONYMS.get(t, t.lower()) for t in tokens]
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise FilterSyntaxError('expected {} but found {}'.format(
+                expected or 'more', token or 'end of expression'))
+        self.position += 1
+        return token
+
+    def parse(self):
+        source = self.parse_or()
+        if self.peek() is not None:
+            raise FilterSyntaxError('unexpected {!r}'.format(self.peek()))
+        return source
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == 'or':
+            self.take()
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else \
+            '({})'.format(' or '.join(terms))
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.peek() == 'and':
+            self.take()
+            terms.append(self.parse_not())
+        return terms[0] if len(terms) == 1 else \
+            '({})'.format(' and '.join(terms))
+
+    def parse_not(self):
+        if self.peek() == 'not':
+            self.take()
+            return '(not {})'.format(self.parse_not())
+        if self.peek() == '(':
+            self.take()
+            source = self.parse_or()
+            self.take(')')
+            return source
+        return self.parse_primitive()
+
+    def parse_primitive(self):
+        token = self.take()
+        if token == 'ip':
+            return '({})'.format(IS_IPV4)
+        if token in PROTOCOLS:
+            return '({} and f[n + 9] == {})'.format(
+                IS_IPV4, PROTOCOLS[token])
+        if token.upper() in TCP_FLAG_BITS:
+            bit = TCP_FLAG_BITS[token.upper()]
+            # NS is the low bit of byte 12, the rest are all of byte 13
+            if bit >> 8:
+                return '({} and f[t + 12] & {})'.format(IS_TCP, bit >> 8)
+            return '({} and f[t + 13] & {})'.format(IS_TCP, bit)
+
+        direction = None
+        if token in ('src', 'dst'):
+            direction, token = token, self.take()
+        if token == 'host':
+            return self.host(direction, self.take())
+        if token == 'port':
+            return self.port(direction, self.take())
+        raise FilterSyntaxError('unknown primitive {!r}'.format(token))
+
+    @staticmethod
+    def host(direction, address):
+        try:
+            # a dotted quad only, where inet_aton would read 1.2.3 as 1.2.0.3
+            octets = ipaddress.IPv4Address(address).packed
+        except ValueError:
+            raise FilterSyntaxError('bad host {!r}'.format(address))
+
+        def matches(offset):
+            return ' and '.join('f[n + {}] == {}'.format(offset + i, b)
+                                for i, b in enumerate(octets))
+        src, dst = matches(12), matches(16)
+        if direction == 'src':
+            return '({} and {})'.format(IS_IPV4, src)
+        if direction == 'dst':
+            return '({} and {})'.format(IS_IPV4, dst)
+        return '({} and ({} or {}))'.format(IS_IPV4, src, dst)
+
+    @staticmethod
+    def port(direction, port):
+        if not port.isdigit() or int(port) > 0xffff:
+            raise FilterSyntaxError('bad port {!r}'.format(port))
+        hi, lo = int(port) >> 8, int(port) & 0xff
+        src = 'f[t] == {} and f[t + 1] == {}'.format(hi, lo)
+        dst = 'f[t + 2] == {} and f[t + 3] == {}'.format(hi, lo)
+        if direction == 'src':
+            return '({} and {})'.format(HAS_PORTS, src)
+        if direction == 'dst':
+            return '({} and {})'.format(HAS_PORTS, dst)
+        return '({} and ({} or {}))'.format(HAS_PORTS, src, dst)
+
+
+# `v4` is whether the frame holds a whole IPv4 header, at offset `n`, `t` the
+# offset of the transport header after it, and `first` whether the datagram
+# is the first (or only) fragment, the one with the transport header in it
+FUNCTION_TEMPLATE = '''
+def frame_filter(f):
+    try:
+        {prelude}
+    except IndexError:
+        e = n = 0  # too short to hold even the link layer header
+    v4 = e == 0x0800 and len(f) >= n + 20 and f[n] >> 4 == 4
+    t = n + ((f[n] & 15) << 2) if v4 else 0
+    first = v4 and not (f[n + 6] & 0x1f or f[n + 7])
+    return bool({expression})
+'''
+
+
+def compile_filter(expression, link_type=LINKTYPE_ETHERNET):
+    """
+    Compile a filter expression into a function of a raw frame (any
+    bytes-like object) captured at the given link layer, which returns
+    whether the frame matches it.
+    """
+    try:
+        prelude = LINK_PRELUDES[link_type]
+    except KeyError:
+        raise ValueError('cannot filter link type {}'.format(link_type))
+    source = FUNCTION_TEMPLATE.format(
+        prelude='\n        '.join(prelude),
+        expression=_Parser(_tokenize(expression)).parse())
+    namespace = {}
+    exec(compile(source, '<filter {!r}>'.format(expression), 'exec'),
+         namespace)
+    frame_filter = namespace['frame_filter']
+    frame_filter.source = source
+    frame_filter.expression = expression
+    return frame_filter
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+A sidecar index of a pcap or pcapng capture, for seeking without re-scanning.
+
+Usage: ./pcap_index.py path/to/net.cap [--between T1 T2] [--flow ...]
+
+The index is built once from a pass over the packet headers, and stored
+next to the capture (by default at `<path>.idx`). It holds the offset,
+timestamp and TCP 4-tuple of every packet, so that packets in a time range,
+a byte range or a flow can be found by binary search or lookup and read
+directly with `PcapReader.packet_at`.
+
+The index file is a header followed by one fixed size row per packet, in
+capture order. The header records how much of the capture has been indexed,
+so that for a capture still being appended to, `update` need only scan and
+append rows for the packets added since.
+"""
+
+import argparse
+from array import array
+from bisect import bisect_left
+import os
+import socket
+import struct
+
+from pcap_solution import ETHER_TYPE_IPV4, FileHeader, Packet, PcapReader
+
+
+class PcapIndex(object):
+    """
+    The offset, timestamp and flow of every packet in a capture, held as
+    parallel arrays in capture order.
+
+    Timestamps are kept as integers in the capture's own units since the
+    epoch: microseconds, or nanoseconds for nanosecond pcap and for pcapng
+    (see PcapReader). Packets that are not TCP over IPv4 have a zeroed
+    4-tuple.
+    """
+    MAGIC = b'PCIX'
+    VERSION = 2
+    # magic, version, timestamp units per second, the first bytes of the
+    # capture, bytes of it indexed, number of rows
+    HEADER = struct.Struct('<4sHxxI{}sqq'.format(FileHeader.LENGTH))
+    # offset, ts_seconds, ts_micro_nano, source ip, destination ip,
+    # source port, destination port
+    ROW = struct.Struct('<qII4s4sHH')
+
+    def __init__(self, file_header_bytes, ts_units=10 ** 6):
+        self.file_header_bytes = file_header_bytes
+        self.ts_units = ts_units
+        self.indexed_size = 0
+        self.offsets = array('q')
+        self.timestamps = array('q')
+        self.flows = []
+        self.time_ordered = True
+        self._by_flow = None
+        self._unsaved = []
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @classmethod
+    def build(cls, pcap_path):
+        """Index the capture at `pcap_path` from scratch"""
+        with PcapReader(pcap_path) as reader:
+            index = cls(bytes(reader.buffer[:FileHeader.LENGTH]),
+                        reader.capture_format.ts_units)
+        index.update(pcap_path)
+        return index
+
+    @classmethod
+    def load(cls, index_path):
+        with open(index_path, 'rb') as f:
+            magic, version, ts_units, file_header_bytes, indexed_size, \
+                count = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError('{} is not a pcap index'.format(index_path))
+            rows = f.read(count * cls.ROW.size)
+        if len(rows) != count * cls.ROW.size:
+            raise ValueError('{} is truncated'.format(index_path))
+        index = cls(file_header_bytes, ts_units)
+        index.indexed_size = indexed_size
+        for row in cls.ROW.iter_unpack(rows):
+            index._append(*row)
+        index._unsaved = []
+        return index
+
+    def _append(self, offset, ts_seconds, ts_micro_nano, source_ip,
+                destination_ip, source_port, destination_port):
+        timestamp = ts_seconds * self.ts_units + ts_micro_nano
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            self.time_ordered = False
+        self.offsets.append(offset)
+        self.timestamps.append(timestamp)
+        flow = (source_ip, source_port, destination_ip, destination_port)
+        self.flows.append(flow)
+        if self._by_flow is not None:
+            self._by_flow.setdefault(flow, []).append(len(self.offsets) - 1)
+        self._unsaved.append(self.ROW.pack(
+            offset, ts_seconds, ts_micro_nano, source_ip, destination_ip,
+            source_port, destination_port))
+
+    def update(self, pcap_path):
+        """
+        Index any complete packets appended to the capture since it was last
+        indexed, returning how many were added
+        """
+        n = len(self)
+        with PcapReader(pcap_path) as reader:
+            if bytes(reader.buffer[:FileHeader.LENGTH]) != \
+                    self.file_header_bytes:
+                raise ValueError('{} is not the capture indexed'.format(
+                    pcap_path))
+            size = len(reader.buffer)
+            start = max(self.indexed_size, reader.first_record)
+            for offset, end, pcap_header, frame, capture_format in \
+                    reader.walk(start):
+                if end > size:
+                    break  # still being written
+                packet = Packet(pcap_header, frame, offset, capture_format)
+                self._append(offset, pcap_header.ts_seconds,
+                             pcap_header.ts_micro_nano, *_tcp_flow(packet))
+                self.indexed_size = end
+        return len(self) - n
+
+    def save(self, index_path):
+        """
+        Write the index to `index_path`. If it was loaded from there, only
+        rows added since are appended, and the header rewritten in place.
+        """
+        mode = 'r+b' if os.path.exists(index_path) and \
+            len(self._unsaved) < len(self) else 'wb'
+        with open(index_path, mode) as f:
+            if mode == 'wb':
+                f.write(b'\0' * self.HEADER.size)
+            else:
+                f.seek(self.HEADER.size + (len(self) - len(self._unsaved)) *
+                       self.ROW.size)
+            f.write(b''.join(self._unsaved))
+            f.truncate()
+            f.seek(0)
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.ts_units,
+                                     self.file_header_bytes,
+                                     self.indexed_size, len(self)))
+        self._unsaved = []
+
+    def between(self, start, end):
+        """
+        Indexes of the packets captured between timestamps `start`
+        (inclusive) and `end` (exclusive), as seconds since the epoch
+        """
+        start, end = int(start * self.ts_units), int(end * self.ts_units)
+        if not self.time_ordered:
+            return [i for i, t in enumerate(self.timestamps)
+                    if start <= t < end]
+        return range(bisect_left(self.timestamps, start),
+                     bisect_left(self.timestamps, end))
+
+    def byte_range(self, start, end):
+        """Indexes of the packets whose records start within [start, end)"""
+        return range(bisect_left(self.offsets, start),
+                     bisect_left(self.offsets, end))
+
+    def flow(self, key):
+        """
+        Indexes of the packets of one direction of a TCP flow, given its
+        (source ip, source port, destination ip, destination port) key with
+        ips as 4 bytes
+        """
+        if self._by_flow is None:
+            self._by_flow = {}
+            for i, flow in enumerate(self.flows):
+                self._by_flow.setdefault(flow, []).append(i)
+        return self._by_flow.get(key, [])
+
+    def packets(self, reader, indexes):
+        """Read the `Packet` at each of the given indexes from `reader`"""
+        for i in indexes:
+            yield reader.packet_at(self.offsets[i])
+
+
+def _tcp_flow(packet):
+    """
+    The (source ip, destination ip, source port, destination port) of a TCP
+    over IPv4 packet, in the order of an index row, or zeroes if it is
+    anything else
+    """
+    try:
+        if packet.ether_type == ETHER_TYPE_IPV4 and \
+                packet.ip_header.protocol == 6:
+            ip_header, tcp_header = packet.ip_header, packet.tcp_header
+            return (ip_header.source_ip, ip_header.destination_ip,
+                    tcp_header.source_port, tcp_header.destination_port)
+    except (struct.error, IndexError):
+        pass  # too short to hold the headers
+    return bytes(4), bytes(4), 0, 0
+
+
+def open_index(pcap_path, index_path=None):
+    """
+    Load the index of the capture at `pcap_path`, bringing it up to date
+    with any packets since appended, or build it if there is none yet.
+    """
+    index_path = index_path or pcap_path + '.idx'
+    try:
+        index = PcapIndex.load(index_path)
+        if os.path.getsize(pcap_path) < index.indexed_size:
+            raise ValueError('{} has been truncated'.format(pcap_path))
+        index.update(pcap_path)
+    except (OSError, ValueError):
+        index = PcapIndex.build(pcap_path)
+    if index._unsaved:
+        index.save(index_path)
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Index a pcap or pcapng capture, and query the index')
+    parser.add_argument('path', help='path to capture to be indexed')
+    parser.add_argument('--index', help='index path, default <path>.idx')
+    parser.add_argument('--between', nargs=2, type=float, metavar=('T1', 'T2'),
+                        help='show packets captured between two timestamps')
+    parser.add_argument('--flow', nargs=4,
+                        metavar=('SRC', 'SPORT', 'DST', 'DPORT'),
+                        help='show packets of one direction of a TCP flow')
+    args = parser.parse_args()
+
+    index = open_index(args.path, args.index)
+    print('{} packets indexed, {}B of {}'.format(
+        len(index), index.indexed_size, args.path))
+
+    selected = None
+    if args.between:
+        selected = index.between(*args.between)
+    if args.flow:
+        src, sport, dst, dport = args.flow
+        flow = index.flow((socket.inet_aton(src), int(sport),
+                           socket.inet_aton(dst), int(dport)))
+        selected = flow if selected is None else sorted(
+            set(selected).intersection(flow))
+    if selected is not None:
+        with PcapReader(args.path) as reader:
+            for packet in index.packets(reader, selected):
+                print('{:>10} {}'.format(packet.offset, packet))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Parse a pcap savefile across several processes.
+
+Usage: ./pcap_parallel.py -j 4 -o out.jpg path/to/net.cap
+
+A cheap scan of the pcap packet headers finds where every record starts, and
+the file is split on those boundaries into one contiguous shard per worker.
+Each worker maps the same file, decodes and verifies its own shard, and
+returns the response segments it found keyed by sequence number, along with
+its `Verifier`; these are merged in shard order at the end. Packets that fail
+verification are counted and skipped, as by pcap_solution, rather than
+aborting the whole job.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+
+from pcap_solution import VERIFY_LEVELS, PcapReader, Verifier
+
+
+def shard_boundaries(offsets, n_shards, end):
+    """
+    Split the record `offsets` of a savefile `end` bytes long into at most
+    `n_shards` contiguous `(start, end)` byte ranges of roughly equal numbers
+    of packets.
+    """
+    n = len(offsets)
+    if not n:
+        return []
+    n_shards = min(n_shards, n)
+    bounds = [offsets[n * i // n_shards] for i in range(n_shards)] + [end]
+    return list(zip(bounds, bounds[1:]))
+
+
+def decode_shard(path, start, end, destination_host, verify='full'):
+    """
+    Decode every packet between byte offsets `start` and `end`, verifying
+    them at level `verify`, returning the number of packets, a mapping of
+    sequence number to payload for each non-SYN segment that passed sent to
+    `destination_host`, and the `Verifier` with its counts.
+    """
+    verifier = Verifier(verify)
+    seq_to_data = {}
+    n = 0
+    with PcapReader(path) as reader:
+        for packet in reader.packets(start, end):
+            n += 1
+            if not verifier.check(packet):
+                continue
+            if packet.ip_header.destination_ip == destination_host and not \
+                    packet.tcp_header.syn:
+                # copy, since the payload must outlive this worker's map
+                seq_to_data[packet.tcp_header.seq_number] = \
+                    bytes(packet.payload)
+    return n, seq_to_data, verifier
+
+
+def parse_parallel(path, destination_host, workers=None, verify='full'):
+    """
+    Decode the savefile at `path` in `workers` processes (by default, one per
+    core), returning the total number of packets, the merged mapping of
+    sequence number to payload for segments sent to `destination_host`, and
+    a `Verifier` with the counts of every worker's verifier summed.
+    """
+    workers = workers or os.cpu_count()
+    destination_host = bytes(destination_host)
+    with PcapReader(path) as reader:
+        reader.file_header.verify()
+        offsets = reader.record_offsets()
+        shards = shard_boundaries(offsets, workers, len(reader.buffer))
+
+    n_packets = 0
+    seq_to_data = {}
+    verifier = Verifier(verify)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(decode_shard, path, start, end,
+                               destination_host, verify)
+                   for start, end in shards]
+        # merge in file order, so later retransmits win as they would serially
+        for future in futures:
+            n, shard_seq_to_data, shard_verifier = future.result()
+            n_packets += n
+            seq_to_data.update(shard_seq_to_data)
+            verifier.checked += shard_verifier.checked
+            verifier.failures.update(shard_verifier.failures)
+    return n_packets, seq_to_data, verifier
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Parse the pcapture of a mystery image download '
+                        'across multiple processes')
+    parser.add_argument('path', help='path to pcap file to be parsed')
+    parser.add_argument('-o', '--output',
+                        help='write to given destination file')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='number of worker processes, default one per core')
+    parser.add_argument('--verify', choices=VERIFY_LEVELS, default='full',
+                        help='how many packets to verify, default full')
+    args = parser.parse_args()
+
+    requesting_host = (192, 168, 0, 101)  # we know this is us
+
+    n_packets, seq_to_data, verifier = parse_parallel(
+        args.path, requesting_host, args.workers, args.verify)
+    http_message = b''.join(d for _, d in sorted(seq_to_data.items()))
+    http_header, http_payload = http_message.split(b'\r\n\r\n', 1)
+
+    if args.output:
+        with open(args.output, 'wb') as output:
+            output.write(http_payload)
+    else:
+        sys.stdout.buffer.write(http_payload)
+    print(verifier, file=sys.stderr)
+    print('OK! parsed {} packets, wrote {}B'.format(
+        n_packets, len(http_payload)), file=sys.stderr)
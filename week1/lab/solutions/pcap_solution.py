@@ -8,11 +8,26 @@ For extensive informational logging, use -v or --verbose flag
 """
 
 import argparse
-from collections import namedtuple
+from array import array
+from bisect import bisect_right
+from collections import Counter, namedtuple
+from collections.abc import Mapping
 from datetime import datetime
+import mmap
 import struct
 import sys
 
+from http_extract import HttpResponseExtractor
+from tcp_reassembly import Reassembler
+
+
+PCAP_MAGIC_MICROSECONDS = 0xa1b2c3d4
+PCAP_MAGIC_NANOSECONDS = 0xa1b23c4d
+
+# See https://www.tcpdump.org/linktypes.html
+LINKTYPE_ETHERNET = 1
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
 
 file_header_fields = ['magic_number', 'major_version', 'minor_version',
                       'tz_offset', 'tz_accuracy', 'snapshot_length',
@@ -27,21 +42,45 @@ class FileHeader(namedtuple('FileHeader', file_header_fields)):
     """
     __slots__ = ()
     LENGTH = 24
+    STRUCT = struct.Struct('IHHIIII')
+    STRUCTS = {'<': struct.Struct('<IHHIIII'), '>': struct.Struct('>IHHIIII')}
 
     def __new__(cls, bs):
-        return super().__new__(cls, *struct.unpack('IHHIIII', bs))
+        return cls.unpack_from(bs)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """Parse the header directly out of `buf` at `offset`, without copying"""
+        byte_order, _ = cls.detect(buf, offset)
+        return cls._make(cls.STRUCTS[byte_order].unpack_from(buf, offset))
+
+    @staticmethod
+    def detect(buf, offset=0):
+        """
+        Given a savefile, determine from its magic number the byte order it
+        was written in ('<' or '>') and whether its timestamps are in
+        nanoseconds rather than microseconds
+        """
+        magic = bytes(buf[offset:offset + 4])
+        for byte_order, endianness in (('<', 'little'), ('>', 'big')):
+            number = int.from_bytes(magic, endianness)
+            if number in (PCAP_MAGIC_MICROSECONDS, PCAP_MAGIC_NANOSECONDS):
+                return byte_order, number == PCAP_MAGIC_NANOSECONDS
+        raise ValueError('not a pcap savefile (magic number {})'.format(
+            magic.hex()))
 
     def __str__(self):
         return "pcap savefile version {}.{}".format(
                 self.major_version, self.minor_version)
 
     def verify(self):
-        assert self.magic_number == 0xa1b2c3d4
+        assert self.magic_number in (PCAP_MAGIC_MICROSECONDS,
+                                     PCAP_MAGIC_NANOSECONDS)
         assert self.major_version == 2
         assert self.minor_version == 4
         assert self.tz_offset == 0
         assert self.tz_accuracy == 0
-        assert self.link_type == 1  # LINKTYPE_ETHERNET
+        assert self.link_type in LINK_LAYERS
 
 
 pcap_packet_header_fields = ['ts_seconds', 'ts_micro_nano', 'payload_length',
@@ -58,18 +97,47 @@ class PcapPacketHeader(namedtuple('PcapPacketHeader',
     """
     __slots__ = ()
     LENGTH = 16
+    STRUCT = struct.Struct('IIII')
+    STRUCTS = {'<': struct.Struct('<IIII'), '>': struct.Struct('>IIII')}
 
     def __new__(cls, bs):
-        return super().__new__(cls, *struct.unpack('IIII', bs))
+        return cls.unpack_from(bs)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """Parse the header directly out of `buf` at `offset`, without copying"""
+        return cls._make(cls.STRUCT.unpack_from(buf, offset))
+
+    def timestamp(self, ts_units):
+        """
+        Seconds since the epoch at which the packet was captured, given the
+        units per second of `ts_micro_nano`, which depend on the savefile
+        (see `CaptureFormat`)
+        """
+        return self.ts_seconds + self.ts_micro_nano / ts_units
+
+    def describe(self, ts_units):
+        return "pcap packet length {}B, captured at {}".format(
+            self.payload_length,
+            datetime.fromtimestamp(self.timestamp(ts_units)))
 
     def __str__(self):
+        # the header alone does not say whether `ts_micro_nano` counts
+        # microseconds or nanoseconds, so give just the whole seconds; a
+        # `Packet` knows, and gives the full timestamp
         return "pcap packet length {}B, captured at {}".format(
-            self.payload_length, datetime.fromtimestamp(
-                self.ts_seconds + 1e-6 * self.ts_micro_nano))
+            self.payload_length, datetime.fromtimestamp(self.ts_seconds))
+
+    def failure(self):
+        """The reason this header fails verification, or None"""
+        if self.payload_length != self.untruncated_length:
+            return 'truncated'  # the entire packet was not captured
+        return None
 
     def verify(self):
         """ensure that the entire packet was captured"""
-        assert self.payload_length == self.untruncated_length
+        reason = self.failure()
+        assert reason is None, reason
 
 
 ethernet_header_fields = ['destination_mac', 'source_mac', 'ether_type']
@@ -84,9 +152,15 @@ class EthernetFrameHeader(namedtuple('EthernetFrameHeader',
     """
     __slots__ = ()
     LENGTH = 14
+    STRUCT = struct.Struct('!6s6sH')
 
     def __new__(cls, bs):
-        return super().__new__(cls, bs[0:6], bs[6:12], bs[12:14])
+        return cls.unpack_from(bs)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """Parse the header directly out of `buf` at `offset`, without copying"""
+        return cls._make(cls.STRUCT.unpack_from(buf, offset))
 
     def __str__(self):
         def fmt_mac(bs):
@@ -94,15 +168,22 @@ class EthernetFrameHeader(namedtuple('EthernetFrameHeader',
         return "Ethernet frame from {} to {}".format(
             fmt_mac(self.source_mac), fmt_mac(self.destination_mac))
 
-    def verify(self):
+    def failure(self):
+        """The reason this header fails verification, or None"""
         # Verify ethertype for an IPv4 datagram
-        assert self.ether_type == bytes.fromhex('0800')
+        if self.ether_type != ETHER_TYPE_IPV4:
+            return 'ether_type'
+        return None
+
+    def verify(self):
+        reason = self.failure()
+        assert reason is None, reason
 
 
 ip_datagram_header_fields = [
-    'version', 'ihl', 'dscp', 'ecn', 'total_length', 'identification', 'flags',
-    'fragment_offset', 'ttl', 'protocol', 'checksum', 'source_ip',
-    'destination_ip'
+    'version_ihl', 'dscp_ecn', 'total_length', 'identification',
+    'flags_fragment_offset', 'ttl', 'protocol', 'checksum', 'source_address',
+    'destination_address'
 ]
 
 
@@ -111,25 +192,55 @@ class IpDatagramHeader(namedtuple('IpDatagramHeader',
     """
     The header of an IPv4 datagram
 
+    Fields packed together on the wire are held as the raw integers unpacked,
+    and split apart by properties only when asked for; the addresses are
+    likewise held as integers, with `source_ip` and `destination_ip` giving
+    their 4 bytes.
+
     See https://en.wikipedia.org/wiki/IPv4#Packet_structure for specification
     """
     __slots__ = ()
+    STRUCT = struct.Struct('!BBHHHBBHII')
 
     def __new__(cls, bs):
-        b1, b2, total_length, identification, b7_8, ttl, protocol, checksum = \
-            struct.unpack('BBHHHBBH', bs[:12])
-        version = b1 >> 4
-        ihl = cls.get_ihl(b1)
-        dscp = b2 >> 2
-        ecn = b2 & 3
-        flags = b7_8 >> 13
-        fragment_offset = b7_8 & 0x1fff
-        source_ip = bs[12:16]
-        destination_ip = bs[16:20]
-        return super().__new__(
-            cls, version, ihl, dscp, ecn, total_length, identification, flags,
-            fragment_offset, ttl, protocol, checksum, source_ip,
-            destination_ip)
+        return cls.unpack_from(bs)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """Parse the header directly out of `buf` at `offset`, without copying"""
+        return cls._make(cls.STRUCT.unpack_from(buf, offset))
+
+    @property
+    def version(self):
+        return self.version_ihl >> 4
+
+    @property
+    def ihl(self):
+        return self.get_ihl(self.version_ihl)
+
+    @property
+    def dscp(self):
+        return self.dscp_ecn >> 2
+
+    @property
+    def ecn(self):
+        return self.dscp_ecn & 3
+
+    @property
+    def flags(self):
+        return self.flags_fragment_offset >> 13
+
+    @property
+    def fragment_offset(self):
+        return self.flags_fragment_offset & 0x1fff
+
+    @property
+    def source_ip(self):
+        return self.source_address.to_bytes(4, 'big')
+
+    @property
+    def destination_ip(self):
+        return self.destination_address.to_bytes(4, 'big')
 
     def __str__(self):
         def fmt_ip(bs):
@@ -146,56 +257,131 @@ class IpDatagramHeader(namedtuple('IpDatagramHeader',
         return b & 0x0f
 
     @staticmethod
-    def verify_checksum(bs):
+    def checksum_ok(bs):
         """
         The 16 bit one's complement of the one's complement sum of all 16 bit
         values in the header should be 0
+
+        Since 2**16 is congruent to 1 modulo 0xffff, the one's complement sum
+        of the 16 bit words of a big-endian integer is congruent to the integer
+        itself, so rather than summing word by word we can take the whole
+        header as one integer modulo 0xffff. A sum of 0xffff is congruent to
+        0 (as is a sum of 0, but only from an all zero header, which would
+        fail on its version anyway).
         """
-        total = sum(t[0] for t in struct.iter_unpack('H', bs))
-        carry_wrapped = (total & 0xffff) + (total >> 16)
-        assert carry_wrapped == 0xffff
+        return int.from_bytes(bs, 'big') % 0xffff == 0
+
+    @classmethod
+    def verify_checksum(cls, bs):
+        assert cls.checksum_ok(bs), 'ip_checksum'
+
+    def failure(self):
+        """The reason this header fails verification, or None"""
+        if self.version != 4:
+            return 'ip_version'
+        if self.ecn != 0:
+            return 'ip_ecn'
+        if self.protocol != 6:  # indicates TCP
+            return 'ip_protocol'
+        return None
 
     def verify(self):
-        assert self.version == 4
-        assert self.ecn == 0
-        assert self.protocol == 6  # indicates TCP
+        reason = self.failure()
+        assert reason is None, reason
 
 
 tcp_header_fields = ['source_port', 'destination_port', 'seq_number',
-                     'ack_number', 'data_offset', 'reserved_bits', 'flags',
-                     'window_size', 'checksum', 'urgent_pointer']
+                     'ack_number', 'offset_flags', 'window_size', 'checksum',
+                     'urgent_pointer']
+
+
+# bit positions of each flag within the 9 bit TCP control field
+TCP_FLAG_BITS = {
+    'NS': 1 << 8, 'CWR': 1 << 7, 'ECE': 1 << 6, 'URG': 1 << 5, 'ACK': 1 << 4,
+    'PSH': 1 << 3, 'RST': 1 << 2, 'SYN': 1 << 1, 'FIN': 1 << 0
+}
+
+
+class TcpFlags(Mapping):
+    """
+    A read-only view of the TCP control bits as a mapping of flag name (see
+    TCP_FLAG_BITS) to whether it is set
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, bits):
+        self.bits = bits
+
+    def __getitem__(self, name):
+        return self.bits & TCP_FLAG_BITS[name] != 0
+
+    def __iter__(self):
+        return iter(TCP_FLAG_BITS)
+
+    def __len__(self):
+        return len(TCP_FLAG_BITS)
+
+    def __repr__(self):
+        return 'TcpFlags({})'.format(
+            '|'.join(name for name, bit in TCP_FLAG_BITS.items()
+                     if self.bits & bit) or 0)
+
+
+def _tcp_flag(name):
+    bit = TCP_FLAG_BITS[name]
+    return property(lambda self: self.offset_flags & bit != 0,
+                    doc='Whether the {} flag is set'.format(name))
 
 
 class TcpHeader(namedtuple('TcpHeader', tcp_header_fields)):
     """
     A TCP segment header
 
+    The data offset, reserved bits and flags share 16 bits, which are held as
+    the raw integer `offset_flags` and split apart by properties only when
+    asked for. Flags are tested individually with `syn`, `ack` etc, or all
+    together as the bitmask `flag_bits`; `flags` gives them as a mapping of
+    flag name to bool.
+
     See https://en.wikipedia.org/wiki/Transmission_Control_Protocol#TCP_segment_structure
     """
     __slots__ = ()
     DEFAULT_LENGTH = 20
+    STRUCT = struct.Struct('!HHIIHHHH')
 
     def __new__(cls, bs):
-        source_port, destination_port, seq_number, ack_number, b12_13, \
-            window_size, checksum, urgent_pointer \
-            = struct.unpack('!HHIIHHHH', bs[:20])
-        data_offset = cls.get_data_offset(bs[:20])
-        reserved_bits = (b12_13 >> 9) & 7
-        flags = {
-            'NS': (b12_13 & (1 << 8)) > 0,
-            'CWR': (b12_13 & (1 << 7)) > 0,
-            'ECE': (b12_13 & (1 << 6)) > 0,
-            'URG': (b12_13 & (1 << 5)) > 0,
-            'ACK': (b12_13 & (1 << 4)) > 0,
-            'PSH': (b12_13 & (1 << 3)) > 0,
-            'RST': (b12_13 & (1 << 2)) > 0,
-            'SYN': (b12_13 & (1 << 1)) > 0,
-            'FIN': (b12_13 & (1 << 0)) > 0
-        }
-        return super().__new__(
-            cls, source_port, destination_port, seq_number, ack_number,
-            data_offset, reserved_bits, flags, window_size, checksum,
-            urgent_pointer)
+        return cls.unpack_from(bs)
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """Parse the header directly out of `buf` at `offset`, without copying"""
+        return cls._make(cls.STRUCT.unpack_from(buf, offset))
+
+    @property
+    def data_offset(self):
+        return self.offset_flags >> 12
+
+    @property
+    def reserved_bits(self):
+        return (self.offset_flags >> 9) & 7
+
+    @property
+    def flag_bits(self):
+        return self.offset_flags & 0x1ff
+
+    @property
+    def flags(self):
+        return TcpFlags(self.offset_flags & 0x1ff)
+
+    ns = _tcp_flag('NS')
+    cwr = _tcp_flag('CWR')
+    ece = _tcp_flag('ECE')
+    urg = _tcp_flag('URG')
+    ack = _tcp_flag('ACK')
+    psh = _tcp_flag('PSH')
+    rst = _tcp_flag('RST')
+    syn = _tcp_flag('SYN')
+    fin = _tcp_flag('FIN')
 
     def __str__(self):
         return 'TCP segment from port {} to {}'.format(
@@ -211,11 +397,598 @@ class TcpHeader(namedtuple('TcpHeader', tcp_header_fields)):
         """
         return bs[12] >> 4
 
+    def failure(self):
+        """The reason this header fails verification, or None"""
+        if self.reserved_bits != 0:
+            return 'tcp_reserved'  # reserved for future use in protocol
+        return None
+
+    def verify(self):
+        reason = self.failure()
+        assert reason is None, reason
+
+
+VLAN_ETHER_TYPES = (0x8100, 0x88a8)  # 802.1Q and 802.1ad tags
+ETHER_TYPE_IPV4 = 0x0800
+
+
+def _ethernet_network_layer(frame):
+    """
+    The ether type and offset of the network layer of an Ethernet frame,
+    skipping over any VLAN tags
+    """
+    offset = 12
+    ether_type = frame[12] << 8 | frame[13]
+    while ether_type in VLAN_ETHER_TYPES:
+        offset += 4
+        ether_type = frame[offset] << 8 | frame[offset + 1]
+    return ether_type, offset + 2
+
+
+def _linux_sll_network_layer(frame):
+    """
+    The protocol type and offset of the network layer of a Linux "cooked"
+    capture, see https://www.tcpdump.org/linktypes/LINKTYPE_LINUX_SLL.html
+    """
+    return frame[14] << 8 | frame[15], 16
+
+
+def _linux_sll2_network_layer(frame):
+    """
+    As for LINKTYPE_LINUX_SLL, but the v2 header, see
+    https://www.tcpdump.org/linktypes/LINKTYPE_LINUX_SLL2.html
+    """
+    return frame[0] << 8 | frame[1], 20
+
+
+def _unknown_network_layer(frame):
+    """For link layers we cannot decode, which then fail verification"""
+    return None, 0
+
+
+LINK_LAYERS = {
+    LINKTYPE_ETHERNET: _ethernet_network_layer,
+    LINKTYPE_LINUX_SLL: _linux_sll_network_layer,
+    LINKTYPE_LINUX_SLL2: _linux_sll2_network_layer,
+}
+
+
+class CaptureFormat(namedtuple('CaptureFormat',
+                               'link_type network_layer ts_units')):
+    """
+    How to interpret the packets of a capture: the link layer they were
+    captured at, and the units per second of `ts_micro_nano`
+    """
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, link_type, ts_units=10 ** 6):
+        return cls(link_type,
+                   LINK_LAYERS.get(link_type, _unknown_network_layer),
+                   ts_units)
+
+
+ETHERNET_FORMAT = CaptureFormat.of(LINKTYPE_ETHERNET)
+
+
+class Packet(object):
+    """
+    A single captured packet, decoded lazily one layer at a time.
+
+    Only the pcap header is parsed up front. The link layer, IP and TCP
+    headers are each parsed out of the captured frame the first time they are
+    accessed and then cached, so a caller that only looks at IP addresses
+    never pays for decoding the TCP header.
+
+    `frame` and `payload` are views onto the underlying capture, and are only
+    valid while the reader that produced the packet is open; take a
+    `bytes(...)` copy of anything that must outlive it.
+    """
+    __slots__ = ('pcap_header', 'frame', 'offset', 'capture_format',
+                 '_network', '_ethernet_header', '_ip_header', '_tcp_header')
+
+    def __init__(self, pcap_header, frame, offset=None,
+                 capture_format=ETHERNET_FORMAT):
+        self.pcap_header = pcap_header
+        self.frame = frame
+        self.offset = offset  # of the pcap record within the savefile
+        self.capture_format = capture_format
+        self._network = None
+        self._ethernet_header = None
+        self._ip_header = None
+        self._tcp_header = None
+
+    def __str__(self):
+        return self.pcap_header.describe(self.capture_format.ts_units)
+
+    @property
+    def timestamp(self):
+        """Seconds since the epoch at which the packet was captured"""
+        return self.pcap_header.timestamp(self.capture_format.ts_units)
+
+    @property
+    def network(self):
+        """The ether type of the network layer and its offset in the frame"""
+        if self._network is None:
+            self._network = self.capture_format.network_layer(self.frame)
+        return self._network
+
+    @property
+    def ether_type(self):
+        return self.network[0]
+
+    @property
+    def ip_offset(self):
+        """Offset of the IP datagram within the frame"""
+        return self.network[1]
+
+    @property
+    def ethernet_header(self):
+        """The Ethernet header, or None if captured at another link layer"""
+        if self._ethernet_header is None and \
+                self.capture_format.link_type == LINKTYPE_ETHERNET:
+            self._ethernet_header = EthernetFrameHeader.unpack_from(self.frame)
+        return self._ethernet_header
+
+    @property
+    def ip_header(self):
+        if self._ip_header is None:
+            self._ip_header = IpDatagramHeader.unpack_from(
+                    self.frame, self.ip_offset)
+        return self._ip_header
+
+    @property
+    def tcp_offset(self):
+        """Offset of the TCP segment within the frame"""
+        ip_offset = self.ip_offset
+        return ip_offset + 4 * IpDatagramHeader.get_ihl(self.frame[ip_offset])
+
+    @property
+    def tcp_header(self):
+        if self._tcp_header is None:
+            self._tcp_header = TcpHeader.unpack_from(
+                    self.frame, self.tcp_offset)
+        return self._tcp_header
+
+    @property
+    def payload(self):
+        """
+        The payload of the TCP segment, ending where the IP datagram does so
+        that any Ethernet padding of short frames is excluded
+        """
+        return self.frame[self.tcp_offset + 4 * self.tcp_header.data_offset:
+                          self.ip_offset + self.ip_header.total_length]
+
+    def rejection(self):
+        """
+        The reason the packet is not a whole TCP segment over IPv4, or None if
+        it is. Only the type and length fields are examined, which is cheap
+        enough to do for every packet whatever the level of verification.
+        """
+        try:
+            failure = self.pcap_header.failure()
+            if failure is not None:
+                return failure
+            if self.ether_type != ETHER_TYPE_IPV4:
+                return 'ether_type'
+            ip_header = self.ip_header
+            if ip_header.version != 4:
+                return 'ip_version'
+            if ip_header.protocol != 6:
+                return 'ip_protocol'
+            if ip_header.flags & 1 or ip_header.fragment_offset:
+                return 'ip_fragment'  # only part of a segment
+            self.tcp_header
+            return None
+        except (struct.error, IndexError):
+            return 'short_frame'  # too short to hold the headers at all
+
+    def failure(self):
+        """
+        The reason the first layer of the packet to fail verification does so,
+        or None if it passes. Layers are decoded as needed.
+        """
+        failure = self.rejection()
+        if failure is not None:
+            return failure
+        failure = self.ip_header.failure()
+        if failure is not None:
+            return failure
+        if not IpDatagramHeader.checksum_ok(
+                self.frame[self.ip_offset:self.tcp_offset]):
+            return 'ip_checksum'
+        return self.tcp_header.failure()
+
     def verify(self):
-        assert self.reserved_bits == 0  # reserved for future use in protocol
+        """Verify every layer of the packet, decoding any not yet decoded"""
+        reason = self.failure()
+        assert reason is None, reason
+
+
+VERIFY_LEVELS = ('off', 'sampled', 'full')
+
+
+class Verifier(object):
+    """
+    Verify packets at a selectable level of cost, counting failures by reason
+    rather than aborting on the first.
+
+    Every packet is first checked to be a whole TCP segment over IPv4, since
+    anything else cannot be reassembled. Beyond that, at level 'full' every
+    packet is verified; at 'sampled', one in every `sample_every`; at 'off',
+    none. Packets not verified are assumed good.
+    """
+    def __init__(self, level='full', sample_every=100):
+        if level not in VERIFY_LEVELS:
+            raise ValueError('unknown verification level {!r}'.format(level))
+        self.level = level
+        self.sample_every = sample_every
+        self.checked = 0
+        self.failures = Counter()
+        self._countdown = 0
+
+    def check(self, packet):
+        """
+        Check that `packet` is a TCP segment and verify it if due at this
+        level, returning whether it passed
+        """
+        reason = packet.rejection()
+        if reason is None:
+            if self.level == 'off':
+                return True
+            if self.level == 'sampled':
+                if self._countdown:
+                    self._countdown -= 1
+                    return True
+                self._countdown = self.sample_every - 1
+            self.checked += 1
+            reason = packet.failure()
+        if reason is None:
+            return True
+        self.failures[reason] += 1
+        return False
+
+    def __str__(self):
+        if not self.failures:
+            return 'verified {} packets, all OK'.format(self.checked)
+        return 'verified {} packets, failures: {}'.format(
+            self.checked, ', '.join('{} {}'.format(n, reason) for reason, n
+                                    in self.failures.most_common()))
+
+
+section_header_fields = ['byte_order_magic', 'major_version', 'minor_version',
+                         'section_length']
+
+
+class SectionHeader(namedtuple('SectionHeader', section_header_fields)):
+    """
+    The body of a pcapng Section Header Block, which plays the part of the
+    FileHeader for each section of a pcapng file
+
+    See https://www.ietf.org/archive/id/draft-ietf-opsawg-pcapng-01.html
+    """
+    __slots__ = ()
+    BLOCK_TYPE = 0x0a0d0d0a
+    BYTE_ORDER_MAGIC = 0x1a2b3c4d
+    STRUCTS = {'<': struct.Struct('<8xIHHq'), '>': struct.Struct('>8xIHHq')}
+
+    @classmethod
+    def unpack_from(cls, buf, offset=0):
+        """Parse the block at `offset`, returning it and its byte order"""
+        magic = bytes(buf[offset + 8:offset + 12])
+        if magic == cls.BYTE_ORDER_MAGIC.to_bytes(4, 'little'):
+            byte_order = '<'
+        elif magic == cls.BYTE_ORDER_MAGIC.to_bytes(4, 'big'):
+            byte_order = '>'
+        else:
+            raise ValueError('bad pcapng byte order magic {}'.format(
+                magic.hex()))
+        return cls._make(cls.STRUCTS[byte_order].unpack_from(buf, offset)), \
+            byte_order
+
+    def __str__(self):
+        return "pcapng section version {}.{}".format(
+                self.major_version, self.minor_version)
+
+    def verify(self):
+        assert self.byte_order_magic == self.BYTE_ORDER_MAGIC
+        assert self.major_version == 1
+
+
+# pcapng block types, besides the section header
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_IF_TSRESOL = 9  # interface description option for timestamp units
+
+# the block structures we read, by byte order
+_PCAPNG_BLOCK_HEADER = {o: struct.Struct(o + 'II') for o in '<>'}
+_PCAPNG_INTERFACE = {o: struct.Struct(o + '8xHxxI') for o in '<>'}
+_PCAPNG_OPTION = {o: struct.Struct(o + 'HH') for o in '<>'}
+_PCAPNG_ENHANCED_PACKET = {o: struct.Struct(o + '8xIIIII') for o in '<>'}
+_PCAPNG_SIMPLE_PACKET = {o: struct.Struct(o + '8xI') for o in '<>'}
+
+# just the payload_length field of a PcapPacketHeader, for skipping records
+_PAYLOAD_LENGTH = {o: struct.Struct(o + '8xI') for o in '<>'}
+
+
+class PcapReader(object):
+    """
+    Walk a pcap savefile through a read-only memory map.
+
+    Rather than issuing a `read()` per pcap header and per frame, the whole
+    savefile is mapped once and each header class parses itself straight out
+    of the map with `unpack_from`. Iterating yields `(pcap_header, frame)`
+    pairs, where `frame` is a `memoryview` onto the captured bytes: slicing it
+    further (into an IP datagram, TCP segment etc) never copies.
+
+    Savefiles of either byte order and timestamp resolution are read, as are
+    pcapng files: the structures for the format are chosen once, when the
+    file is opened, so that the loop over packets never branches on it. For
+    pcapng, each packet block is presented with a PcapPacketHeader whose
+    `ts_micro_nano` is in nanoseconds.
+
+    Views handed out by the reader are only valid while it is open.
+    """
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped, and is no pcap savefile either
+            self._file.close()
+            raise
+        self.buffer = memoryview(self._map)
+        first_word = bytes(self.buffer[:4])
+        if first_word == SectionHeader.BLOCK_TYPE.to_bytes(4, 'big'):
+            self._open_pcapng()
+        else:
+            self._open_pcap()
+        self.link_type = self.capture_format.link_type
+
+    def _open_pcap(self):
+        self.format = 'pcap'
+        self.byte_order, nanoseconds = FileHeader.detect(self.buffer)
+        self.file_header = FileHeader._make(
+            FileHeader.STRUCTS[self.byte_order].unpack_from(self.buffer))
+        self.capture_format = CaptureFormat.of(
+            self.file_header.link_type, 10 ** 9 if nanoseconds else 10 ** 6)
+        self.first_record = FileHeader.LENGTH
+        self._packet_header = PcapPacketHeader.STRUCTS[self.byte_order]
+        self._walk = self._walk_pcap
+
+    def _open_pcapng(self):
+        self.format = 'pcapng'
+        self.file_header, self.byte_order = SectionHeader.unpack_from(
+            self.buffer)
+        # (offset, byte order, interface capture formats) of each section
+        # seen so far, and the offset up to which blocks have been scanned
+        self._sections = []
+        self._scanned_to = 0
+        self.first_record = 0
+        self._walk = self._walk_pcapng
+        # the first interface is described before any packets
+        _, interfaces = self._pcapng_state_at(0)
+        offset = 0
+        while not interfaces and offset < len(self.buffer):
+            offset = self._scan_pcapng_block(offset)
+        if not interfaces:
+            raise ValueError('pcapng file describes no interfaces')
+        self.capture_format = interfaces[0][1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def walk(self, start=None, end=None):
+        """
+        Iterate over `(offset, next_offset, pcap_header, frame,
+        capture_format)` for each record between byte offsets `start` and
+        `end`, which must fall on record boundaries (see `record_offsets`).
+        By default, the whole savefile.
+        """
+        if start is None:
+            start = self.first_record
+        end = len(self.buffer) if end is None else min(end, len(self.buffer))
+        return self._walk(start, end)
+
+    def _walk_pcap(self, offset, end):
+        buf = self.buffer
+        unpack_header = self._packet_header.unpack_from
+        make_header = PcapPacketHeader._make
+        capture_format = self.capture_format
+        while offset + PcapPacketHeader.LENGTH <= end:
+            pcap_header = make_header(unpack_header(buf, offset))
+            frame_start = offset + PcapPacketHeader.LENGTH
+            frame_end = frame_start + pcap_header.payload_length
+            yield offset, frame_end, pcap_header, buf[frame_start:frame_end], \
+                capture_format
+            offset = frame_end
+
+    def _pcapng_state_at(self, offset):
+        """
+        The byte order and interfaces of the pcapng section containing
+        `offset`, scanning the blocks up to it if not already seen
+        """
+        while self._scanned_to <= offset and \
+                self._scanned_to < len(self.buffer):
+            self._scan_pcapng_block(self._scanned_to)
+        i = bisect_right([s[0] for s in self._sections], offset) - 1
+        _, byte_order, interfaces = self._sections[max(i, 0)]
+        return byte_order, interfaces
+
+    def _scan_pcapng_block(self, offset):
+        """
+        Note the section or interface described by the block at `offset`, if
+        not done already, returning the offset of the next block
+        """
+        buf = self.buffer
+        if bytes(buf[offset:offset + 4]) == \
+                SectionHeader.BLOCK_TYPE.to_bytes(4, 'big'):
+            _, byte_order = SectionHeader.unpack_from(buf, offset)
+            if offset >= self._scanned_to:
+                self._sections.append((offset, byte_order, []))
+        else:
+            byte_order = self._sections[-1][1] if offset >= self._scanned_to \
+                else self._pcapng_state_at(offset)[0]
+        block_type, block_length = \
+            _PCAPNG_BLOCK_HEADER[byte_order].unpack_from(buf, offset)
+        if block_length < 12 or block_length % 4:
+            raise ValueError('corrupt pcapng block at {}'.format(offset))
+        if block_type == PCAPNG_INTERFACE_DESCRIPTION and \
+                offset >= self._scanned_to:
+            self._sections[-1][2].append(
+                self._interface_format(offset, block_length, byte_order))
+        next_offset = offset + block_length
+        self._scanned_to = max(self._scanned_to, next_offset)
+        return next_offset
+
+    def _interface_format(self, offset, block_length, byte_order):
+        """
+        The timestamp units of an Interface Description Block, along with the
+        CaptureFormat of its packets once their timestamps are converted to
+        nanoseconds
+        """
+        buf = self.buffer
+        link_type, _ = _PCAPNG_INTERFACE[byte_order].unpack_from(buf, offset)
+        ts_units = 10 ** 6
+        option = offset + 16
+        unpack_option = _PCAPNG_OPTION[byte_order].unpack_from
+        while option + 4 <= offset + block_length - 4:
+            code, length = unpack_option(buf, option)
+            if code == 0:
+                break
+            if code == PCAPNG_IF_TSRESOL:
+                resolution = buf[option + 4]
+                # a power of 10, unless the top bit is set for a power of 2
+                ts_units = 2 ** (resolution & 0x7f) if resolution & 0x80 \
+                    else 10 ** resolution
+            option += 4 + (length + 3) // 4 * 4
+        return ts_units, CaptureFormat.of(link_type, 10 ** 9)
+
+    def _walk_pcapng(self, offset, end):
+        buf = self.buffer
+        byte_order, interfaces = self._pcapng_state_at(offset)
+        make_header = PcapPacketHeader._make
+        while offset + 12 <= end:
+            block_type, block_length = \
+                _PCAPNG_BLOCK_HEADER[byte_order].unpack_from(buf, offset)
+            if block_type == SectionHeader.BLOCK_TYPE or \
+                    block_type == PCAPNG_INTERFACE_DESCRIPTION:
+                next_offset = self._scan_pcapng_block(offset)
+                byte_order, interfaces = self._pcapng_state_at(offset)
+                offset = next_offset
+                continue
+            if block_length < 12 or block_length % 4:
+                raise ValueError('corrupt pcapng block at {}'.format(offset))
+            next_offset = offset + block_length
+            if block_type == PCAPNG_ENHANCED_PACKET:
+                interface, ts_high, ts_low, captured_length, original_length \
+                    = _PCAPNG_ENHANCED_PACKET[byte_order].unpack_from(
+                        buf, offset)
+                ts_units, capture_format = interfaces[interface]
+                ts_seconds, ts_fraction = divmod(ts_high << 32 | ts_low,
+                                                 ts_units)
+                pcap_header = make_header((
+                    ts_seconds, ts_fraction * 10 ** 9 // ts_units,
+                    captured_length, original_length))
+                yield offset, next_offset, pcap_header, \
+                    buf[offset + 28:offset + 28 + captured_length], \
+                    capture_format
+            elif block_type == PCAPNG_SIMPLE_PACKET:
+                original_length, = \
+                    _PCAPNG_SIMPLE_PACKET[byte_order].unpack_from(buf, offset)
+                captured_length = min(original_length, block_length - 16)
+                pcap_header = make_header(
+                    (0, 0, captured_length, original_length))
+                yield offset, next_offset, pcap_header, \
+                    buf[offset + 12:offset + 12 + captured_length], \
+                    interfaces[0][1]
+            offset = next_offset
+
+    def records(self, start=None, end=None):
+        """
+        Iterate over `(pcap_header, frame)` pairs for the records between
+        byte offsets `start` and `end`, which must fall on record boundaries
+        (see `record_offsets`). By default, the whole savefile.
+        """
+        for _, _, pcap_header, frame, _ in self.walk(start, end):
+            yield pcap_header, frame
+
+    def record_offsets(self):
+        """
+        Scan the savefile for the offset of every pcap packet header (or
+        pcapng packet block).
+
+        For pcap savefiles, only the captured length of each record is read
+        in order to skip to the next, which makes this far cheaper than a
+        full parse. Returns an `array('q')` of offsets into `buffer`.
+        """
+        if self.format == 'pcapng':
+            return array('q', (offset for offset, *_ in self.walk()))
+        buf = self.buffer
+        end = len(buf)
+        offsets = array('q')
+        append = offsets.append
+        offset = FileHeader.LENGTH
+        unpack_length = _PAYLOAD_LENGTH[self.byte_order].unpack_from
+        while offset + PcapPacketHeader.LENGTH <= end:
+            append(offset)
+            offset += PcapPacketHeader.LENGTH + unpack_length(buf, offset)[0]
+        return offsets
+
+    def packets(self, start=None, end=None, frame_filter=None):
+        """
+        Iterate over the savefile as lazily decoded `Packet` records,
+        optionally only those whose raw frame passes `frame_filter` (see
+        pcap_filter.compile_filter)
+        """
+        for offset, _, pcap_header, frame, capture_format in \
+                self.walk(start, end):
+            if frame_filter is None or frame_filter(frame):
+                yield Packet(pcap_header, frame, offset, capture_format)
+
+    def packet_at(self, offset):
+        """The `Packet` whose record starts at byte `offset`"""
+        for offset, _, pcap_header, frame, capture_format in \
+                self.walk(offset):
+            return Packet(pcap_header, frame, offset, capture_format)
+        raise IndexError('no packet at offset {}'.format(offset))
+
+    def close(self):
+        try:
+            self.buffer.release()
+            self._map.close()
+        except BufferError:
+            # views handed out by the reader are still referenced; the map
+            # is released once the last of them is garbage collected
+            pass
+        self._file.close()
+
+
+def iter_packets(path, frame_filter=None):
+    """
+    Stream the packets of the pcap savefile at `path` as `Packet` records,
+    optionally only those whose raw frame passes `frame_filter`.
+
+    The file is memory mapped rather than read into memory, so this runs in
+    constant memory however large the capture. The mapping is closed once the
+    generator is exhausted or closed.
+    """
+    with PcapReader(path) as reader:
+        reader.file_header.verify()
+        yield from reader.packets(frame_filter=frame_filter)
 
 
 if __name__ == '__main__':
+    from pcap_filter import compile_filter
+
     parser = argparse.ArgumentParser(
             description='Parse the pcapture of a mystery image download')
     parser.add_argument('path', help='path to pcap file to be parsed')
@@ -223,9 +996,14 @@ if __name__ == '__main__':
                         help='write to given destination file')
     parser.add_argument('-v', '--verbose', help='show log output',
                         action='store_true')
+    parser.add_argument('--verify', choices=VERIFY_LEVELS, default='full',
+                        help='how many packets to verify, default full')
+    parser.add_argument('-f', '--filter',
+                        help='only consider packets matching a filter '
+                             'expression, e.g. "tcp and port 80"')
     args = parser.parse_args()
 
-    requesting_host = (192, 168, 0, 101)  # we know this is us
+    requesting_host = bytes((192, 168, 0, 101))  # we know this is us
 
     if args.verbose:
         def log(s='', indent=0):
@@ -234,69 +1012,59 @@ if __name__ == '__main__':
         def log(*args, **kwargs):
             pass
 
-    seq_to_data = {}  # a mapping of seq numbers to data in each segment
-    with open(args.path, 'rb') as f:
-        fh = FileHeader(f.read(FileHeader.LENGTH))
+    if args.output:
+        output = open(args.output, 'wb')
+    else:
+        output = sys.stdout.buffer
+
+    # stream the body of the first response sent to us straight to the output
+    # as the reassembler hands on each contiguous piece
+    extractor = HttpResponseExtractor(output)
+    response_key = None
+
+    def on_data(key, data):
+        global response_key
+        if response_key is None and key[2] == requesting_host:
+            response_key = key
+        if key == response_key:
+            extractor.feed(data)
+
+    def on_close(key):
+        if key == response_key:
+            extractor.close()
+
+    verifier = Verifier(args.verify)
+    reassembler = Reassembler(on_data, on_close)
+    with PcapReader(args.path) as reader:
+        fh = reader.file_header
         log(fh)
         fh.verify()
+        frame_filter = compile_filter(args.filter, reader.link_type) \
+            if args.filter else None
 
-        while True:
-            log()
+        for packet in reader.packets(frame_filter=frame_filter):
+            if args.verbose:
+                log()
+                log(packet)
+                if packet.ethernet_header is not None:
+                    log(packet.ethernet_header, indent=1)
+                log(packet.ip_header, indent=2)
+                log(packet.tcp_header, indent=3)
+            if verifier.check(packet):
+                reassembler.add(packet)
+        reassembler.close()
+    if args.output:
+        output.close()
 
-            # consume and check individual pcap header
-            bs = f.read(PcapPacketHeader.LENGTH)
-            if not bs:
-                break
-            pcap_header = PcapPacketHeader(bs)
-            log(pcap_header)
-            pcap_header.verify()
-
-            # read the entire ethernet frame into memory, and parse and verify
-            # its header
-            ethernet_frame = f.read(pcap_header.payload_length)
-            ethernet_header = EthernetFrameHeader(
-                    ethernet_frame[:EthernetFrameHeader.LENGTH])
-            log(ethernet_header, indent=1)
-            ethernet_header.verify()
-
-            # the payload of the ethernet frame is an IP datagram
-            ip_datagram = ethernet_frame[EthernetFrameHeader.LENGTH:]
-
-            # parse and verify the IP datagram header
-            ip_header_length = 4 * IpDatagramHeader.get_ihl(ip_datagram[0])
-            ip_header = IpDatagramHeader(ip_datagram[:ip_header_length])
-            log(ip_header, indent=2)
-            ip_header.verify()
-            IpDatagramHeader.verify_checksum(ip_datagram[:ip_header_length])
-
-            # the payload of the IP datagram is a TCP segment
-            tcp_segment = ip_datagram[ip_header_length:]
-
-            # parse and verify TCP header
-            tcp_header_length = 4 * TcpHeader.get_data_offset(
-                    tcp_segment[:TcpHeader.DEFAULT_LENGTH])
-            tcp_header = TcpHeader(tcp_segment[:tcp_header_length])
-            log(tcp_header, indent=3)
-            tcp_header.verify()
-
-            # the payload of the TCP segment is a fragment of our HTTP message
-            tcp_payload = tcp_segment[tcp_header_length:]
-
-            # consider only the response segments, and collect them by
-            # sequence number
-            if tuple(ip_header.destination_ip) == requesting_host and not \
-                    tcp_header.flags['SYN']:
-                seq_to_data[tcp_header.seq_number] = tcp_payload
-
-    http_message = b''.join(d for _, d in sorted(seq_to_data.items()))
-    http_header, http_payload = http_message.split(b'\r\n\r\n', 1)
-    log(b'\n'.join(http_header.split(b'\r\n')).decode('utf-8'))
+    log(verifier)
+    log('reassembled with {} retransmitted and {} overlapping segments'.format(
+        reassembler.retransmits, reassembler.overlaps))
+    if extractor.status_line is None:
+        sys.exit('no HTTP response to {} found'.format(
+            '.'.join(str(b) for b in requesting_host)))
+    log(b'\n'.join(extractor.header_bytes.split(b'\r\n')).decode('utf-8'))
     log()
-
-    if args.output:
-        with open(args.output, 'wb') as output:
-            output.write(http_payload)
-        log('OK! wrote {}B to {}'.format(len(http_payload), args.output))
-    else:
-        sys.stdout.write(http_payload)
-        log('OK! wrote {}B to stdout'.format(len(http_payload)))
+    log('OK! wrote {}B to {}'.format(extractor.body_length,
+                                     args.output or 'stdout'))
+    if not extractor.complete:
+        log('warning: the response body was incomplete')
@@ -0,0 +1,178 @@
+"""
+Reassemble the byte streams of many concurrent TCP connections.
+
+Each direction of each connection is tracked separately, keyed by the
+4-tuple (source ip, source port, destination ip, destination port). Sequence
+numbers are made relative to the initial sequence number of the SYN, and data
+is handed on as soon as it is contiguous: only segments that arrive ahead of
+a gap are held back, so memory is bounded by the out-of-order window rather
+than by the size of the transfer.
+"""
+
+import heapq
+
+
+SEQ_MODULUS = 1 << 32
+
+
+def flow_key(packet):
+    """The (source ip, source port, destination ip, destination port) key"""
+    ip_header, tcp_header = packet.ip_header, packet.tcp_header
+    return (ip_header.source_ip, tcp_header.source_port,
+            ip_header.destination_ip, tcp_header.destination_port)
+
+
+class Stream(object):
+    """
+    One direction of a TCP connection.
+
+    `delivered` counts the bytes of the stream handed on so far, and is the
+    position at which the next in-order byte belongs. Segments beyond it wait
+    in `pending`, a heap of (position, data).
+    """
+    __slots__ = ('isn', 'next_seq', 'delivered', 'pending', 'pending_bytes',
+                 'fin_position', 'retransmits', 'overlaps')
+
+    def __init__(self, isn, next_seq):
+        self.isn = isn
+        self.next_seq = next_seq
+        self.delivered = 0
+        self.pending = []
+        self.pending_bytes = 0
+        self.fin_position = None
+        self.retransmits = 0
+        self.overlaps = 0
+
+    def position(self, seq):
+        """
+        The position within the stream of sequence number `seq`, allowing for
+        sequence numbers wrapping around 2**32
+        """
+        delta = (seq - self.next_seq) % SEQ_MODULUS
+        if delta >= SEQ_MODULUS // 2:
+            delta -= SEQ_MODULUS
+        return self.delivered + delta
+
+    def advance(self, n):
+        self.delivered += n
+        self.next_seq = (self.next_seq + n) % SEQ_MODULUS
+
+    @property
+    def finished(self):
+        return self.fin_position is not None and \
+            self.delivered >= self.fin_position
+
+
+class Reassembler(object):
+    """
+    Feed TCP segments in capture order with `add`; contiguous data is passed
+    to `on_data(key, data)` as soon as any gap before it has been filled.
+
+    Data passed to `on_data` may be a view onto the capture, so it must be
+    consumed or copied before the callback returns. Once both a FIN has been
+    seen and all data up to it delivered, or on RST, `on_close(key)` is called
+    and the stream forgotten.
+    """
+    def __init__(self, on_data, on_close=None):
+        self.on_data = on_data
+        self.on_close = on_close
+        self.streams = {}
+        self.retransmits = 0
+        self.overlaps = 0
+
+    def add(self, packet):
+        """Add the TCP segment carried by a `Packet`"""
+        tcp_header = packet.tcp_header
+        self.add_segment(flow_key(packet), tcp_header.seq_number,
+                         packet.payload, syn=tcp_header.syn,
+                         fin=tcp_header.fin, rst=tcp_header.rst)
+
+    def add_segment(self, key, seq, payload, syn=False, fin=False,
+                    rst=False):
+        """Add a segment of the stream identified by `key`"""
+        stream = self.streams.get(key)
+        if syn:
+            if stream is not None and stream.isn == seq:
+                self._count_retransmit(stream)
+            else:
+                # a new connection; the SYN itself occupies the initial
+                # sequence number
+                self.streams[key] = Stream(seq, (seq + 1) % SEQ_MODULUS)
+            return
+        if stream is None:
+            if not payload:
+                return  # e.g. a stray ACK or FIN of a stream already closed
+            # we missed the handshake, so start from wherever we join
+            stream = self.streams[key] = Stream(None, seq)
+        if rst:
+            self._close(key)
+            return
+
+        start = stream.position(seq)
+        if fin:
+            stream.fin_position = start + len(payload)
+        if payload:
+            self._add_data(key, stream, start, payload)
+        if stream.finished:
+            self._close(key)
+
+    def _add_data(self, key, stream, start, payload):
+        end = start + len(payload)
+        if end <= stream.delivered:
+            self._count_retransmit(stream)
+            return
+        if start > stream.delivered:
+            # ahead of a gap, so hold on to a copy until the gap is filled
+            heapq.heappush(stream.pending, (start, bytes(payload)))
+            stream.pending_bytes += len(payload)
+            return
+        if start < stream.delivered:
+            self._count_overlap(stream)
+            payload = payload[stream.delivered - start:]
+        self._deliver(key, stream, payload)
+        self._drain(key, stream)
+
+    def _drain(self, key, stream):
+        """Deliver any pending segments that are now contiguous"""
+        pending = stream.pending
+        while pending and pending[0][0] <= stream.delivered:
+            start, data = heapq.heappop(pending)
+            stream.pending_bytes -= len(data)
+            end = start + len(data)
+            if end <= stream.delivered:
+                self._count_retransmit(stream)
+                continue
+            if start < stream.delivered:
+                self._count_overlap(stream)
+                data = data[stream.delivered - start:]
+            self._deliver(key, stream, data)
+
+    def _deliver(self, key, stream, data):
+        stream.advance(len(data))
+        self.on_data(key, data)
+
+    def _count_retransmit(self, stream):
+        stream.retransmits += 1
+        self.retransmits += 1
+
+    def _count_overlap(self, stream):
+        stream.overlaps += 1
+        self.overlaps += 1
+
+    def _close(self, key):
+        del self.streams[key]
+        if self.on_close is not None:
+            self.on_close(key)
+
+    @property
+    def pending_bytes(self):
+        """Bytes held back across all streams, waiting for a gap to fill"""
+        return sum(s.pending_bytes for s in self.streams.values())
+
+    def close(self):
+        """
+        Close every stream still open, e.g. at the end of a capture. Any data
+        still waiting on a gap that was never filled is discarded.
+        """
+        for key in list(self.streams):
+            self._close(key)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Benchmark the caching forwarder under load, against a local fake upstream.
+
+Usage: ./dns_bench.py [--clients 100] [--duration 5] [--names 1000]
+                      [--latency 0.02] [--ttl 300]
+
+The fake upstream answers every query with an A record after a fixed delay,
+standing in for the round trip to a real recursive resolver, and counts the
+queries it is sent. A load generator then runs many concurrent clients, each
+a stub resolver with its own UDP socket and one query in flight at a time,
+asking for names drawn at random from a fixed pool. It does so first
+straight against the upstream, as a baseline, and then through a forwarder,
+reporting queries/sec, median and 99th percentile latency and how many
+queries each left unanswered or sent upstream.
+
+The upstream and forwarder run in a child process of their own, so that they
+do not share an event loop with the load generator.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import random
+import sys
+import time
+
+from dns_cache import DnsCache
+from dns_forwarder import Forwarder, serve, stop
+from dns_resolver import Resolver
+from simple_dns import Header, Message, ResourceRecord
+
+
+LOCALHOST = '127.0.0.1'
+A = 1
+
+
+class FakeUpstream(asyncio.DatagramProtocol):
+    """
+    Answer every query for an A record with 10.0.0.1, each after `latency`
+    seconds and with the given `ttl`, counting the queries received
+    """
+    def __init__(self, latency, ttl):
+        self.latency = latency
+        self.ttl = ttl
+        self.transport = None
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        query = Message.decode(data)
+        question = query.questions[0]
+        answers = []
+        if question.qtype == 'A':
+            answers.append(ResourceRecord(question.qname, A, 1, self.ttl, 4,
+                                          '10.0.0.1'))
+        response = Message(Header(query.header.xid, 0x8180, 0, 0, 0, 0),
+                           query.questions, answers)
+        asyncio.get_running_loop().call_later(
+            self.latency, self.transport.sendto, response.encode(), addr)
+
+
+async def _serve_until_stopped(connection, latency, ttl, forward, cache_size):
+    loop = asyncio.get_running_loop()
+    _, upstream = await loop.create_datagram_endpoint(
+        lambda: FakeUpstream(latency, ttl), local_addr=(LOCALHOST, 0))
+    upstream_address = upstream.transport.get_extra_info('sockname')
+    if not forward:
+        connection.send(upstream_address)
+        await loop.run_in_executor(None, connection.recv)
+        connection.send((upstream.queries, None))
+        return
+
+    cache = DnsCache(cache_size)
+    async with Resolver(upstream_address, concurrency=1000, sockets=4,
+                        cache=cache) as resolver:
+        transport, server = await serve(Forwarder(resolver), (LOCALHOST, 0))
+        connection.send(transport.get_extra_info('sockname'))
+        await loop.run_in_executor(None, connection.recv)
+        await stop(transport, server)
+        await cache.drain()
+    connection.send((upstream.queries, str(cache)))
+
+
+def _run_servers(connection, *args):
+    asyncio.run(_serve_until_stopped(connection, *args))
+    connection.close()
+
+
+class _StubProtocol(asyncio.DatagramProtocol):
+    """A client socket with at most one query awaiting its response"""
+    def __init__(self):
+        self.transport = None
+        self.xid = None
+        self.future = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.future is not None and not self.future.done() and \
+                int.from_bytes(data[:2], 'big') == self.xid:
+            self.future.set_result(data)
+
+    def error_received(self, exc):
+        pass  # left to time out
+
+    async def ask(self, query, timeout):
+        self.xid = query.header.xid
+        self.future = asyncio.get_running_loop().create_future()
+        self.transport.sendto(query.encode())
+        return Message.decode(await asyncio.wait_for(self.future, timeout))
+
+
+async def _client(address, names, deadline, timeout, latencies, rng):
+    """Query `names` at random until `deadline`, returning how many failed"""
+    loop = asyncio.get_running_loop()
+    transport, stub = await loop.create_datagram_endpoint(
+        _StubProtocol, remote_addr=address)
+    failed = 0
+    try:
+        while time.perf_counter() < deadline:
+            query = Message.query(rng.choice(names), 'A')
+            start = time.perf_counter()
+            try:
+                response = await stub.ask(query, timeout)
+            except asyncio.TimeoutError:
+                failed += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+            if response.header.flags & 0xf:
+                failed += 1
+    finally:
+        transport.close()
+    return failed
+
+
+async def generate_load(address, names, clients, duration, timeout=1.0,
+                        seed=0):
+    """
+    Run `clients` concurrent clients against the server at `address` for
+    `duration` seconds, returning the latencies of the queries answered, how
+    many were not (or were answered with an error), and the seconds taken
+    """
+    rng = random.Random(seed)
+    latencies = []
+    start = time.perf_counter()
+    failed = await asyncio.gather(
+        *(_client(address, names, start + duration, timeout, latencies, rng)
+          for _ in range(clients)))
+    return latencies, sum(failed), time.perf_counter() - start
+
+
+def percentile(values, p):
+    """The `p`th percentile of the sorted `values`, by nearest rank"""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def measure(names, clients, duration, latency, ttl, forward,
+            cache_size=10000, seed=0):
+    """
+    Start a fake upstream, and a forwarder to it if `forward`, in a child
+    process, and load whichever is in front, returning (latencies, failed,
+    seconds, queries received upstream, cache statistics or None)
+    """
+    receiver, sender = multiprocessing.Pipe()
+    child = multiprocessing.Process(
+        target=_run_servers,
+        args=(sender, latency, ttl, forward, cache_size))
+    child.start()
+    try:
+        address = receiver.recv()
+        latencies, failed, elapsed = asyncio.run(generate_load(
+            address, names, clients, duration, seed=seed))
+        receiver.send('stop')
+        upstream_queries, cache = receiver.recv()
+    finally:
+        child.join()
+    latencies.sort()
+    return latencies, failed, elapsed, upstream_queries, cache
+
+
+def run(names, clients, duration, latency, ttl, cache_size=10000, seed=0):
+    """Load the upstream directly and then through a forwarder, reporting"""
+    print('{:<10}{:>10}{:>12}{:>10}{:>10}{:>8}{:>10}'.format(
+        'target', 'queries', 'queries/sec', 'p50 ms', 'p99 ms', 'failed',
+        'upstream'))
+    for name, forward in (('upstream', False), ('forwarder', True)):
+        latencies, failed, elapsed, upstream_queries, cache = measure(
+            names, clients, duration, latency, ttl, forward, cache_size,
+            seed)
+        print('{:<10}{:>10}{:>12,.0f}{:>10.2f}{:>10.2f}{:>8}{:>10}'.format(
+            name, len(latencies) + failed, len(latencies) / elapsed,
+            percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+            failed, upstream_queries))
+        if cache is not None:
+            print('cache: {}'.format(cache), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark the caching DNS forwarder under load')
+    parser.add_argument('--clients', type=int, default=100,
+                        help='number of concurrent clients, default 100')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds to generate load for, default 5')
+    parser.add_argument('--names', type=int, default=1000,
+                        help='number of distinct names to query, default '
+                             '1000')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the fake upstream takes to answer, '
+                             'default 0.02')
+    parser.add_argument('--ttl', type=int, default=300,
+                        help='TTL of the upstream answers, default 300')
+    parser.add_argument('--cache', type=int, default=10000, metavar='ENTRIES',
+                        help='forwarder cache size, default 10000')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the names each client queries')
+    args = parser.parse_args()
+
+    names = ['host{}.example.com'.format(i) for i in range(args.names)]
+    run(names, args.clients, args.duration, args.latency, args.ttl,
+        args.cache, args.seed)
@@ -0,0 +1,213 @@
+"""
+A TTL-aware cache of DNS responses, bounded in size with LRU eviction.
+
+Responses are cached by (qname, qtype) for as long as the shortest TTL among
+their records. Negative responses (NXDOMAIN, or no records of the type asked
+for) are cached too, for the TTL given by the SOA record in their authority
+section, per RFC 2308. Responses with a TTL of 0 are never cached, as their
+owners asked for them not to be reused.
+
+An entry that has expired may still be served, stale, for a short grace
+period after, while a refresh is fetched in the background, per RFC 8767: a
+lookup never waits on the network for a name it has seen recently. Nor do
+concurrent misses for the same name each go to the network: they share a
+single fetch.
+"""
+
+import asyncio
+from collections import OrderedDict
+import time
+
+from simple_dns import OPT, Message, type_number
+
+
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+SOA = 6
+
+# the TTL given to records served stale, per RFC 8767 § 4
+STALE_ANSWER_TTL = 30
+
+# how long past expiry entries are served stale by default, and at most:
+# RFC 8767 § 5 suggests a limit of 1 to 3 days
+STALE_TTL = 300
+MAX_STALE_TTL = 3 * 86400
+
+
+class _Entry(object):
+    __slots__ = ('response', 'stored', 'expires', 'negative')
+
+    def __init__(self, response, stored, expires, negative):
+        self.response = response
+        self.stored = stored
+        self.expires = expires
+        self.negative = negative
+
+
+def _with_ttl(records, ttl):
+    # the TTL of an OPT pseudo-record holds flags, not a TTL
+    return [r if r.type == OPT else r._replace(ttl=ttl(r)) for r in records]
+
+
+class DnsCache(object):
+    """
+    Cache decoded response `Message`s by (qname, qtype), holding at most
+    `max_entries` and evicting the least recently used beyond that.
+
+    TTLs are capped at `max_ttl` (or `max_negative_ttl` for negative
+    responses), and expired entries are served stale for up to `stale_ttl`
+    seconds, which may be no more than `MAX_STALE_TTL`.
+
+    The `hits`, `stale_hits`, `misses` and `evictions` counters record how
+    lookups went; `negative_hits` counts the hits (stale or not) that were
+    for negative responses, and `coalesced` the misses that waited on a
+    fetch already in flight rather than making their own.
+    """
+    def __init__(self, max_entries=10000, max_ttl=86400, max_negative_ttl=900,
+                 stale_ttl=STALE_TTL, clock=time.monotonic):
+        if not 0 <= stale_ttl <= MAX_STALE_TTL:
+            raise ValueError('stale_ttl must be from 0 to {}, not {}'.format(
+                MAX_STALE_TTL, stale_ttl))
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.stale_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+        self._fetching = {}  # key to the task fetching it
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(name, qtype):
+        # by number, as a type may be given by its mnemonic or as TYPEn
+        return name.lower().rstrip('.'), type_number(qtype)
+
+    def _ttl(self, response):
+        """
+        How long `response` may be cached for, whether it is negative, or
+        None if it may not be cached at all
+        """
+        rcode = response.header.flags & 0xf
+        if rcode == RCODE_NOERROR and response.answers:
+            return min(min(r.ttl for r in response.answers), self.max_ttl), \
+                False
+        if rcode in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            for r in response.authority:
+                if r.type == SOA:
+                    # RFC 2308 § 5: the lesser of the SOA's TTL and minimum
+                    return min(r.ttl, r.rdata.minimum,
+                               self.max_negative_ttl), True
+        return None  # an error, or negative without an SOA to say for how long
+
+    def put(self, response):
+        """Cache `response`, if it may be, under its first question"""
+        if not response.questions:
+            return
+        question = response.questions[0]
+        key = self.key(question.qname, question.qtype)
+        ttl = self._ttl(response)
+        if ttl is None:
+            return
+        ttl, negative = ttl
+        if ttl <= 0:
+            # not to be reused, even stale, and neither is what it replaces
+            self.entries.pop(key, None)
+            return
+        now = self.clock()
+        self.entries[key] = _Entry(response, now, now + ttl, negative)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, name, qtype):
+        """
+        Look up a cached response, returning it along with whether it is
+        stale, or (None, False) on a miss. The TTLs of the records returned
+        count down from when the response was cached.
+        """
+        key = self.key(name, qtype)
+        entry = self.entries.get(key)
+        now = self.clock()
+        if entry is None or now >= entry.expires + self.stale_ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None, False
+        self.entries.move_to_end(key)
+        stale = now >= entry.expires
+        if stale:
+            self.stale_hits += 1
+
+            def ttl(r):
+                return STALE_ANSWER_TTL
+        else:
+            self.hits += 1
+            age = int(now - entry.stored)
+
+            def ttl(r):
+                return max(0, r.ttl - age)
+        if entry.negative:
+            self.negative_hits += 1
+        response = entry.response
+        return Message(response.header, response.questions,
+                       _with_ttl(response.answers, ttl),
+                       _with_ttl(response.authority, ttl),
+                       _with_ttl(response.additional, ttl)), stale
+
+    async def resolve(self, name, qtype, fetch):
+        """
+        Answer from the cache if possible, otherwise with `await fetch(name,
+        qtype)`, caching what that returns. A stale entry is answered with at
+        once, while a single refresh of it is fetched in the background.
+        """
+        response, stale = self.get(name, qtype)
+        if response is not None and not stale:
+            return response
+        key = self.key(name, qtype)
+        task = self._fetching.get(key)
+        if task is None:
+            task = self._fetching[key] = asyncio.ensure_future(
+                self._fetch(key, name, qtype, fetch))
+            # a failed refresh just leaves the stale entry to be served
+            task.add_done_callback(_retrieve_exception)
+        elif response is None:
+            self.coalesced += 1
+        if response is None:
+            # shielded, so that one waiter being cancelled does not cancel
+            # the fetch for the others
+            return await asyncio.shield(task)
+        return response
+
+    async def drain(self):
+        """Wait for every fetch in flight, including refreshes, to finish"""
+        while self._fetching:
+            await asyncio.wait(list(self._fetching.values()))
+
+    async def _fetch(self, key, name, qtype, fetch):
+        try:
+            response = await fetch(name, qtype)
+            self.put(response)
+            return response
+        finally:
+            del self._fetching[key]
+
+    def __str__(self):
+        return '{} entries, {} hits ({} stale, {} negative), {} misses ' \
+            '({} coalesced), {} evictions'.format(
+                len(self), self.hits + self.stale_hits, self.stale_hits,
+                self.negative_hits, self.misses, self.coalesced,
+                self.evictions)
+
+
+def _retrieve_exception(task):
+    if not task.cancelled():
+        task.exception()
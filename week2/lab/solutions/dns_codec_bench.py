@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Benchmark `Message.decode` and `Message.encode` over a corpus of recorded
+DNS responses.
+
+Usage: ./dns_codec_bench.py [corpus ...] [--save corpus.bin]
+                            [--responses 1000] [--answers 20]
+
+A corpus is a file of raw responses, each prefixed by its length in two
+bytes just as over TCP, so that one can be recorded from any stream of DNS
+over TCP. Without one, a synthetic corpus is generated of the sort that is
+expensive to decode: responses with a CNAME, many answers and several NS
+records with glue, every name compressed with pointers to names earlier in
+the message.
+
+Responses are decoded, and then the decoded messages encoded again, which
+also reports how much larger (or smaller) they come out for being compressed
+differently from the originals. Last, the first address is picked out of
+each successful response with a lazy `MessageView`, as a filter would.
+"""
+
+import argparse
+import random
+import struct
+import sys
+import time
+
+from dns_view import MessageView
+from simple_dns import Message, encode_name
+
+
+A, NS, CNAME = 1, 2, 5
+
+
+def _record(name, rtype, ttl, data):
+    return name + struct.pack('!HHIH', rtype, 1, ttl, len(data)) + data
+
+
+def _pointer(offset):
+    return struct.pack('!H', 0xc000 | offset)
+
+
+def synthetic_response(rng, zone, answers=20, nameservers=4):
+    """
+    The raw response to a query for www.`zone`, which is a CNAME for a name
+    with `answers` A records, with `nameservers` NS records for the zone in
+    the authority section and their addresses in the additional section
+    """
+    def address():
+        return bytes(rng.randrange(256) for _ in range(4))
+
+    question = encode_name('www.' + zone)
+    zone_at = 12 + 4  # skipping the length and label of 'www'
+    message = bytearray(struct.pack(
+        '!HHHHHH', rng.randrange(0x10000), 0x8180, 1, answers + 1,
+        nameservers, nameservers))
+    message += question + struct.pack('!HH', A, 1)
+
+    # the CNAME target, 'cdn.' + zone, is written as a label and pointer
+    target_at = len(message) + 12
+    message += _record(_pointer(12), CNAME, 300,
+                       b'\x03cdn' + _pointer(zone_at))
+    for _ in range(answers):
+        message += _record(_pointer(target_at), A, 60, address())
+
+    nameserver_at = []
+    for n in range(nameservers):
+        label = 'ns{}'.format(n + 1).encode('ascii')
+        nameserver_at.append(len(message) + 12)
+        message += _record(_pointer(zone_at), NS, 86400,
+                           bytes((len(label),)) + label + _pointer(zone_at))
+    for offset in nameserver_at:
+        message += _record(_pointer(offset), A, 86400, address())
+    return bytes(message)
+
+
+def synthetic_corpus(n, answers=20, seed=0):
+    rng = random.Random(seed)
+    return [synthetic_response(rng, 'example{}.com'.format(i % 100), answers)
+            for i in range(n)]
+
+
+def read_corpus(path):
+    """The responses in a corpus file, as a list of bytes"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    responses = []
+    i = 0
+    while i + 2 <= len(data):
+        length = int.from_bytes(data[i:i+2], 'big')
+        responses.append(data[i+2:i+2+length])
+        i += 2 + length
+    return responses
+
+
+def write_corpus(path, responses):
+    with open(path, 'wb') as f:
+        for response in responses:
+            f.write(len(response).to_bytes(2, 'big') + response)
+
+
+def _repeat(function, inputs, min_seconds):
+    """Call `function` on each input, over and over, returning the rounds"""
+    rounds = 0
+    start = time.perf_counter()
+    while True:
+        for x in inputs:
+            function(x)
+        rounds += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return rounds, elapsed
+
+
+def first_address(response):
+    """The first address answered in a successful response, if any"""
+    view = MessageView(response)
+    if view.rcode == 0:
+        record = view.first_answer(A)
+        if record is not None:
+            return record.rdata
+    return None
+
+
+def measure(responses, min_seconds=1.0):
+    """
+    Decode every response repeatedly for at least `min_seconds`, then
+    encode every decoded message likewise, then find the first address in
+    every response, returning for each (messages, records, bytes, seconds)
+    """
+    messages = [Message.decode(r) for r in responses]
+    records = sum(len(m.answers) + len(m.authority) + len(m.additional)
+                  for m in messages)
+    results = []
+    for function, inputs, outputs in (
+            (Message.decode, responses, responses),
+            (Message.encode, messages, [m.encode() for m in messages]),
+            (first_address, responses, responses)):
+        rounds, elapsed = _repeat(function, inputs, min_seconds)
+        results.append((rounds * len(inputs), rounds * records,
+                        rounds * sum(map(len, outputs)), elapsed))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark decoding, encoding and lazily viewing a '
+                        'corpus of DNS responses')
+    parser.add_argument('corpus', nargs='*',
+                        help='files of length-prefixed responses, default a '
+                             'synthetic corpus')
+    parser.add_argument('--responses', type=int, default=1000,
+                        help='number of synthetic responses, default 1000')
+    parser.add_argument('--answers', type=int, default=20,
+                        help='A records per synthetic response, default 20')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic responses')
+    parser.add_argument('--save',
+                        help='write the corpus benchmarked to this file')
+    parser.add_argument('--seconds', type=float, default=2.0,
+                        help='minimum seconds to spend on each of decoding, '
+                             'encoding and viewing, default 2')
+    args = parser.parse_args()
+
+    if args.corpus:
+        responses = [r for path in args.corpus for r in read_corpus(path)]
+    else:
+        responses = synthetic_corpus(args.responses, args.answers, args.seed)
+    if args.save:
+        write_corpus(args.save, responses)
+    print('Benchmarking {:,} responses'.format(len(responses)),
+          file=sys.stderr)
+
+    print('{:<8}{:>14}{:>14}{:>10}{:>14}'.format(
+        'mode', 'messages/sec', 'records/sec', 'MB/sec', 'bytes/message'))
+    for mode, (messages, records, size, elapsed) in zip(
+            ('decode', 'encode', 'view'), measure(responses, args.seconds)):
+        print('{:<8}{:>14,.0f}{:>14,.0f}{:>10.1f}{:>14,.0f}'.format(
+            mode, messages / elapsed, records / elapsed,
+            size / elapsed / 1e6, size / messages))
@@ -0,0 +1,229 @@
+"""
+A caching DNS forwarder, to run as a node-local resolver.
+
+Usage: python3 dns_forwarder.py [--listen 127.0.0.1:5353]
+                                [--upstream 8.8.8.8:53] [--cache 10000]
+
+Queries are accepted over both UDP and TCP, answered from a `DnsCache` where
+possible, and otherwise forwarded upstream through a `Resolver`, whose many
+queries in flight share a few UDP sockets. Concurrent queries for the same
+name and type, from however many clients, are coalesced by the cache into a
+single upstream query.
+
+Clients that advertise a UDP payload size with EDNS are answered over UDP
+with responses up to that size (though no more than 1232 bytes), and others
+with up to 512 bytes; longer responses are truncated, for the client to ask
+again over TCP.
+"""
+
+import argparse
+import asyncio
+import struct
+import sys
+
+from dns_cache import DnsCache
+from dns_resolver import Resolver, parse_address
+from simple_dns import (EDNS_UDP_SIZE, FLAG_QR, FLAG_RA, FLAG_RD, FLAG_TC,
+                        GOOGLE_PUBLIC_DNS, MAX_UDP_SIZE, OPCODE_MASK, OPT,
+                        Header, Message, opt_record)
+
+
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NOTIMP = 4
+
+
+def _reply_header(query_header, flags):
+    """The header of a reply to a query, echoing its xid, opcode and RD bit"""
+    return query_header._replace(
+        flags=FLAG_QR | (query_header.flags & (OPCODE_MASK | FLAG_RD)) |
+        flags)
+
+
+class Forwarder(object):
+    """
+    Answer raw DNS queries by way of `resolver`, counting queries answered
+    and those that failed upstream
+    """
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.queries = 0
+        self.failures = 0
+
+    async def answer(self, data, over_udp=False):
+        """
+        The raw response to the raw query `data`, or None if it is not worth
+        answering. Over UDP, a response longer than the client can take is
+        truncated, with the TC bit set.
+        """
+        if len(data) < 12:
+            return None
+        try:
+            query = Message.decode(data)
+        except Exception:
+            header = Header(*struct.unpack_from('!HHHHHH', data))
+            if header.flags & FLAG_QR:
+                return None
+            return self._error(header, [], RCODE_FORMERR)
+        if query.header.flags & FLAG_QR:
+            return None  # a response, not a query
+        # answer EDNS with EDNS, advertising what we will send over UDP
+        client_size = query.udp_size
+        additional = [opt_record(EDNS_UDP_SIZE)] if client_size else []
+        if query.header.flags & OPCODE_MASK or len(query.questions) != 1:
+            return self._error(query.header, query.questions, RCODE_NOTIMP,
+                               additional)
+
+        self.queries += 1
+        question = query.questions[0]
+        try:
+            response = await self.resolver.query(question.qname,
+                                                 question.qtype)
+        except Exception:
+            # whatever went wrong upstream (a timeout, a lost connection, a
+            # response that could not be decoded...), the client is owed an
+            # answer
+            self.failures += 1
+            return self._error(query.header, query.questions, RCODE_SERVFAIL,
+                               additional)
+
+        # the upstream flags (RA, AA, RCODE) but our client's xid, RD bit and
+        # question, as they spelled it, and our own OPT record, not upstream's
+        reply = Message(
+            _reply_header(query.header, response.header.flags &
+                          ~(FLAG_QR | OPCODE_MASK | FLAG_RD | FLAG_TC)),
+            query.questions, response.answers, response.authority,
+            [r for r in response.additional if r.type != OPT] + additional)
+        encoded = reply.encode()
+        max_size = min(client_size, EDNS_UDP_SIZE) if client_size else \
+            MAX_UDP_SIZE
+        if over_udp and len(encoded) > max_size:
+            # the client should retry over TCP for the whole response
+            reply = Message(reply.header._replace(
+                flags=reply.header.flags | FLAG_TC), query.questions,
+                additional=additional)
+            encoded = reply.encode()
+        return encoded
+
+    @staticmethod
+    def _error(query_header, questions, rcode, additional=None):
+        return Message(_reply_header(query_header, FLAG_RA | rcode),
+                       questions, additional=additional).encode()
+
+
+class _UdpServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.transport = None
+        self.replies = set()  # the loop only holds weak references to tasks
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        task = asyncio.ensure_future(self._reply(data, addr))
+        self.replies.add(task)
+        task.add_done_callback(self.replies.discard)
+
+    async def _reply(self, data, addr):
+        response = await self.forwarder.answer(data, over_udp=True)
+        if response is not None and not self.transport.is_closing():
+            self.transport.sendto(response, addr)
+
+
+async def _serve_tcp_client(forwarder, reader, writer):
+    """
+    Answer each query on a TCP connection, each message prefixed by its
+    length in two bytes (RFC 1035 § 4.2.2). Queries may be pipelined, so
+    each is answered as soon as it can be, in any order.
+    """
+    async def reply(data):
+        response = await forwarder.answer(data)
+        if response is not None and not writer.is_closing():
+            writer.write(len(response).to_bytes(2, 'big') + response)
+
+    replies = set()
+    try:
+        while True:
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+            data = await reader.readexactly(length)
+            task = asyncio.ensure_future(reply(data))
+            replies.add(task)
+            task.add_done_callback(replies.discard)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass  # the client is done with us
+    finally:
+        if replies:
+            await asyncio.wait(replies)
+        writer.close()
+
+
+async def serve(forwarder, listen):
+    """
+    Start answering queries for `forwarder` on the `listen` address over UDP
+    and TCP, returning the UDP transport and TCP server
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _UdpServerProtocol(forwarder), local_addr=listen)
+    server = await asyncio.start_server(
+        lambda r, w: _serve_tcp_client(forwarder, r, w), *listen)
+    return transport, server
+
+
+async def stop(transport, server):
+    """
+    Stop accepting queries on the `transport` and `server` returned by
+    `serve`, then wait for those already received over UDP to be answered
+    """
+    transport.close()
+    server.close()
+    replies = transport.get_protocol().replies
+    if replies:
+        await asyncio.wait(replies)
+
+
+async def _main(args):
+    cache = DnsCache(args.cache)
+    async with Resolver(args.upstream, args.concurrency, args.timeout,
+                        args.retries, args.sockets, cache) as resolver:
+        forwarder = Forwarder(resolver)
+        transport, server = await serve(forwarder, args.listen)
+        print('Forwarding queries on {} to {}'.format(
+            transport.get_extra_info('sockname'), args.upstream),
+            file=sys.stderr)
+        try:
+            await server.serve_forever()
+        finally:
+            await stop(transport, server)
+            await cache.drain()
+            print('answered {} queries, {} failed upstream; cache: {}'.format(
+                forwarder.queries, forwarder.failures, cache), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Run a caching DNS forwarder')
+    parser.add_argument('--listen', type=parse_address,
+                        default=('127.0.0.1', 5353),
+                        help='address to serve on, default 127.0.0.1:5353')
+    parser.add_argument('--upstream', type=parse_address,
+                        default=GOOGLE_PUBLIC_DNS,
+                        help='upstream server as host:port, default '
+                             '8.8.8.8:53')
+    parser.add_argument('--cache', type=int, default=10000, metavar='ENTRIES',
+                        help='cache up to this many responses, default 10000')
+    parser.add_argument('-c', '--concurrency', type=int, default=1000,
+                        help='maximum upstream queries in flight')
+    parser.add_argument('--timeout', type=float, default=2.0,
+                        help='seconds to wait for each upstream attempt')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='further upstream attempts after a timeout')
+    parser.add_argument('--sockets', type=int, default=4,
+                        help='number of UDP sockets to the upstream')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
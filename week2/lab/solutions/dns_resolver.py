@@ -0,0 +1,262 @@
+"""
+Resolve many names concurrently with asyncio, over one or a few UDP sockets.
+
+Usage: python3 dns_resolver.py names.txt [-t A] [-c 200] [--server 8.8.8.8:53]
+
+Rather than sending one query and blocking until its response arrives, every
+query in flight shares a socket: each is sent with a transaction id not in use
+by any other query on that socket, and responses are matched back to their
+queries by `header.xid` (and question) as they arrive, in whatever order. Each
+query is given its own timeout and retried a few times before giving up, and
+the number in flight at once is capped.
+
+Queries advertise with EDNS that responses of up to 1232 bytes can be taken
+over UDP, and any response that comes back truncated regardless is fetched
+again over TCP.
+"""
+
+import argparse
+import asyncio
+from itertools import cycle
+import random
+import sys
+import time
+
+from dns_cache import DnsCache
+from simple_dns import (EDNS_UDP_SIZE, FLAG_TC, GOOGLE_PUBLIC_DNS, Message,
+                        type_number)
+
+
+def _name_key(name):
+    """A name as compared with others, whether or not fully qualified"""
+    return name.rstrip('.').lower()
+
+
+class _ResolverProtocol(asyncio.DatagramProtocol):
+    """
+    One UDP socket to the upstream server, with the queries awaiting a
+    response on it keyed by transaction id
+    """
+    def __init__(self):
+        self.transport = None
+        self.server = None
+        self.pending = {}  # xid to (future, question)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server = transport.get_extra_info('peername')[:2]
+
+    def send(self, query):
+        """
+        Send `query`, first giving it an xid that is unused on this socket,
+        and return a future for its response
+        """
+        while query.header.xid in self.pending:
+            query.header = query.header._replace(
+                xid=random.randint(0, 0xffff))
+        future = asyncio.get_running_loop().create_future()
+        self.pending[query.header.xid] = (future, query.questions[0])
+        self.transport.sendto(query.encode())
+        return future
+
+    def forget(self, xid):
+        self.pending.pop(xid, None)
+
+    def datagram_received(self, data, addr):
+        if addr[:2] != self.server or len(data) < 12:
+            return  # not from our server, or not even a header
+        entry = self.pending.get(int.from_bytes(data[:2], 'big'))
+        if entry is None:
+            return  # a late response to a query already given up on
+        future, question = entry
+        try:
+            response = Message.decode(data)
+        except Exception:
+            return  # malformed; the query will time out and be retried
+        if not response.questions or \
+                _name_key(response.questions[0].qname) != \
+                _name_key(question.qname) or \
+                type_number(response.questions[0].qtype) != \
+                type_number(question.qtype):
+            return  # matches the xid of a query but not its question
+        self.forget(response.header.xid)
+        if not future.done():
+            future.set_result(response)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable; we cannot tell which query it was for,
+        # so leave them all to time out
+        pass
+
+    def connection_lost(self, exc):
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(
+                    exc or ConnectionError('resolver socket closed'))
+        self.pending.clear()
+
+
+class Resolver(object):
+    """
+    Resolve names against `server` over a pool of `sockets` UDP sockets, with
+    at most `concurrency` queries in flight at once.
+
+    Each attempt at a query waits `timeout` seconds for its response, and a
+    query is attempted `retries` more times (each time with a fresh xid)
+    before failing with TimeoutError. Use as an async context manager, or
+    call `open` and `close`.
+
+    Given a `DnsCache`, queries are answered from it where possible, and
+    only misses (and refreshes of stale entries) go to the server.
+
+    Queries advertise a UDP payload size of `udp_size` with EDNS, or none at
+    all if it is None, and a truncated response is fetched again over TCP,
+    which `tcp_fallbacks` counts.
+    """
+    def __init__(self, server=GOOGLE_PUBLIC_DNS, concurrency=100, timeout=2.0,
+                 retries=2, sockets=1, cache=None, udp_size=EDNS_UDP_SIZE):
+        self.server = server
+        self.cache = cache
+        self.udp_size = udp_size
+        self.tcp_fallbacks = 0
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.sockets = sockets
+        self._protocols = []
+        self._next_protocol = None
+        self._semaphore = None
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        for _ in range(self.sockets):
+            _, protocol = await loop.create_datagram_endpoint(
+                _ResolverProtocol, remote_addr=self.server)
+            self._protocols.append(protocol)
+        self._next_protocol = cycle(self._protocols)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    def close(self):
+        for protocol in self._protocols:
+            protocol.transport.close()
+        self._protocols = []
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def query(self, name, record_type='A'):
+        """Resolve `name`, returning the response `Message`"""
+        if self.cache is not None:
+            return await self.cache.resolve(name, record_type, self._query)
+        return await self._query(name, record_type)
+
+    async def _query(self, name, record_type):
+        async with self._semaphore:
+            for _ in range(self.retries + 1):
+                protocol = next(self._next_protocol)
+                query = Message.query(name.rstrip('.'), record_type,
+                                      self.udp_size)
+                future = protocol.send(query)
+                try:
+                    response = await asyncio.wait_for(future, self.timeout)
+                except asyncio.TimeoutError:
+                    continue
+                finally:
+                    protocol.forget(query.header.xid)
+                if response.header.flags & FLAG_TC:
+                    self.tcp_fallbacks += 1
+                    return await asyncio.wait_for(self._query_tcp(query),
+                                                  self.timeout)
+                return response
+        raise TimeoutError('no response for {} {} after {} attempts'.format(
+            name, record_type, self.retries + 1))
+
+    async def _query_tcp(self, query):
+        """Send `query` over a TCP connection of its own, per RFC 7766"""
+        reader, writer = await asyncio.open_connection(*self.server)
+        try:
+            data = query.encode()
+            writer.write(len(data).to_bytes(2, 'big') + data)
+            length = int.from_bytes(await reader.readexactly(2), 'big')
+            return Message.decode(await reader.readexactly(length))
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('{} closed the connection mid-response'
+                                  .format(self.server))
+        finally:
+            writer.close()
+
+    async def query_many(self, names, record_type='A'):
+        """
+        Resolve each of `names`, returning a list of their responses in the
+        same order, with the exception raised in place of any that failed
+        """
+        return await asyncio.gather(
+            *(self.query(name, record_type) for name in names),
+            return_exceptions=True)
+
+
+def parse_address(s):
+    host, _, port = s.rpartition(':')
+    return host, int(port)
+
+
+async def _main(args, names):
+    cache = DnsCache(args.cache) if args.cache else None
+    async with Resolver(args.server, args.concurrency, args.timeout,
+                        args.retries, args.sockets, cache,
+                        args.udp_size or None) as resolver:
+        start = time.perf_counter()
+        responses = await resolver.query_many(names, args.type)
+        elapsed = time.perf_counter() - start
+    failed = 0
+    for name, response in zip(names, responses):
+        if isinstance(response, Exception):
+            failed += 1
+            print('{}\t{}'.format(name, response))
+        else:
+            print('{}\t{}'.format(name, ' '.join(
+                str(r.rdata) for r in response.answers) or '<no answer>'))
+    print('resolved {} of {} names in {:.2f}s, {:.0f} queries/sec'.format(
+        len(names) - failed, len(names), elapsed, len(names) / elapsed),
+        file=sys.stderr)
+    if resolver.tcp_fallbacks:
+        print('{} truncated responses fetched again over TCP'.format(
+            resolver.tcp_fallbacks), file=sys.stderr)
+    if cache is not None:
+        print('cache: {}'.format(cache), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Resolve a batch of names concurrently')
+    parser.add_argument('names', help='file of names, one per line, or - '
+                                      'for stdin')
+    parser.add_argument('-t', '--type', default='A',
+                        help='record type to query, default A')
+    parser.add_argument('--server', type=parse_address,
+                        default=GOOGLE_PUBLIC_DNS,
+                        help='upstream server as host:port, default '
+                             '8.8.8.8:53')
+    parser.add_argument('-c', '--concurrency', type=int, default=100,
+                        help='maximum queries in flight, default 100')
+    parser.add_argument('--timeout', type=float, default=2.0,
+                        help='seconds to wait for each attempt, default 2')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='further attempts after a timeout, default 2')
+    parser.add_argument('--sockets', type=int, default=1,
+                        help='number of UDP sockets to spread queries over')
+    parser.add_argument('--cache', type=int, default=0, metavar='ENTRIES',
+                        help='cache up to this many responses, default none')
+    parser.add_argument('--udp-size', type=int, default=EDNS_UDP_SIZE,
+                        help='UDP payload size to advertise with EDNS, or 0 '
+                             'for none, default 1232')
+    args = parser.parse_args()
+
+    source = sys.stdin if args.names == '-' else open(args.names)
+    with source:
+        names = [line.strip() for line in source if line.strip()]
+    asyncio.run(_main(args, names))
@@ -0,0 +1,79 @@
+"""
+Tests of `Resolver` against a stand-in upstream server on localhost.
+
+Usage: python3 -m unittest dns_resolver_test
+"""
+
+import asyncio
+import unittest
+
+from dns_cache import DnsCache
+from dns_resolver import Resolver
+from simple_dns import (FLAG_QR, FLAG_RA, FLAG_RD, Message, ResourceRecord,
+                        type_number)
+
+
+LOCALHOST = '127.0.0.1'
+ADDRESS = '192.0.2.1'
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    Answer every A query with `ADDRESS`, echoing the question as decoded,
+    as a real server would
+    """
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = Message.decode(data)
+        question = query.questions[0]
+        answers = []
+        if type_number(question.qtype) == 1:
+            answers.append(ResourceRecord(question.qname, 1, 1, 60, 4,
+                                          ADDRESS))
+        response = Message(query.header._replace(
+            flags=FLAG_QR | FLAG_RD | FLAG_RA), query.questions, answers)
+        self.transport.sendto(response.encode(), addr)
+
+
+class ResolverTest(unittest.TestCase):
+    def resolve(self, name, record_type='A', cache=None):
+        """Resolve `name` through a stand-in upstream, or time out"""
+        async def resolve():
+            loop = asyncio.get_running_loop()
+            transport, _ = await loop.create_datagram_endpoint(
+                _UpstreamProtocol, local_addr=(LOCALHOST, 0))
+            server = transport.get_extra_info('sockname')
+            try:
+                async with Resolver(server, timeout=1.0, retries=0,
+                                    cache=cache) as resolver:
+                    return await resolver.query(name, record_type)
+            finally:
+                transport.close()
+        return asyncio.run(resolve())
+
+    def test_query(self):
+        response = self.resolve('example.com')
+        self.assertEqual([r.rdata for r in response.answers], [ADDRESS])
+
+    def test_fully_qualified_name(self):
+        response = self.resolve('Example.COM.')
+        self.assertEqual(response.questions[0].qname, 'Example.COM')
+        self.assertEqual([r.rdata for r in response.answers], [ADDRESS])
+
+    def test_type_as_number(self):
+        response = self.resolve('example.com', 'TYPE1')
+        self.assertEqual(response.questions[0].qtype, 'A')
+        self.assertEqual([r.rdata for r in response.answers], [ADDRESS])
+
+    def test_cached_by_type_number(self):
+        cache = DnsCache()
+        self.resolve('example.com', 'A', cache)
+        response = self.resolve('example.com', 'TYPE1', cache)
+        self.assertEqual([r.rdata for r in response.answers], [ADDRESS])
+        self.assertEqual((len(cache), cache.hits, cache.misses), (1, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+"""
+A lazy view of an encoded DNS message, for when only a little of it is needed.
+
+`Message.decode` parses every question and record up front, formatting the
+data of each record as it goes, which is wasted effort when all that is
+wanted is the RCODE, or the first address among the answers. A `MessageView`
+parses just the header when made, and walks each section only once it is
+asked for, skipping over the names and data of the sections before it
+without decoding them. The records of a section are `RecordView`s, whose
+fixed fields are read as the section is walked but whose name and data are
+decoded only when accessed, with raw accessors alongside for filtering
+without any formatting at all.
+"""
+
+from simple_dns import (HEADER, QUESTION, RECORD, Header, Message, Question,
+                        ResourceRecord, parse_name, parse_record_data,
+                        type_name)
+
+
+A = 1
+
+QUESTIONS, ANSWERS, AUTHORITY, ADDITIONAL = range(4)
+
+
+def skip_name(bs, i):
+    """The offset just past the name at offset `i`, without decoding it"""
+    while True:
+        b = bs[i]
+        if not b:
+            return i + 1
+        if b >> 6 == 0b11:
+            return i + 2  # a pointer always ends a name
+        if b > 63:
+            raise ValueError('bad label length {} at offset {}'.format(b, i))
+        i += b + 1
+
+
+class RecordView(object):
+    """
+    A resource record within a `MessageView`, with its type, class, TTL and
+    data length read but its name and data left to be decoded on access
+    """
+    __slots__ = ('message', 'offset', 'type', 'dns_class', 'ttl', 'rdlength',
+                 'rdata_offset')
+
+    def __init__(self, message, offset, rtype, dns_class, ttl, rdlength,
+                 rdata_offset):
+        self.message = message
+        self.offset = offset
+        self.type = rtype
+        self.dns_class = dns_class
+        self.ttl = ttl
+        self.rdlength = rdlength
+        self.rdata_offset = rdata_offset
+
+    @property
+    def name(self):
+        return parse_name(self.message.data, self.offset,
+                          self.message.names)[0]
+
+    @property
+    def rdata(self):
+        """The data, formatted as by `parse_record_data`"""
+        return parse_record_data(self.message.data, self.rdata_offset,
+                                 self.type, self.rdlength, self.message.names)
+
+    @property
+    def raw_rdata(self):
+        """The data as it was encoded, with any names left compressed"""
+        return bytes(self.message.data[
+            self.rdata_offset:self.rdata_offset + self.rdlength])
+
+    @property
+    def address(self):
+        """The address of an A record, as an int"""
+        if self.type != A or self.rdlength != 4:
+            raise ValueError('not an A record')
+        return int.from_bytes(self.raw_rdata, 'big')
+
+    def to_record(self):
+        return ResourceRecord(self.name, self.type, self.dns_class, self.ttl,
+                              self.rdlength, self.rdata)
+
+    def __repr__(self):
+        return repr(self.to_record())
+
+
+class MessageView(object):
+    """
+    An encoded message `data` (bytes, or any bytes-like object), with its
+    header parsed but its sections parsed only as they are asked for
+    """
+    def __init__(self, data):
+        self.data = data
+        self.header = Header(*HEADER.unpack_from(data))
+        self.names = {}  # offset to name, as for `parse_name`
+        self._sections = {}
+        # the offset each section starts at, as far as they have been walked
+        self._starts = [12]
+
+    @property
+    def rcode(self):
+        return self.header.flags & 0xf
+
+    def _section(self, section):
+        records = self._sections.get(section)
+        if records is None:
+            # walking a section finds where the next one starts
+            while len(self._starts) <= section + 1:
+                self._walk(len(self._starts) - 1)
+            records = self._sections[section]
+        return records
+
+    def _walk(self, section):
+        """Walk a section, starting where the one before it ended"""
+        if section == QUESTIONS:
+            bs = self.data
+            idx = self._starts[section]
+            records = []
+            for _ in range(self.header.qdcount):
+                name_at, idx = idx, skip_name(bs, idx)
+                qtype, qclass = QUESTION.unpack_from(bs, idx)
+                records.append((name_at, qtype, qclass))
+                idx += QUESTION.size
+        else:
+            records = [RecordView(self, *fields)
+                       for fields in self._scan(section)]
+            last = records[-1] if records else None
+            idx = last.rdata_offset + last.rdlength if last else \
+                self._starts[section]
+        self._sections[section] = records
+        self._starts.append(idx)
+
+    def _scan(self, section):
+        """
+        Generate the offset of each record of a section, followed by its
+        fixed fields and the offset of its data, without making views of
+        them; the start of the section must already be known
+        """
+        bs = self.data
+        idx = self._starts[section]
+        for _ in range(self.header[section + 2]):  # ancount, nscount...
+            name_at, idx = idx, skip_name(bs, idx)
+            rtype, dns_class, ttl, length = RECORD.unpack_from(bs, idx)
+            idx += RECORD.size
+            if idx + length > len(bs):
+                raise ValueError('record data at offset {} runs past the '
+                                 'end of the message'.format(idx))
+            yield name_at, rtype, dns_class, ttl, length, idx
+            idx += length
+
+    @property
+    def questions(self):
+        return [Question(parse_name(self.data, name_at, self.names)[0],
+                         type_name(qtype), qclass)
+                for name_at, qtype, qclass in self._section(QUESTIONS)]
+
+    @property
+    def answers(self):
+        return self._section(ANSWERS)
+
+    @property
+    def authority(self):
+        return self._section(AUTHORITY)
+
+    @property
+    def additional(self):
+        return self._section(ADDITIONAL)
+
+    def first_answer(self, rtype=A):
+        """
+        The first answer of the given type (a number), or None, walking only
+        as far into the answers as it takes to find it
+        """
+        if ANSWERS in self._sections:
+            for record in self._sections[ANSWERS]:
+                if record.type == rtype:
+                    return record
+            return None
+        self._section(QUESTIONS)
+        for fields in self._scan(ANSWERS):
+            if fields[1] == rtype:
+                return RecordView(self, *fields)
+        return None
+
+    def to_message(self):
+        """Decode the whole message, as `Message.decode` would"""
+        return Message(self.header, self.questions,
+                       [r.to_record() for r in self.answers],
+                       [r.to_record() for r in self.authority],
+                       [r.to_record() for r in self.additional])
+
+    def __repr__(self):
+        return repr(self.to_message())
@@ -7,14 +7,60 @@ import struct
 
 GOOGLE_PUBLIC_DNS = ('8.8.8.8', 53)
 
-# See RFC 1035 § 3.2.2 for a full list of types
-Q_TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'MX': 15, 'TXT': 16}
+# See RFC 1035 § 3.2.2 for a full list of types, and RFC 3596, RFC 2782 and
+# RFC 6891 for AAAA, SRV and OPT
+Q_TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15,
+           'TXT': 16, 'AAAA': 28, 'SRV': 33, 'OPT': 41}
 TYPE_NAMES = dict((v, k) for k, v in Q_TYPES.items())
+OPT = Q_TYPES['OPT']
+
+# header flags, see RFC 1035 § 4.1.1
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+OPCODE_MASK = 0x7800
 
 # See RFC 1035 § 4.1 for the meanings of fields
 Header = namedtuple('Header', 'xid flags qdcount ancount nscount arcount')
 Question = namedtuple('Question', 'qname qtype qclass')
 ResourceRecord = namedtuple('ResourceRecord', 'name type dns_class ttl rdlength rdata')
+# See RFC 1035 § 3.3.9 and § 3.3.13, and RFC 2782
+MxData = namedtuple('MxData', 'preference exchange')
+SrvData = namedtuple('SrvData', 'priority weight port target')
+SoaData = namedtuple('SoaData', 'mname rname serial refresh retry expire minimum')
+
+HEADER = struct.Struct('!HHHHHH')
+QUESTION = struct.Struct('!HH')
+RECORD = struct.Struct('!HHIH')  # the fixed fields that follow its name
+A_RECORD = struct.Struct('!HHIH4s')  # the same, with an address as its data
+SHORT = struct.Struct('!H')
+SOA_COUNTS = struct.Struct('!IIIII')
+SRV_FIELDS = struct.Struct('!HHH')
+
+# the largest message sent over UDP without EDNS, see RFC 1035 § 2.3.4
+MAX_UDP_SIZE = 512
+# the UDP payload size to advertise with EDNS, small enough to avoid IP
+# fragmentation on almost any path (as agreed for DNS Flag Day 2020)
+EDNS_UDP_SIZE = 1232
+
+
+def type_name(rtype):
+    """
+    The mnemonic for a record type number, or TYPEn for one that has none,
+    per RFC 3597 § 5
+    """
+    return TYPE_NAMES.get(rtype) or 'TYPE{}'.format(rtype)
+
+
+def type_number(name):
+    """The number of a record type, given its mnemonic or as TYPEn"""
+    try:
+        return Q_TYPES[name]
+    except KeyError:
+        if name[:4].upper() == 'TYPE' and name[4:].isdigit():
+            return int(name[4:])
+        raise ValueError('unknown record type {!r}'.format(name))
 
 
 class Message(object):
@@ -33,30 +79,46 @@ class Message(object):
         self.additional = additional or []
 
     @classmethod
-    def query(cls, name, record_type):
+    def query(cls, name, record_type, udp_size=None):
         """
         Construct a query message for the given name and record type.
 
         Use a random transaction id, set only the RD ("recursive desired") flag,
-        and indicate that we have one question and no other records.
+        and indicate that we have one question and no other records. Given a
+        `udp_size`, also advertise with EDNS (RFC 6891) that we can receive
+        responses of up to that many bytes over UDP.
         """
-        header = Header(random.randint(0, 0xffff), 0x0100, 1, 0, 0, 0)
+        header = Header(random.randint(0, 0xffff), FLAG_RD, 1, 0, 0, 0)
         questions = [Question(name, record_type, 1)]
-        return cls(header, questions)
+        additional = [opt_record(udp_size)] if udp_size else []
+        return cls(header, questions, additional=additional)
+
+    @property
+    def udp_size(self):
+        """
+        The UDP payload size advertised by the EDNS OPT record, or None if
+        there is none
+        """
+        for r in self.additional:
+            if r.type == OPT:
+                return max(r.dns_class, MAX_UDP_SIZE)
+        return None
 
     @classmethod
     def decode(cls, bs):
         """
-        Construct a message by parsing the given bytes
+        Construct a message by parsing the given bytes, or any bytes-like
+        object such as a memoryview of a larger buffer
         """
-        header = Header(*struct.unpack('!HHHHHH', bs[:12]))
+        header = Header(*struct.unpack_from('!HHHHHH', bs))
         questions, answers, authority, additional = [], [], [], []
+        names = {}  # offset to name, shared by every name in the message
 
         idx = 12
         for _ in range(header.qdcount):
-            name, idx = parse_name(bs, idx)
-            qtype, qclass = struct.unpack('!HH', bs[idx:idx+4])
-            questions.append(Question(name, TYPE_NAMES[qtype], qclass))
+            name, idx = parse_name(bs, idx, names)
+            qtype, qclass = struct.unpack_from('!HH', bs, idx)
+            questions.append(Question(name, type_name(qtype), qclass))
             idx += 4
 
         sections = (
@@ -64,34 +126,138 @@ class Message(object):
             (header.nscount, authority),
             (header.arcount, additional)
         )
+        unpack_from = struct.unpack_from
+        size = len(bs)
         # parse each resource record for each section
         for n, records in sections:
             for _ in range(n):
-                name, idx = parse_name(bs, idx)
-                rtype, rclass, ttl, length = struct.unpack('!HHIH', bs[idx:idx+10])
+                # most record names are a lone pointer to a name already
+                # decoded, so try for that before parsing the name in full
+                pointer = unpack_from('!H', bs, idx)[0]
+                if pointer >= 0xc000 and pointer & 0x3fff in names:
+                    name = names[pointer & 0x3fff]
+                    idx += 2
+                else:
+                    name, idx = parse_name(bs, idx, names)
+                rtype, rclass, ttl, length = unpack_from('!HHIH', bs, idx)
                 idx += 10
-                data = parse_record_data(bs, idx, rtype, length)
+                if idx + length > size:
+                    raise ValueError('record data at offset {} runs past the '
+                                     'end of the message'.format(idx))
+                if rtype == 1 and length == 4:
+                    data = socket.inet_ntoa(bs[idx:idx+4])
+                else:
+                    data = parse_record_data(bs, idx, rtype, length, names)
                 idx += length
-                r = ResourceRecord(name, rtype, rclass, ttl, length, data)
-                records.append(r)
+                records.append(
+                    ResourceRecord(name, rtype, rclass, ttl, length, data))
 
         return cls(header, questions, answers, authority, additional)
 
     def encode(self):
-        """Encode the message as a sequence of bytes"""
-        name = b''.join(len(p).to_bytes(1, 'big') + bytes(p, 'ascii')
-                        for p in self.questions[0].qname.split('.'))
-        return struct.pack(
-            '!HHHHHH{}sBHH'.format(len(name)),
-            *self.header,
-            name,
-            0,                          # terminating byte
-            Q_TYPES[record_type],       # record type code
-            1                           # Qclass of "internet"
-        )
-
-
-def parse_name(bs, i):
+        """
+        Encode the message as a sequence of bytes, with the counts in the
+        header taken from the sections themselves, and every name compressed
+        against those before it
+        """
+        writer = _MessageWriter()
+        writer.pack(HEADER, self.header.xid, self.header.flags,
+                    len(self.questions), len(self.answers),
+                    len(self.authority), len(self.additional))
+        for q in self.questions:
+            writer.name(q.qname)
+            writer.pack(QUESTION, type_number(q.qtype), q.qclass)
+        for records in (self.answers, self.authority, self.additional):
+            for r in records:
+                writer.name(r.name)
+                if r.type == 1:
+                    writer.pack(A_RECORD, 1, r.dns_class, r.ttl, 4,
+                                socket.inet_aton(r.rdata))
+                    continue
+                writer.pack(RECORD, r.type, r.dns_class, r.ttl, 0)
+                start = writer.end
+                writer.record_data(r.type, r.rdata)
+                # fill in the length, now that the data is written
+                SHORT.pack_into(writer.buffer, start - 2, writer.end - start)
+        return writer.getvalue()
+
+
+class _MessageWriter(object):
+    """
+    A message being encoded into a bytearray, which is allocated up front and
+    grown only when it fills, rather than joined from many small bytes.
+
+    Each name written is compressed to a pointer to the longest of its
+    suffixes written before, if any (RFC 1035 § 4.1.4), and each of its
+    suffixes that it does write out in full is recorded for later names to
+    point to. Suffixes are matched case sensitively, so that every name
+    comes out spelled exactly as it went in.
+    """
+    def __init__(self, size=MAX_UDP_SIZE):
+        self.buffer = bytearray(size)
+        self.end = 0
+        self.suffixes = {}  # name suffix to the offset it was written at
+
+    def pack(self, fmt, *values):
+        try:
+            fmt.pack_into(self.buffer, self.end, *values)
+        except struct.error:
+            # out of room (or a bad value, which will fail again): double it
+            self.buffer += bytes(len(self.buffer) + fmt.size)
+            fmt.pack_into(self.buffer, self.end, *values)
+        self.end += fmt.size
+
+    def write(self, data):
+        # assigning past the end of the buffer just extends it
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def name(self, name):
+        name = name.rstrip('.')
+        suffixes = self.suffixes
+        start = 0
+        while start < len(name):
+            offset = suffixes.get(name[start:])
+            if offset is not None:
+                self.pack(SHORT, 0xc000 | offset)
+                return
+            dot = name.find('.', start)
+            if dot < 0:
+                dot = len(name)
+            label = name[start:dot].encode('ascii')
+            if len(label) > 63:
+                raise ValueError('label {!r} is longer than 63 bytes'.format(
+                    label))
+            if label:
+                # only the first 16K of a message can be pointed to
+                if self.end < 0x4000:
+                    suffixes[name[start:]] = self.end
+                self.write(bytes((len(label),)) + label)
+            start = dot + 1
+        self.write(b'\0')
+
+    def record_data(self, rtype, rdata):
+        """
+        Write record data, compressing names only in the types defined by
+        RFC 1035, per RFC 3597 § 4
+        """
+        if rtype in (2, 5, 12):
+            self.name(rdata)
+        elif rtype == 15:
+            self.pack(SHORT, rdata.preference)
+            self.name(rdata.exchange)
+        elif rtype == 6:
+            self.name(rdata.mname)
+            self.name(rdata.rname)
+            self.pack(SOA_COUNTS, *rdata[2:])
+        else:
+            self.write(encode_record_data(rtype, rdata))
+
+    def getvalue(self):
+        return bytes(memoryview(self.buffer)[:self.end])
+
+
+def parse_name(bs, i, names=None):
     """
     Parse name such as 'ns1.google.com' from a point in a DNS message.
 
@@ -107,8 +273,21 @@ def parse_name(bs, i):
     two bits are `11`, it is a pointer.
 
     See RFC 1035 § 4.1.4 for details.
+
+    Pointers are followed iteratively, and each must point to a prior
+    occurrence of a name, before the labels that led to it, so that a loop
+    of pointers raises ValueError rather than being followed forever. Given
+    a dict `names`, shared by every call for the same message, the suffix
+    starting at each label is memoized by its offset, so that a name pointed
+    to many times is decoded just once.
+
+    Returns the name and the offset just past it.
     """
     labels = []
+    offsets = []
+    suffix = ''
+    end = None
+    start = i  # of the labels being read; a pointer must point before it
 
     while True:
         b = bs[i]
@@ -116,29 +295,126 @@ def parse_name(bs, i):
             break
 
         # if first two bits are `11`, then the remaining 14 bits are a pointer
-        if b >> 6 == 0b11:  # if first two bits are on, it's a pointer
+        if b >> 6 == 0b11:
             pointer = ((b & 0x3f) << 8) | bs[i+1]
-            result, _ = parse_name(bs, pointer)
-            return '.'.join([str(l, 'ascii') for l in labels] + [result]), i + 2
-
-        labels.append(bs[i+1:i+b+1])
+            if end is None:
+                end = i + 2
+            if pointer >= start:
+                raise ValueError('name pointer at offset {} to {} does not '
+                                 'point backwards'.format(i, pointer))
+            if names is not None and pointer in names:
+                suffix = names[pointer]
+                break
+            i = start = pointer
+            continue
+        if b > 63:
+            raise ValueError('bad label length {} at offset {}'.format(b, i))
+
+        offsets.append(i)
+        labels.append(str(bs[i+1:i+b+1], 'ascii'))
         i += b + 1
 
-    return str(b'.'.join(labels), 'ascii'), i + 1  # +1 for null terminator
+    if end is None:
+        end = i + 1  # +1 for null terminator
+    # join the labels from the last, memoizing the suffix at each as we go
+    for label, offset in zip(reversed(labels), reversed(offsets)):
+        suffix = label + '.' + suffix if suffix else label
+        if names is not None:
+            names[offset] = suffix
+    return suffix, end
 
 
-def parse_record_data(bs, i, rtype, length):
+def parse_record_data(bs, i, rtype, length, names=None):
     """
-    Parse the data field of a resource record
+    Parse the data field of a resource record, decoding any names in it with
+    the memo `names`, as for `parse_name`
     """
     if rtype == 1:
         # A record: show as dotted decimal
-        return '.'.join(str(int(b)) for b in bs[i:i+length])
-    if rtype == 2:
-        # NS record: show as name
-        return parse_name(bs, i)[0]
+        return '.'.join(map(str, bs[i:i+length]))
+    if rtype in (2, 5, 12):
+        # NS, CNAME or PTR record: show as name
+        return parse_name(bs, i, names)[0]
+    if rtype == 28 and length == 16:
+        # AAAA record: show as an IPv6 address
+        return socket.inet_ntop(socket.AF_INET6, bytes(bs[i:i+16]))
+    if rtype == 33:
+        # SRV record: three 16 bit fields then a name
+        return SrvData(*SRV_FIELDS.unpack_from(bs, i),
+                       parse_name(bs, i + 6, names)[0])
+    if rtype == 15:
+        # MX record: a preference then a name
+        return MxData(struct.unpack_from('!H', bs, i)[0],
+                      parse_name(bs, i + 2, names)[0])
+    if rtype == 6:
+        # SOA record: two names then five 32 bit counts
+        mname, i = parse_name(bs, i, names)
+        rname, i = parse_name(bs, i, names)
+        return SoaData(mname, rname, *struct.unpack_from('!IIIII', bs, i))
     # otherwise, just show bytes
-    return str(bs[i:i+length])
+    return bytes(bs[i:i+length])
+
+
+def opt_record(udp_size, options=b''):
+    """
+    An EDNS OPT pseudo-record, advertising a UDP payload size of `udp_size`,
+    with its class holding the size and its TTL the extended RCODE, version
+    and flags, all zero. See RFC 6891 § 6.1.
+    """
+    return ResourceRecord('', OPT, udp_size, 0, len(options), options)
+
+
+def encode_name(name):
+    """
+    Encode a name such as 'ns1.google.com' as a sequence of labels, each
+    preceded by its length, and terminated by an empty label
+    """
+    labels = [bytes(p, 'ascii') for p in name.rstrip('.').split('.') if p]
+    return b''.join(len(p).to_bytes(1, 'big') + p for p in labels) + b'\0'
+
+
+def encode_record_data(rtype, rdata):
+    """
+    Encode the data field of a resource record, as parsed by
+    `parse_record_data`, without compressing any names in it
+    """
+    if rtype == 1:
+        return socket.inet_aton(rdata)
+    if rtype in (2, 5, 12):
+        return encode_name(rdata)
+    if rtype == 28:
+        return socket.inet_pton(socket.AF_INET6, rdata)
+    if rtype == 33:
+        return SRV_FIELDS.pack(*rdata[:3]) + encode_name(rdata.target)
+    if rtype == 15:
+        return struct.pack('!H', rdata.preference) + encode_name(rdata.exchange)
+    if rtype == 6:
+        return encode_name(rdata.mname) + encode_name(rdata.rname) + \
+            struct.pack('!IIIII', *rdata[2:])
+    return rdata
+
+
+def _recv_exactly(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed mid-message')
+        data += chunk
+    return data
+
+
+def query_tcp(query, server=GOOGLE_PUBLIC_DNS, timeout=5.0):
+    """
+    Send `query` over TCP and return the response, as for a query whose
+    response over UDP was truncated. Each message is prefixed by its length
+    in two bytes, see RFC 1035 § 4.2.2.
+    """
+    with socket.create_connection(server, timeout) as sock:
+        data = query.encode()
+        sock.sendall(len(data).to_bytes(2, 'big') + data)
+        length = int.from_bytes(_recv_exactly(sock, 2), 'big')
+        return Message.decode(_recv_exactly(sock, length))
 
 
 # Formatting functions
@@ -157,7 +433,9 @@ Question.__repr__ = _format_question
 
 
 def _format_record(r):
-    return '{}\t\t{}\tIN\t{}\t{}'.format(r.name, r.ttl, TYPE_NAMES[r.type], r.rdata)
+    if r.type == OPT:
+        return '.\t\t\tOPT\tudp={}\t{}'.format(r.dns_class, r.rdata)
+    return '{}\t\t{}\tIN\t{}\t{}'.format(r.name, r.ttl, type_name(r.type), r.rdata)
 ResourceRecord.__repr__ = _format_record
 
 
@@ -185,7 +463,7 @@ Message.__repr__ = _format_message
 
 if __name__ == '__main__':
     name, record_type = sys.argv[1], sys.argv[2]
-    query = Message.query(name, record_type)
+    query = Message.query(name, record_type, EDNS_UDP_SIZE)
 
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # IPv4, UDP
     sock.bind(('', 0))
@@ -196,7 +474,7 @@ if __name__ == '__main__':
     sock.sendto(query.encode(), GOOGLE_PUBLIC_DNS)
 
     while True:
-        data, addr = sock.recvfrom(4096)
+        data, addr = sock.recvfrom(0xffff)
         if addr != GOOGLE_PUBLIC_DNS:
             continue  # ignore messages from other hosts!
 
@@ -205,6 +483,10 @@ if __name__ == '__main__':
         if query.header.xid != response.header.xid:
             continue  # ignore responses to _other_ queries
 
+        if response.header.flags & FLAG_TC:
+            print('Response truncated, retrying over TCP')
+            response = query_tcp(query)
+
         print('Response:')
         print(response)
         break
@@ -1,12 +1,61 @@
 import argparse
+import asyncio
+from collections import deque
 from enum import Enum
-import select
+import errno
+import multiprocessing
+import multiprocessing.connection
+import os
+import selectors
+import signal
 import socket
 import sys
+import time
 import traceback
 
+try:
+    import resource
+except ImportError:  # not on Windows, where the fd limit is left alone
+    resource = None
 
-CONNECTION_POOL_SIZE = 4
+
+# the pool of connections to the end server, see `ServerConnectionPool`
+POOL_MIN_SIZE = 4
+POOL_MAX_SIZE = 64
+POOL_IDLE_TIMEOUT = 30.0
+POOL_MAX_CONNECTING = 4
+
+# bytes a transport may have waiting to be written before we stop reading
+# from the other side of the proxy, see `AsyncProxyServer`
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# bytes read from a socket at a time when relaying, see `ProxyServer`
+BUFFER_SIZE = 64 * 1024
+
+# the most a request line and headers may take up, see `HttpMessage`, or
+# a chunk size or trailer line, see `ChunkedBody`
+MAX_HEAD_SIZE = 64 * 1024
+
+# what `HttpMessage.body_length` gives for a body in the chunked transfer
+# coding, whose length is only known once it has all been read
+CHUNKED = 'chunked'
+
+# whether bodies can be spliced between sockets within the kernel (Linux)
+SPLICE = hasattr(os, 'splice')
+SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK if SPLICE else 0
+
+# seconds between the worker supervisor logging stats, and at least
+# between starts of the same worker, see `WorkerSupervisor`
+STATS_INTERVAL = 10
+RESTART_DELAY = 1
+
+# the counts each engine keeps, see `proxy_stats`
+STATS = ('clients', 'relayed', 'bad_gateways', 'pool_size', 'pool_opened',
+         'pool_failed', 'pool_expired')
+
+# what a client is sent when its request could not be forwarded
+BAD_GATEWAY = (b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n'
+               b'Connection: close\r\n\r\n')
 
 COLOR_GREEN = '\033[32m'
 COLOR_BLUE = '\033[34m'
@@ -18,11 +67,37 @@ def log(msg, color=COLOR_DEFAULT):
     sys.stderr.write(color + msg + COLOR_DEFAULT + '\n')
 
 
+def raise_fd_limit():
+    """
+    Allow ourselves as many open sockets as the hard limit does, as each
+    client needs one
+    """
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def proxy_stats(proxy):
+    """
+    The counts named by `STATS` for either engine: clients accepted,
+    responses relayed and 502s sent in their place, connections in the pool
+    and how many it has opened, failed to open and closed as idle
+    """
+    pool = proxy.pool
+    return (proxy.clients, proxy.relayed, proxy.bad_gateways, len(pool),
+            pool.opened, pool.failed, pool.expired)
+
+
 def format_data(data):
     """
-    Format an HTTP message for presentation in a log message
+    Format an HTTP message, or any bytes-like part of one, for presentation
+    in a log message
     """
-    string = data.decode().encode('unicode_escape').decode()
+    # only so much will be shown, however long it is once escaped
+    string = bytes(data[:80]).decode(errors='replace').encode(
+        'unicode_escape').decode()
     if len(string) > 40:
         return string[:40] + '...'
     return string
@@ -35,12 +110,18 @@ class HttpMessage(object):
     Call `ingest_chunk` repeatedly with sequential chunks of the single
     HTTP request. State is updated to reflect headers, body etc that
     we have so far.
+
+    Alternatively, to stream a message through rather than buffer it whole,
+    call `ingest_head` with each chunk until it has the request line and
+    headers, send `head_bytes` on, and then relay `body_length` bytes of
+    body as they arrive, or a `ChunkedBody` if it is `CHUNKED`.
     """
     def __init__(self):
         self.request_line = None
         self.headers = {}
         self._body_chunks = []
         self._prior_data = ''
+        self._head = bytearray()  # the head so far, when streaming
 
     def ingest_chunk(self, data):
         # If no request line, read it
@@ -68,6 +149,73 @@ class HttpMessage(object):
                 header, value = header_line.split(b': ', 1)
                 self.headers[header] = value
 
+    def ingest_head(self, data):
+        """
+        Parse what the next chunk `data` (any bytes-like object) has of the
+        request line and headers, returning the offset in it at which the
+        body starts once they are complete, or None until then. Only the
+        head is kept, never the body.
+        """
+        start = len(self._head)
+        self._head += data
+        # the blank line may have been split across chunks
+        end = self._head.find(b'\r\n\r\n', max(0, start - 3))
+        if end == -1:
+            if len(self._head) > MAX_HEAD_SIZE:
+                raise ValueError('message head is too long')
+            return None
+        lines = bytes(self._head[:end]).split(b'\r\n')
+        self.request_line = lines[0]
+        for line in lines[1:]:
+            header, value = line.split(b': ', 1)
+            self.headers[header] = value
+        self._head = bytearray()
+        return end + 4 - start
+
+    def get_header(self, name):
+        """The value of a header, whatever the case of its name, or None"""
+        name = name.lower()
+        for header, value in self.headers.items():
+            if header.lower() == name:
+                return value
+        return None
+
+    def is_interim(self):
+        """
+        Whether this is an informational response, such as 100 Continue,
+        with the final response still to follow
+        """
+        return self.request_line.startswith(b'HTTP/') and \
+            self.request_line[9:10] == b'1'
+
+    def body_length(self, request=None):
+        """
+        The length of the body, per RFC 7230 § 3.3.3: 0 for a response that
+        never has one, `CHUNKED` if it is in the chunked transfer coding, or
+        else its Content-Length, and otherwise 0 for a request, or None for
+        a response whose body runs until the server closes the connection.
+        For a response, `request` is the request it answers, as a response
+        to HEAD has no body whatever its headers say.
+        """
+        is_response = self.request_line.startswith(b'HTTP/')
+        if is_response and (
+                self.request_line[9:12] in (b'204', b'304') or
+                self.is_interim() or request is not None and
+                request.request_line.startswith(b'HEAD ')):
+            return 0
+        coding = self.get_header(b'Transfer-Encoding')
+        if coding is not None:
+            # chunked, if at all, is the last coding applied
+            if coding.rsplit(b',', 1)[-1].strip().lower() == b'chunked':
+                return CHUNKED
+            if not is_response:
+                raise ValueError('request body of unknown length')
+            return None
+        length = self.get_header(b'Content-Length')
+        if length is not None:
+            return int(length)
+        return None if is_response else 0
+
     @staticmethod
     def _read_line(data):
         pos = data.find(b'\r\n')
@@ -88,41 +236,260 @@ class HttpMessage(object):
         except KeyError:
             return False
 
-    def to_bytes(self):
+    def head_bytes(self):
+        """The request line and headers, up to the blank line after them"""
         return b'\r\n'.join(
              [self.request_line] + [
                  k + b': ' + v
                  for k, v in self.headers.items()
-             ] + [b'', self.get_body()]
+             ] + [b'', b'']
         )
 
+    def to_bytes(self):
+        return self.head_bytes() + self.get_body()
+
+
+class ChunkedBody(object):
+    """
+    Find where a body in the chunked transfer coding ends, by scanning it as
+    it passes through, without decoding it: chunk size lines, chunk data and
+    trailer are all relayed just as they are.
+    """
+    def __init__(self):
+        self.done = False
+        self._line = bytearray()  # the size or trailer line so far
+        self._data = 0  # bytes of chunk data, and the CRLF after, to come
+        self._trailer = False  # whether the last chunk has been seen
+
+    def scan(self, data):
+        """
+        Scan the next bytes `data` (any bytes-like object) of the body,
+        returning how many of them belong to it: all of them, unless it ends
+        within them
+        """
+        i = 0
+        while i < len(data) and not self.done:
+            if self._data:
+                step = min(self._data, len(data) - i)
+                self._data -= step
+                i += step
+                continue
+            # lines are short, so only copy a little at a time to find them
+            window = bytes(data[i:i + 1024])
+            end = window.find(b'\n')
+            if end == -1:
+                self._line += window
+                i += len(window)
+                if len(self._line) > MAX_HEAD_SIZE:
+                    raise ValueError('chunk line is too long')
+                continue
+            line = bytes(self._line + window[:end]).rstrip(b'\r')
+            self._line = bytearray()
+            i += end + 1
+            if self._trailer:
+                # the trailer is ended by a blank line
+                self.done = not line
+                continue
+            # a size in hex, maybe followed by extensions after a semicolon
+            size = int(line.split(b';', 1)[0].strip(), 16)
+            if size:
+                self._data = size + 2
+            else:
+                self._trailer = True
+        return i
+
+
+
+
+
+
+
+
+class ServerConnectionPool(object):
+    """
+    The bookkeeping for an elastic pool of connections to the end server,
+    with the I/O left to the proxy engine using it.
+
+    A connection is checked out for one request at a time, and checked back
+    in once its response has been read. When none is idle, more are opened,
+    at most `max_connecting` at a time and `max_size` in all, and beyond
+    that requests wait their turn in `waiters`. Connections left idle for
+    `idle_timeout` seconds are closed, down to `min_size`, and any that the
+    server closes or that fail are discarded, to be replaced as needed.
+    """
+    def __init__(self, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT,
+                 max_connecting=POOL_MAX_CONNECTING):
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.idle_timeout = idle_timeout
+        self.max_connecting = max_connecting
+        self.idle = deque()  # (connection, idle since), longest idle first
+        self.busy = set()
+        self.connecting = set()  # whatever stands for each one being opened
+        self.waiters = deque()
+        self.opened = 0
+        self.failed = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.idle) + len(self.busy) + len(self.connecting)
+
+    def add(self, conn, now):
+        """Add a connection opened by other means than `to_open`, idle"""
+        self.opened += 1
+        self.idle.append((conn, now))
+
+    def checkout(self):
+        """
+        The most recently used idle connection, now busy, or None if there
+        is none, leaving those used least to expire when the load drops
+        """
+        if not self.idle:
+            return None
+        conn, _ = self.idle.pop()
+        self.busy.add(conn)
+        return conn
+
+    def checkin(self, conn, now):
+        self.busy.discard(conn)
+        self.idle.append((conn, now))
+
+    def to_open(self):
+        """
+        How many more connections to start opening now, for the requests
+        waiting and to keep `min_size` open
+        """
+        wanted = max(len(self.waiters) - len(self.connecting),
+                     self.min_size - len(self))
+        room = min(self.max_size - len(self),
+                   self.max_connecting - len(self.connecting))
+        return max(0, min(wanted, room))
+
+    def connected(self, token, conn):
+        """Count the connection opened in place of `token` as busy"""
+        self.connecting.discard(token)
+        self.busy.add(conn)
+        self.opened += 1
+
+    def connect_failed(self, token):
+        self.connecting.discard(token)
+        self.failed += 1
+
+    def discard(self, conn):
+        """Forget a connection that has been closed, whether busy or idle"""
+        if conn in self.busy:
+            self.busy.remove(conn)
+        else:
+            self.idle = deque(entry for entry in self.idle
+                              if entry[0] is not conn)
 
+    def expire(self, now):
+        """
+        Remove and return the connections, beyond `min_size`, that have been
+        idle for too long
+        """
+        expired = []
+        while self.idle and len(self) > self.min_size and \
+                self.idle[0][1] + self.idle_timeout <= now:
+            expired.append(self.idle.popleft()[0])
+        self.expired += len(expired)
+        return expired
 
+    def __str__(self):
+        return '{} connections ({} idle, {} busy, {} opening), {} waiting; ' \
+            '{} opened, {} failed to open, {} expired'.format(
+                len(self), len(self.idle), len(self.busy),
+                len(self.connecting), len(self.waiters), self.opened,
+                self.failed, self.expired)
 
 
+class _BodyRelay(object):
+    """
+    What remains of the body of a message being relayed from `src` to `dst`
+    as it arrives: `remaining` bytes of it, or all there is until `src`
+    closes, if None, noting in `eof` that it did. A chunked body is relayed
+    until its `chunks` say it has ended, with `remaining` None until then.
+    Given a `pipe`, the body is spliced through it, within the kernel, with
+    `in_pipe` bytes of it there at a time, rather than read into a buffer
+    and sent on.
+    """
+    __slots__ = ('src', 'dst', 'remaining', 'chunks', 'pipe', 'in_pipe',
+                 'eof')
 
+    def __init__(self, src, dst, remaining, chunks=None, pipe=None):
+        self.src = src
+        self.dst = dst
+        self.remaining = remaining
+        self.chunks = chunks
+        self.pipe = pipe  # (read fd, write fd)
+        self.in_pipe = 0
+        self.eof = False
 
 
 class ProxyServer(object):
+    """
+    Proxy HTTP requests from any number of clients to the end server, over a
+    `ServerConnectionPool` of connections to it.
+
+    Every socket is registered with a selector (epoll or kqueue where
+    available), so that the cost of each turn of the event loop depends on
+    the number of sockets ready, not the number open. Once a client has
+    sent the head of a request, a server connection is checked out for it,
+    until the response has been sent back, and the client is left
+    unregistered meanwhile, with anything more it sends left in the kernel,
+    but for the body of its request. Requests that find the pool saturated
+    wait their turn.
+
+    Messages are streamed through rather than buffered whole: each head is
+    sent on as soon as it has been parsed, and the body after it relayed as
+    it arrives, spliced through a pipe where the platform allows it, or else
+    read into a buffer and sent on from memoryviews of it, so that no more
+    than a buffer's worth of any one body is ever held. Reading from either
+    side stops while the other has any of it still to take. Chunked bodies
+    are always read into the buffer, to be scanned for where they end.
 
-    class ConnectionState(Enum):
-        AVAILABLE = 1
-        UNAVAILABLE = 2
+    Whatever a client sends after a request, in the same read, is kept to be
+    read as its next request, once the response to this one has been sent,
+    so that pipelined requests are answered in turn. A server that sends
+    more than its response is in no state to be sent another request, and
+    its connection is closed.
+    """
 
     class LogAction(Enum):
         RECEIVED = 1
         SENDING = 2
 
-    def __init__(self, host, port, end_host, end_port):
+    def __init__(self, host, port, end_host, end_port, verbose=True,
+                 pool=None, reuse_port=False, splice=SPLICE):
         self.host = host
         self.port = port
         self.end_host = end_host
         self.end_port = end_port
-        self.inputs = []  # sockets we'll read from
-        self.outputs = []  # sockets we'll write to
-        self.messages = {}  # messages we build up to forward
-        self.server_connections = {}  # a connection pool to the server
-        self.mapping = {}  # sender -> receiver mapping ie where to proxy
+        self.end_address = None  # (family, address) the server was found at
+        self.verbose = verbose
+        self.reuse_port = reuse_port
+        self.splice = splice
+        self.report = None  # called with `proxy_stats` about once a second
+        self.clients = 0
+        self.relayed = 0
+        self.bad_gateways = 0
+        self.pool = ServerConnectionPool() if pool is None else pool
+        self.selector = selectors.DefaultSelector()
+        self.server_connections = set()  # open or being opened
+        self.heads = {}  # socket -> the message whose head we are reading
+        self.relays = {}  # socket -> the body relay reading from it
+        self.relays_to = {}  # socket -> the body relay writing to it
+        self.pending = {}  # socket -> deque of memoryviews not yet sent
+        self.leftover = {}  # socket -> bytes read past the message before
+        self.mapping = {}  # client <-> server for each exchange in flight
+        # server -> (request, its bytes to retry it with or None, whether
+        # the connection was reused)
+        self.in_flight = {}
+        self.closing = set()  # clients to close once their response is sent
+        self.buffer = bytearray(BUFFER_SIZE)  # what each read is into
+        self.spare_buffers = []  # to take its place when it holds unsent data
+        self.pipes = []  # empty pipes to splice bodies through
 
     def _start_proxy(self):
         """
@@ -131,49 +498,488 @@ class ProxyServer(object):
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                # for the kernel to share out connections among the
+                # processes listening on the port
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             s.setblocking(0)
             s.bind((self.host, self.port))
-            s.listen()
+            s.listen(socket.SOMAXCONN)
             log(f'Listening for new connections on {self.host}:{self.port}')
         except OSError as e:
             log(f'Failed to start proxy server: {e}', COLOR_RED)
             s.close()
             sys.exit(-1)
-        self.inputs.append(s)
+        self.selector.register(s, selectors.EVENT_READ)
         return s
 
-    def _create_server_connection_pool(self, size):
+    def _create_server_connection_pool(self):
         """
-        Create a number of connections to the end server
+        Open the pool's first connections to the end server, at least one
+        even if it need not keep any, to be sure the server is there
         """
-        for _ in range(size):
+        for _ in range(max(self.pool.min_size, 1)):
             s = None
             try:
                 s = socket.create_connection((self.end_host, self.end_port))
-                host, port = s.getpeername()
-                log(f'Established a connection to server with fd {s.fileno()}')
-                self.server_connections[s] = self.ConnectionState.AVAILABLE
-                self.inputs.append(s)
+                s.setblocking(0)
             except OSError as e:
                 log(f'Failed to connect to server: {e}', COLOR_RED)
                 if s:
                     s.close()
                 sys.exit(-1)
+            log(f'Established a connection to server with fd {s.fileno()}')
+            # later connections are opened without blocking, so without
+            # looking the server up again
+            self.end_address = s.family, s.getpeername()
+            self.server_connections.add(s)
+            self.selector.register(s, selectors.EVENT_READ)
+            self.pool.add(s, time.monotonic())
+
+    def _open_server_connections(self):
+        """
+        Start opening as many connections as the pool wants, each finished
+        by `_finish_connecting` once it is writable
+        """
+        family, address = self.end_address
+        for _ in range(self.pool.to_open()):
+            s = socket.socket(family, socket.SOCK_STREAM)
+            s.setblocking(0)
+            self.pool.connecting.add(s)
+            err = s.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS):
+                s.close()
+                self._connect_failed(s, os.strerror(err))
+                continue
+            self.server_connections.add(s)
+            self.selector.register(s, selectors.EVENT_WRITE)
+
+    def _finish_connecting(self, s):
+        err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.server_connections.remove(s)
+            self.selector.unregister(s)
+            s.close()
+            self._connect_failed(s, os.strerror(err))
+            return
+        if self.verbose:
+            log(f'Established a connection to server with fd {s.fileno()}')
+        self.pool.connected(s, s)
+        self.selector.modify(s, selectors.EVENT_READ)
+        self._checkin(s, reused=False)
+
+    def _connect_failed(self, s, reason):
+        self.pool.connect_failed(s)
+        log(f'Failed to connect to server: {reason}', COLOR_RED)
+        if not len(self.pool):
+            # no connection will come free for the requests waiting
+            while self.pool.waiters:
+                client, _, _, _ = self.pool.waiters.popleft()
+                if client.fileno() != -1:  # else it has been closed since
+                    self._bad_gateway(client)
+
+    def _close_server_connection(self, s):
+        """
+        Close a server connection, which the server has closed or which has
+        failed, and deal with the exchange in flight on it, if any. A request
+        with no response at all on a reused connection may just have crossed
+        with the server closing it as idle, so is retried on another one, if
+        we have all of it; other clients are answered with a 502, unless
+        they have had some of the response already, when there is nothing
+        for it but to close their connection too.
+        """
+        self._discard_server_connection(s)
+        if s in self.mapping:
+            client = self.mapping[s]
+            responded = s not in self.heads
+            if responded and s not in self.relays:
+                # the response is all in, and on its way to the client
+                self._end_exchange_if_done(s)
+                return
+            request, retry, reused = self.in_flight[s]
+            self._end_exchange(s)
+            if responded:
+                self.closing.add(client)
+                self._response_done(client)
+            elif reused and retry is not None:
+                self._dispatch(client, request, retry, 0)
+            else:
+                self._bad_gateway(client)
+        elif self.verbose:
+            log('Server closed idle connection', COLOR_RED)
+        self._open_server_connections()
+
+    def _discard_server_connection(self, s):
+        self._watch(s, 0)
+        s.close()
+        self.server_connections.discard(s)
+        self.pool.discard(s)
+        self.pending.pop(s, None)
+        self.leftover.pop(s, None)
+
+    def _watch(self, s, events):
+        """
+        Register interest in just `events` on `s`, or none at all if they
+        are 0, only if that is a change
+        """
+        key = self.selector.get_map().get(s)
+        if key is None:
+            if events:
+                self.selector.register(s, events)
+        elif not events:
+            self.selector.unregister(s)
+        elif key.events != events:
+            self.selector.modify(s, events)
+
+    def _update(self, s):
+        """
+        Register interest in whatever `s` is waiting for now: to be read
+        from if we are reading a head from it, or a body and the other side
+        has taken all of it so far, and to be written to if it has not
+        """
+        if s.fileno() == -1 or s in self.pool.connecting:
+            return
+        events = 0
+        relay = self.relays.get(s)
+        if relay is not None:
+            if relay.remaining != 0 and not self._relay_blocked(relay):
+                events = selectors.EVENT_READ
+        elif s in self.heads or s in self.server_connections:
+            # a server connection is always read from, if only to see it
+            # close while idle
+            events = selectors.EVENT_READ
+        relay = self.relays_to.get(s)
+        if self.pending.get(s) or relay is not None and relay.in_pipe:
+            events |= selectors.EVENT_WRITE
+        self._watch(s, events)
+
+    def _accept(self, proxy):
+        try:
+            client_connection, (c_host, c_port) = proxy.accept()
+        except BlockingIOError:
+            return  # another process or thread took it first
+        if self.verbose:
+            log(f'Accepted a connection from {c_host}:{c_port}')
+        client_connection.setblocking(0)
+        self.clients += 1
+        self.heads[client_connection] = HttpMessage()
+        self.selector.register(client_connection, selectors.EVENT_READ)
 
     def _close_client_connection(self, s):
         """
-        Clean up our state and close the client connection
+        Clean up our state and close the client connection, along with the
+        server connection of any exchange it is in the middle of
         """
-        if s in self.outputs:
-            self.outputs.remove(s)
-        if s in self.inputs:
-            self.inputs.remove(s)
-        dest = self.mapping[s]
-        self.server_connections[dest] = self.ConnectionState.AVAILABLE
+        self._watch(s, 0)
         s.close()
+        self.heads.pop(s, None)
+        self.pending.pop(s, None)
+        self.leftover.pop(s, None)
+        self.closing.discard(s)
+        if s in self.mapping:
+            # its response is still to come, and no one wants it now
+            dest = self.mapping[s]
+            self._end_exchange(dest)
+            self._discard_server_connection(dest)
+            self._open_server_connections()
+
+    def _dispatch(self, client, request, request_bytes, remaining):
+        """
+        Send a request, its head and whatever of its body we have in
+        `request_bytes`, over the next server connection free, or have it
+        wait for one, with the `remaining` bytes of its body to be relayed
+        after, or the rest of its chunks, if a `ChunkedBody`
+        """
+        dest = self.pool.checkout()
+        if dest is not None:
+            self._send_request(client, dest, request, request_bytes,
+                               remaining, reused=True)
+            return
+        self.pool.waiters.append((client, request, request_bytes, remaining))
+        self._open_server_connections()
+
+    def _checkin(self, s, reused=True):
+        """
+        Hand a server connection that has come free to the next request
+        waiting for one, or else back to the pool
+        """
+        while self.pool.waiters:
+            client, request, request_bytes, remaining = \
+                self.pool.waiters.popleft()
+            if client.fileno() != -1:  # else it has been closed since
+                self._send_request(client, s, request, request_bytes,
+                                   remaining, reused)
+                return
+        self.pool.checkin(s, time.monotonic())
+        self._update(s)
+
+    def _send_request(self, client, dest, request, request_bytes, remaining,
+                      reused):
+        self.mapping[client] = dest
+        self.mapping[dest] = client
+        # a request can only be retried if we never had to relay its body
+        self.in_flight[dest] = (request, None if remaining else request_bytes,
+                                reused)
+        self.heads[dest] = HttpMessage()
+        self._log(self.LogAction.SENDING, dest, request_bytes)
+        try:
+            self._send(dest, memoryview(request_bytes))
+        except OSError:
+            self._close_server_connection(dest)
+            return
+        if remaining:
+            self._start_relay(client, dest, remaining)
+        self._update(client)
+        self._update(dest)
+
+    def _end_exchange(self, dest):
+        """
+        Unpair a server connection from its client, dropping any body still
+        being relayed between them, and return the client
+        """
+        client = self.mapping.pop(dest)
+        del self.mapping[client]
+        del self.in_flight[dest]
+        self.heads.pop(dest, None)
+        for s in (client, dest):
+            relay = self.relays.get(s)
+            if relay is not None:
+                self._drop_relay(relay)
+        return client
+
+    def _end_exchange_if_done(self, dest):
+        """
+        Once the whole response has been read, and sent on to the client,
+        along with the whole request before it, put the server connection
+        back in the pool, and the client on to its next request
+        """
+        client = self.mapping[dest]
+        if dest in self.heads or dest in self.relays or \
+                client in self.relays or self.pending.get(client):
+            return
+        self._end_exchange(dest)
+        if dest in self.server_connections and dest in self.leftover:
+            # it sent more than the response, and there is no knowing what
+            self._discard_server_connection(dest)
+        if dest in self.server_connections:
+            self._checkin(dest)
+        else:
+            self._open_server_connections()  # to replace it
+        self._response_done(client)
+
+    def _bad_gateway(self, client):
+        self.bad_gateways += 1
+        self.closing.add(client)
+        self._log(self.LogAction.SENDING, client, BAD_GATEWAY)
+        try:
+            self._send(client, memoryview(BAD_GATEWAY))
+        except OSError:
+            self._close_client_connection(client)
+            return
+        self._response_done(client)
+
+    def _response_done(self, client):
+        """
+        Close the client connection if it is to be, or else read its next
+        request, starting with whatever it sent after the last, once the
+        response has all been sent
+        """
+        if self.pending.get(client):
+            self._update(client)
+        elif client in self.closing:
+            self._close_client_connection(client)
+        else:
+            self.heads[client] = HttpMessage()
+            data = self.leftover.pop(client, None)
+            if data is not None:
+                try:
+                    self._read_request(client, memoryview(data))
+                except ValueError:
+                    # a request we cannot make sense of
+                    self._close_client_connection(client)
+                    return
+            self._update(client)
+
+    def _send(self, s, data):
+        """
+        Send as much of the memoryview `data` as `s` will take now, after
+        anything already waiting, and keep the rest to send once it is
+        writable, returning whether that was all of it
+        """
+        queue = self.pending.get(s)
+        if not queue:
+            try:
+                sent = s.send(data)
+            except BlockingIOError:
+                sent = 0
+            if sent == len(data):
+                return True
+            data = data[sent:]
+            queue = self.pending[s] = deque()
+        if data.obj is self.buffer:
+            # the buffer holds unsent data now, so read into another
+            self.buffer = self.spare_buffers.pop() if self.spare_buffers \
+                else bytearray(BUFFER_SIZE)
+        queue.append(data)
+        return False
+
+    def _flush(self, s):
+        """
+        Send what we can of the data waiting for `s`, returning whether that
+        was all of it
+        """
+        queue = self.pending.get(s)
+        while queue:
+            data = queue[0]
+            try:
+                sent = s.send(data)
+            except BlockingIOError:
+                return False
+            if sent < len(data):
+                queue[0] = data[sent:]
+                return False
+            queue.popleft()
+            if isinstance(data.obj, bytearray):
+                self.spare_buffers.append(data.obj)
+        return True
+
+    def _start_relay(self, src, dst, remaining):
+        """
+        Relay the `remaining` bytes of a body from `src` to `dst`, or the
+        rest of its chunks if a `ChunkedBody`
+        """
+        chunks = pipe = None
+        if isinstance(remaining, ChunkedBody):
+            chunks, remaining = remaining, None
+        elif self.splice:
+            pipe = self.pipes.pop() if self.pipes else os.pipe()
+        relay = _BodyRelay(src, dst, remaining, chunks, pipe)
+        self.relays[src] = self.relays_to[dst] = relay
+
+    def _drop_relay(self, relay):
+        del self.relays[relay.src]
+        del self.relays_to[relay.dst]
+        if relay.pipe is None:
+            return
+        if relay.in_pipe:
+            # what is left in the pipe is going nowhere now
+            for fd in relay.pipe:
+                os.close(fd)
+        else:
+            self.pipes.append(relay.pipe)
+
+    def _relay_blocked(self, relay):
+        """Whether `dst` has yet to take all of the body relayed so far"""
+        return relay.in_pipe or bool(self.pending.get(relay.dst))
+
+    def _relay_body(self, relay):
+        """Relay what there is of a body now, its `src` being readable"""
+        size = BUFFER_SIZE if relay.remaining is None else \
+            min(relay.remaining, BUFFER_SIZE)
+        try:
+            if relay.pipe is not None:
+                n = os.splice(relay.src.fileno(), relay.pipe[1], size,
+                              flags=SPLICE_FLAGS)
+            else:
+                n = relay.src.recv_into(self.buffer, size)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            n = 0
+        if not n:
+            self._relay_ended(relay)
+            return
+        if relay.pipe is not None:
+            if relay.remaining is not None:
+                relay.remaining -= n
+            relay.in_pipe += n
+            self._drain_pipe(relay)
+            self._relay_progress(relay)
+            return
+        data = memoryview(self.buffer)[:n]
+        if relay.chunks is not None:
+            end = relay.chunks.scan(data)
+            if relay.chunks.done:
+                relay.remaining = 0
+                data = self._keep_leftover(relay.src, data, end)
+        elif relay.remaining is not None:
+            relay.remaining -= n
+        self._send(relay.dst, data)
+        self._relay_progress(relay)
+
+    def _keep_leftover(self, s, data, end):
+        """
+        Keep what `data` read from `s` has past the `end` of the message,
+        returning the message's part of it
+        """
+        if end < len(data):
+            self.leftover[s] = bytes(data[end:])
+        return data[:end]
+
+    def _body_start(self, s, data, length):
+        """
+        The part of the body of a message `length` long that `data` has,
+        keeping anything after it, and what is left of the body to relay
+        """
+        if length is CHUNKED:
+            chunks = ChunkedBody()
+            data = self._keep_leftover(s, data, chunks.scan(data))
+            return data, 0 if chunks.done else chunks
+        if length is None:
+            return data, None
+        data = self._keep_leftover(s, data, length)
+        return data, length - len(data)
+
+    def _drain_pipe(self, relay):
+        """Splice as much of what is in the pipe on to `dst` as it takes"""
+        if self.pending.get(relay.dst):
+            return  # the head goes first
+        while relay.in_pipe:
+            try:
+                n = os.splice(relay.pipe[0], relay.dst.fileno(),
+                              relay.in_pipe, flags=SPLICE_FLAGS)
+            except BlockingIOError:
+                return
+            relay.in_pipe -= n
+
+    def _relay_ended(self, relay):
+        """Deal with `src` closing its connection partway through a body"""
+        if relay.src not in self.server_connections:
+            # there is nothing to do with half a request
+            self._close_client_connection(relay.src)
+            return
+        # whether it ended the response or cut it short, all the client can
+        # be given is what there is of it
+        relay.remaining = 0
+        relay.eof = True
+        self._relay_progress(relay)
+
+    def _relay_progress(self, relay):
+        if relay.remaining == 0 and not self._relay_blocked(relay):
+            self._finish_relay(relay)
+        else:
+            self._update(relay.src)
+            self._update(relay.dst)
+
+    def _finish_relay(self, relay):
+        self._drop_relay(relay)
+        if relay.src in self.server_connections:
+            dest = relay.src
+            if relay.eof:
+                # the client can only tell where the response ended if we
+                # close its connection too
+                self.closing.add(relay.dst)
+                self._discard_server_connection(dest)
+        else:
+            dest = relay.dst
+        self._update(relay.src)
+        self._update(relay.dst)
+        self._end_exchange_if_done(dest)
 
     def _log(self, action, socket, msg):
-        s_host, s_port = socket.getpeername()
+        if not self.verbose:
+            return
+        s_host, s_port = socket.getpeername()[:2]
         host_port = f'{s_host}:{s_port}'
         if socket in self.server_connections:
             arrow = '<-' if action is self.LogAction.RECEIVED else '->'
@@ -193,102 +999,584 @@ class ProxyServer(object):
                 len(msg)
             ), COLOR_BLUE)
 
+    def _read(self, s):
+        relay = self.relays.get(s)
+        if relay is not None:
+            self._relay_body(relay)
+            return
+        try:
+            n = s.recv_into(self.buffer)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            n = 0
+        data = memoryview(self.buffer)[:n]
+        if s in self.server_connections:
+            self._read_response(s, data)
+        else:
+            self._read_request(s, data)
+
+    def _read_request(self, s, data):
+        if not data:
+            self._close_client_connection(s)
+            return
+        self._log(self.LogAction.RECEIVED, s, data)
+        msg = self.heads[s]
+        end = msg.ingest_head(data)
+        if end is None:
+            return
+        del self.heads[s]
+        msg.headers.update({b'Connection': b'Keep-Alive'})
+        body, remaining = self._body_start(s, data[end:], msg.body_length())
+        # read no more from the client until it has a server connection
+        self._update(s)
+        self._dispatch(s, msg, msg.head_bytes() + body, remaining)
+
+    def _read_response(self, s, data):
+        msg = self.heads.get(s)
+        if not data or msg is None:
+            # the server closed the connection, or sent something unasked
+            self._close_server_connection(s)
+            return
+        self._log(self.LogAction.RECEIVED, s, data)
+        client = self.mapping[s]
+        request, _, reused = self.in_flight[s]
+        # with some of the response in, the request cannot be retried
+        self.in_flight[s] = request, None, reused
+        while True:
+            end = msg.ingest_head(data)
+            if end is None:
+                return
+            head = msg.head_bytes()
+            self._log(self.LogAction.SENDING, client, head)
+            self._send(client, memoryview(head))
+            data = data[end:]
+            if not msg.is_interim():
+                break
+            # the response proper is still to come, after e.g. 100 Continue
+            msg = self.heads[s] = HttpMessage()
+        del self.heads[s]
+        self.relayed += 1
+        body, remaining = self._body_start(s, data, msg.body_length(request))
+        if body:
+            self._send(client, body)
+        if remaining != 0:
+            self._start_relay(s, client, remaining)
+        self._update(s)
+        self._update(client)
+        self._end_exchange_if_done(s)
+
+    def _write(self, s):
+        if s in self.pool.connecting:
+            self._finish_connecting(s)
+            return
+        if self._flush(s):
+            relay = self.relays_to.get(s)
+            if relay is not None:
+                self._drain_pipe(relay)
+                self._relay_progress(relay)
+            elif s in self.mapping:
+                self._end_exchange_if_done(
+                    s if s in self.server_connections else self.mapping[s])
+            elif s not in self.server_connections:
+                self._response_done(s)
+        self._update(s)
+
     def run(self):
         """
         Run the proxy using I/O multiplexing for concurrency
         """
-        self._create_server_connection_pool(CONNECTION_POOL_SIZE)
+        raise_fd_limit()
+        self._create_server_connection_pool()
         proxy = self._start_proxy()
+        next_report = 0
 
-        while self.inputs:
-            try:
-                readable, writable, exceptional = select.select(self.inputs, self.outputs, self.inputs)
-
-                for s in readable:
+        while True:
+            # wake up now and then to close connections long idle
+            for key, events in self.selector.select(timeout=1):
+                s = key.fileobj
+                try:
                     # if the proxy socket itself is readable, we have a new
                     # connection to accept
                     if s is proxy:
-                        client_connection, (c_host, c_port) = proxy.accept()
-                        log(f'Accepted a connection from {c_host}:{c_port}')
-                        client_connection.setblocking(0)
-                        self.inputs.append(client_connection)
-                        # TODO handle no available connections
-                        dest = [k for k, v in self.server_connections.items()
-                                if v is self.ConnectionState.AVAILABLE][0]
-                        self.server_connections[dest] = self.ConnectionState.UNAVAILABLE
-                        self.mapping[client_connection] = dest
-                        self.mapping[dest] = client_connection
-                    else:
-                        data = s.recv(4096)         # read up to 4kb of data at most
-                        # readable socket with data: ingest it for forwarding
-                        if data:
-                            self._log(self.LogAction.RECEIVED, s, data)
-                            dest = self.mapping[s]
-                            try:
-                                self.messages[dest].ingest_chunk(data)
-                            except KeyError:
-                                self.messages[dest] = HttpMessage()
-                                self.messages[dest].ingest_chunk(data)
-                            if dest not in self.outputs:
-                                self.outputs.append(dest)
-                        # readable socket with no data: close the corresponding
-                        # client connection
-                        else:
-                            if s in self.server_connections:
-                                # TODO why would the server ever send this
-                                # print(self.mapping)
-                                client_connection = self.mapping[s]
-                            else:
-                                client_connection = s
-                            self._close_client_connection(client_connection)
-
-                for s in writable:
-                    try:
-                        msg = self.messages[s]
-                        assert msg.is_complete()
-                    except (KeyError, AssertionError):
-                        # No messages waiting so stop checking for writability
-                        if s in self.outputs:
-                            self.outputs.remove(s)
+                        self._accept(proxy)
+                        continue
+                    if events & selectors.EVENT_READ:
+                        self._read(s)
+                    # the socket may have been closed while reading
+                    if events & selectors.EVENT_WRITE and s.fileno() != -1:
+                        self._write(s)
+                except (OSError, ValueError) as e:
+                    # ValueError for a message we cannot make sense of
+                    if not isinstance(e, ConnectionError):
+                        traceback.print_exc(file=sys.stderr)
+                    if s.fileno() == -1:
+                        continue
+                    if s in self.server_connections:
+                        self._close_server_connection(s)
                     else:
-                        if s in self.server_connections:
-                            msg.headers.update({b'Connection': b'Keep-Alive'})
-                        msg_bytes = msg.to_bytes()
-                        self._log(self.LogAction.SENDING, s, msg_bytes)
-                        s.send(msg_bytes)
-                        del self.messages[s]
-
-                for s in exceptional:
-                    log(f'Exception on {s}')
-                    self.inputs.remove(s)
-                    if s in self.outputs:
-                        self.outputs.remove(s)
-                    dest = self.mapping[s]
-                    s.close()
+                        self._close_client_connection(s)
+            now = time.monotonic()
+            for s in self.pool.expire(now):
+                if self.verbose:
+                    log(f'Closing idle connection to server with fd '
+                        f'{s.fileno()}')
+                self._discard_server_connection(s)
+            if self.report is not None and now >= next_report:
+                self.report(proxy_stats(self))
+                next_report = now + 1
+
+
+class AsyncProxyServer(object):
+    """
+    The same proxy as `ProxyServer`, on asyncio streams, with flow control.
+
+    A task for each client reads its requests in turn, checking a
+    connection out of the `ServerConnectionPool` for each one, waiting its
+    turn for one if need be, and relaying the response back. Having written
+    a message, it waits for the transport to drain below `write_buffer_size`
+    before it reads any more, and a stream whose reader is not keeping up
+    stops reading from its socket, so that a slow client or server holds up
+    only its own exchange, and never more than a bounded amount of data for
+    it sits in the proxy.
+
+    Messages are streamed through: each head is written on once it has been
+    read, and the body after it relayed `write_buffer_size` bytes at most
+    at a time, or a chunk size or trailer line at a time. Request bodies no
+    bigger than that are read whole first, so that the request can still be
+    retried. Pipelined requests are read, and answered, in turn.
+    """
+    def __init__(self, host, port, end_host, end_port, verbose=True,
+                 pool=None, reuse_port=False,
+                 write_buffer_size=WRITE_BUFFER_SIZE):
+        self.host = host
+        self.port = port
+        self.end_host = end_host
+        self.end_port = end_port
+        self.verbose = verbose
+        self.reuse_port = reuse_port
+        self.report = None  # called with `proxy_stats` about once a second
+        self.clients = 0
+        self.relayed = 0
+        self.bad_gateways = 0
+        # of (reader, writer)
+        self.pool = ServerConnectionPool() if pool is None else pool
+        self.write_buffer_size = write_buffer_size
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(
+            self.end_host, self.end_port, limit=self.write_buffer_size)
+        writer.transport.set_write_buffer_limits(self.write_buffer_size)
+        if self.verbose:
+            log('Established a connection to server with fd '
+                f'{writer.get_extra_info("socket").fileno()}')
+        return reader, writer
+
+    def _open_server_connections(self):
+        for _ in range(self.pool.to_open()):
+            # the pool holding on to the task keeps it from being collected
+            self.pool.connecting.add(
+                asyncio.ensure_future(self._open_server_connection()))
 
-            except socket.error as e:
-                print(e, file=sys.stderr)
-                traceback.print_exc(file=sys.stderr)
-            finally:
-                # TODO close anything necessary
+    async def _open_server_connection(self):
+        task = asyncio.current_task()
+        try:
+            conn = await self._connect()
+        except OSError as e:
+            self.pool.connect_failed(task)
+            log(f'Failed to connect to server: {e}', COLOR_RED)
+            if not len(self.pool):
+                # no connection will come free for the requests waiting
+                while self.pool.waiters:
+                    waiter = self.pool.waiters.popleft()
+                    if not waiter.done():
+                        waiter.set_exception(e)
+            return
+        self.pool.connected(task, conn)
+        self._checkin(conn, reused=False)
+
+    async def _checkout(self):
+        """
+        A connection to the server, and whether it has been used before,
+        waiting for one to come free or be opened if need be
+        """
+        conn = self.pool.checkout()
+        if conn is not None:
+            return conn, True
+        waiter = asyncio.get_running_loop().create_future()
+        self.pool.waiters.append(waiter)
+        self._open_server_connections()
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled() and \
+                    waiter.exception() is None:
+                # handed a connection just as we gave up waiting
+                self._checkin(waiter.result()[0])
+            raise
+
+    def _checkin(self, conn, reused=True):
+        """
+        Hand a connection that has come free to the next request waiting for
+        one, or else back to the pool
+        """
+        while self.pool.waiters:
+            waiter = self.pool.waiters.popleft()
+            if not waiter.done():  # else it was cancelled
+                waiter.set_result((conn, reused))
+                return
+        self.pool.checkin(conn, time.monotonic())
+
+    def _discard(self, conn):
+        conn[1].close()
+        self.pool.discard(conn)
+        self._open_server_connections()
+
+    async def _tick(self):
+        """Close connections long idle, and report, once a second"""
+        while True:
+            await asyncio.sleep(1)
+            for _, writer in self.pool.expire(time.monotonic()):
+                writer.close()
+            if self.report is not None:
+                self.report(proxy_stats(self))
+
+    @staticmethod
+    async def _read_head(reader):
+        """
+        The next message from `reader`, with just its head read, or None if
+        the reader is done first
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ValueError('message head cut short')
+            return None
+        except asyncio.LimitOverrunError:
+            raise ValueError('message head is too long')
+        msg = HttpMessage()
+        msg.ingest_head(head)
+        return msg
+
+    @staticmethod
+    async def _read_line(reader):
+        """The next line from `reader`, with its line ending"""
+        try:
+            return await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('connection closed mid-body')
+        except asyncio.LimitOverrunError:
+            raise ValueError('chunk line is too long')
+
+    async def _relay_chunked(self, reader, writer):
+        """
+        Relay a body in the chunked transfer coding from `reader` to
+        `writer`, up to the end of the trailer after its last chunk
+        """
+        while True:
+            line = await self._read_line(reader)
+            writer.write(line)
+            # a size in hex, maybe followed by extensions after a semicolon
+            size = int(line.split(b';', 1)[0].strip(), 16)
+            if not size:
+                break
+            # the chunk data, and the CRLF after it
+            await self._relay_body(reader, writer, size + 2)
+        while True:
+            line = await self._read_line(reader)
+            writer.write(line)
+            if not line.rstrip(b'\r\n'):
+                break  # the blank line that ends the trailer
+        await writer.drain()
+
+    async def _relay_body(self, reader, writer, length):
+        """
+        Relay `length` bytes of body from `reader` to `writer`, or all there
+        is until `reader` is done if None, or its chunks if `CHUNKED`, as
+        they arrive
+        """
+        if length is CHUNKED:
+            await self._relay_chunked(reader, writer)
+            return
+        while length is None or length > 0:
+            size = self.write_buffer_size if length is None else \
+                min(length, self.write_buffer_size)
+            data = await reader.read(size)
+            if not data:
+                if length is None:
+                    return
+                raise ConnectionError('connection closed mid-body')
+            writer.write(data)
+            # read no more until the other side has taken most of it
+            await writer.drain()
+            if length is not None:
+                length -= len(data)
+
+    async def _bad_gateway(self, writer):
+        self.bad_gateways += 1
+        self._log(False, BAD_GATEWAY)
+        writer.write(BAD_GATEWAY)
+        await writer.drain()
+
+    async def _exchange(self, request, request_bytes, remaining,
+                        client_reader, client_writer):
+        """
+        Send a request, its head and whatever of its body we have in
+        `request_bytes`, over a pooled connection, relaying the `remaining`
+        bytes of its body from the client after, and stream the response
+        back, returning whether the client connection may be kept. As with
+        `ProxyServer`, a request with no response at all on a reused
+        connection is retried on another one, if we have all of it; other
+        clients are sent a 502, unless they have had some of the response
+        already.
+        """
+        while True:
+            try:
+                conn, reused = await self._checkout()
+            except OSError:
+                await self._bad_gateway(client_writer)
+                return False
+            reader, writer = conn
+            retry = reused and not remaining
+            responded = False
+            try:
+                writer.write(request_bytes)
+                await writer.drain()
+                if remaining:
+                    await self._relay_body(client_reader, writer, remaining)
+                response = await self._read_head(reader)
+                while response is not None:
+                    retry = False
+                    head = response.head_bytes()
+                    self._log(False, head)
+                    client_writer.write(head)
+                    responded = True
+                    if not response.is_interim():
+                        break
+                    # the response proper is still to come
+                    response = await self._read_head(reader)
+                if response is not None:
+                    self.relayed += 1
+                    length = response.body_length(request)
+                    await self._relay_body(reader, client_writer, length)
+                    if length is not None:
+                        self._checkin(conn)
+                        return True
+                    # the client can only tell where the response ended if
+                    # we close its connection too
+                    await client_writer.drain()
+            except ConnectionError:
                 pass
+            except ValueError:
+                retry = False  # the server sent something, if not sense
+            except BaseException:
+                self._discard(conn)
+                raise
+            self._discard(conn)
+            if responded:
+                return False
+            if not retry:
+                await self._bad_gateway(client_writer)
+                return False
 
+    def _log(self, to_server, msg_bytes):
+        if self.verbose:
+            arrow = '->' if to_server else '<-'
+            log('{:>21}(proxy){} {} ({} bytes total)'.format(
+                ' ', arrow, format_data(msg_bytes), len(msg_bytes)),
+                COLOR_BLUE)
 
+    async def _handle_client(self, client_reader, client_writer):
+        c_host, c_port = client_writer.get_extra_info('peername')[:2]
+        if self.verbose:
+            log(f'Accepted a connection from {c_host}:{c_port}')
+        self.clients += 1
+        client_writer.transport.set_write_buffer_limits(self.write_buffer_size)
+        try:
+            while True:
+                request = await self._read_head(client_reader)
+                if request is None:
+                    break
+                request.headers.update({b'Connection': b'Keep-Alive'})
+                request_bytes = request.head_bytes()
+                remaining = request.body_length()
+                if remaining is not CHUNKED and \
+                        remaining <= self.write_buffer_size:
+                    request_bytes += await client_reader.readexactly(
+                        remaining)
+                    remaining = 0
+                self._log(True, request_bytes)
+                if not await self._exchange(request, request_bytes, remaining,
+                                            client_reader, client_writer):
+                    break
+                # read no more until the client has taken most of it
+                await client_writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client is done with us
+        except Exception as e:
+            log(f'Relay for {c_host}:{c_port} failed: {e!r}', COLOR_RED)
+        finally:
+            client_writer.close()
 
+    async def serve(self):
+        # at least one connection, even if the pool need not keep any, to be
+        # sure the server is there
+        for _ in range(max(self.pool.min_size, 1)):
+            self.pool.add(await self._connect(), time.monotonic())
+        server = await asyncio.start_server(
+            self._handle_client, self.host, self.port,
+            backlog=socket.SOMAXCONN, limit=self.write_buffer_size,
+            reuse_port=self.reuse_port or None)
+        log(f'Listening for new connections on {self.host}:{self.port}')
+        tick = asyncio.ensure_future(self._tick())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            tick.cancel()
 
+    def run(self):
+        """
+        Run the proxy on an asyncio event loop
+        """
+        raise_fd_limit()
+        try:
+            asyncio.run(self.serve())
+        except OSError as e:
+            log(f'Failed to start proxy server: {e}', COLOR_RED)
+            sys.exit(-1)
 
 
+ENGINES = {'select': ProxyServer, 'asyncio': AsyncProxyServer}
 
 
+def _run_worker(engine, args, kwargs, stats, slot):
+    """
+    The body of a worker process: run a proxy, reporting its stats into its
+    own row of the shared `stats`
+    """
+    # the supervisor stops its workers itself, on Ctrl-C as on SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    row = slice(slot * len(STATS), (slot + 1) * len(STATS))
 
+    def report(counts):
+        stats[row] = counts
 
+    proxy = engine(*args, reuse_port=True, **kwargs)
+    proxy.report = report
+    proxy.run()
 
 
+class WorkerSupervisor(object):
+    """
+    Run the proxy in `workers` processes, each with its own event loop and
+    pool of connections to the server, and its own socket listening on the
+    same port with SO_REUSEPORT, for the kernel to share clients out among.
 
+    A worker that exits is started again, though no sooner than
+    `RESTART_DELAY` seconds after it last was, so that one failing from the
+    start does not spin. Each worker reports its `proxy_stats` into a row of
+    shared memory, and every `stats_interval` seconds these are logged
+    summed, along with the counts of workers that have since exited.
+    """
+    def __init__(self, engine, args, kwargs, workers,
+                 stats_interval=STATS_INTERVAL):
+        self.engine = engine
+        self.args = args  # for the engine, with kwargs
+        self.kwargs = kwargs
+        self.workers = workers
+        self.stats_interval = stats_interval
+        self.stats = multiprocessing.Array('q', workers * len(STATS),
+                                           lock=False)
+        self.retired = [0] * len(STATS)
+        self.processes = [None] * workers
+        self.started = [0] * workers
+        self.restarts = 0
 
+    def _start(self, slot):
+        process = multiprocessing.Process(
+            target=_run_worker, daemon=True,
+            args=(self.engine, self.args, self.kwargs, self.stats, slot))
+        process.start()
+        self.processes[slot] = process
+        self.started[slot] = time.monotonic()
+        log(f'Started worker {slot} with pid {process.pid}')
 
+    def _reap(self, slot):
+        """
+        Clean up after a worker that has exited, folding its counts into
+        `retired`, all but the size of its pool, which went with it
+        """
+        process = self.processes[slot]
+        process.join()
+        log(f'Worker {slot} with pid {process.pid} exited with code '
+            f'{process.exitcode}', COLOR_RED)
+        row = slice(slot * len(STATS), (slot + 1) * len(STATS))
+        for i, (name, count) in enumerate(zip(STATS, self.stats[row])):
+            if name != 'pool_size':
+                self.retired[i] += count
+        self.stats[row] = [0] * len(STATS)
+        self.processes[slot] = None
 
+    def totals(self):
+        """The `STATS` of every worker, past and present, summed"""
+        totals = list(self.retired)
+        for i, count in enumerate(self.stats):
+            totals[i % len(STATS)] += count
+        return dict(zip(STATS, totals))
 
+    def summary(self):
+        return '{} workers, {} restarts: {clients} clients, {relayed} ' \
+            'responses relayed, {bad_gateways} 502s; pool of {pool_size} ' \
+            'connections, {pool_opened} opened, {pool_failed} failed to ' \
+            'open, {pool_expired} expired'.format(
+                self.workers, self.restarts, **self.totals())
+
+    def run(self):
+        """
+        Start the workers and keep them running, until interrupted
+        """
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            log('Workers need SO_REUSEPORT, which this platform lacks',
+                COLOR_RED)
+            sys.exit(-1)
+        # stop the workers on the way out, whether killed or interrupted
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        for slot in range(self.workers):
+            self._start(slot)
+        next_stats = time.monotonic() + self.stats_interval
+        try:
+            while True:
+                deadlines = [next_stats] + [
+                    self.started[slot] + RESTART_DELAY
+                    for slot, process in enumerate(self.processes)
+                    if process is None]
+                multiprocessing.connection.wait(
+                    [p.sentinel for p in self.processes if p is not None],
+                    max(0, min(deadlines) - time.monotonic()))
+                now = time.monotonic()
+                for slot, process in enumerate(self.processes):
+                    if process is not None and not process.is_alive():
+                        self._reap(slot)
+                    if self.processes[slot] is None and \
+                            now >= self.started[slot] + RESTART_DELAY:
+                        self.restarts += 1
+                        self._start(slot)
+                if now >= next_stats:
+                    log(self.summary())
+                    next_stats = now + self.stats_interval
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in self.processes:
+                if process is not None:
+                    process.terminate()
+            for process in self.processes:
+                if process is not None:
+                    process.join()
+            log(self.summary())
 
 
 if __name__ == '__main__':
@@ -301,7 +1589,40 @@ if __name__ == '__main__':
                         help='Hostname of target, default "localhost"')
     parser.add_argument('--end_port', default='9000',
                         help='Port for target, default 9000')
+    parser.add_argument('--engine', choices=sorted(ENGINES),
+                        default='select',
+                        help='Event loop to run the proxy on, default '
+                             '"select"')
+    parser.add_argument('--pool_min', type=int, default=POOL_MIN_SIZE,
+                        help='Connections to the target to keep open, '
+                             f'default {POOL_MIN_SIZE}')
+    parser.add_argument('--pool_max', type=int, default=POOL_MAX_SIZE,
+                        help='Most connections to the target to open, '
+                             f'default {POOL_MAX_SIZE}')
+    parser.add_argument('--idle_timeout', type=float,
+                        default=POOL_IDLE_TIMEOUT,
+                        help='Seconds before closing an idle connection to '
+                             'the target beyond --pool_min, default '
+                             f'{POOL_IDLE_TIMEOUT:g}')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Run this many worker processes sharing the '
+                             'port, under a supervisor that restarts them, '
+                             'default 0 to run in this process alone')
+    parser.add_argument('--quiet', action='store_true',
+                        help='Log only errors, not every message relayed')
     args = parser.parse_args()
-    proxy = ProxyServer(args.host, int(args.port),
-                        args.end_host, int(args.end_port))
-    proxy.run()
+    # each worker gets a copy of the pool, to fill for itself
+    pool = ServerConnectionPool(args.pool_min, args.pool_max,
+                                args.idle_timeout)
+    proxy_args = (args.host, int(args.port), args.end_host, int(args.end_port))
+    if args.workers:
+        WorkerSupervisor(ENGINES[args.engine], proxy_args,
+                         {'verbose': not args.quiet, 'pool': pool},
+                         args.workers).run()
+    else:
+        proxy = ENGINES[args.engine](*proxy_args, verbose=not args.quiet,
+                                     pool=pool)
+        try:
+            proxy.run()
+        except KeyboardInterrupt:
+            log(f'Server connection pool: {pool}')
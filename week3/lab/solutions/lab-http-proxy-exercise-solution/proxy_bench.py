@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Benchmark the proxy's requests/sec against its number of worker processes.
+
+Usage: ./proxy_bench.py [--workers 0 1 2 4] [--engine select]
+                        [--connections 64] [--duration 5] [--load 2]
+
+The bundled week3/lab/server.py is started as the backend, and then, for each
+worker count in turn, the proxy with that many `--workers` in front of it, 0
+being the proxy in a single process with no supervisor. A load generator,
+itself spread over a few processes so as not to be the bottleneck, keeps
+`connections` keep-alive client connections busy, each sending a GET and
+reading its response before sending the next, and reports requests/sec,
+median and 99th percentile latency and how many requests failed. It does so
+first straight against the backend, as a baseline.
+
+Workers can only add throughput while there are cores to spare for them,
+beyond those the backend and the load generator are using.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+LOCALHOST = '127.0.0.1'
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROXY = os.path.join(HERE, 'advanced_proxy.py')
+BACKEND = os.path.join(HERE, os.pardir, os.pardir, 'server.py')
+
+REQUEST = b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n'
+
+
+def content_length(head):
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            return int(value)
+    return 0
+
+
+async def _fetch(reader, writer):
+    """Send a request and read its response, returning its head"""
+    writer.write(REQUEST)
+    head = await reader.readuntil(b'\r\n\r\n')
+    await reader.readexactly(content_length(head))
+    return head
+
+
+async def _client(address, deadline, timeout, latencies):
+    """
+    Send requests one after another over a keep-alive connection until
+    `deadline`, connecting again whenever the connection is lost or closed,
+    and return how many failed
+    """
+    failed = 0
+    writer = None
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*address), timeout)
+            head = await asyncio.wait_for(_fetch(reader, writer), timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            failed += 1
+            if writer is not None:
+                writer.close()
+                writer = None
+            continue
+        if not head.startswith(b'HTTP/1.1 200'):
+            failed += 1
+        else:
+            latencies.append(time.perf_counter() - start)
+        if b'\r\nConnection: close' in head:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+    return failed
+
+
+async def generate_load(address, connections, duration, timeout=5.0):
+    """
+    Run `connections` concurrent clients against the server at `address`
+    for `duration` seconds, returning the latencies of the requests that
+    succeeded, how many did not, and the seconds taken
+    """
+    latencies = []
+    start = time.perf_counter()
+    failed = await asyncio.gather(
+        *(_client(address, start + duration, timeout, latencies)
+          for _ in range(connections)))
+    return latencies, sum(failed), time.perf_counter() - start
+
+
+def _run_load(connection, *args):
+    connection.send(asyncio.run(generate_load(*args)))
+    connection.close()
+
+
+def measure(address, connections, duration, processes):
+    """
+    Load the server at `address` from `processes` processes at once,
+    returning the sorted latencies, how many requests failed and the seconds
+    taken by the slowest process
+    """
+    children = []
+    for i in range(processes):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        # share the connections out as evenly as they go
+        share = connections // processes + (i < connections % processes)
+        child = multiprocessing.Process(
+            target=_run_load, args=(sender, address, share, duration))
+        child.start()
+        children.append((child, receiver))
+    latencies, failed, elapsed = [], 0, 0
+    for child, receiver in children:
+        child_latencies, child_failed, child_elapsed = receiver.recv()
+        child.join()
+        latencies.extend(child_latencies)
+        failed += child_failed
+        elapsed = max(elapsed, child_elapsed)
+    latencies.sort()
+    return latencies, failed, elapsed
+
+
+def percentile(values, p):
+    """The `p`th percentile of the sorted `values`, by nearest rank"""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def wait_for_port(address, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(address, timeout).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def start_proxy(port, backend_port, workers, engine):
+    """
+    Start the proxy, returning its process once every worker is listening,
+    since clients keep to the worker that accepted their connection
+    """
+    args = [sys.executable, PROXY, '--quiet', '--host', LOCALHOST,
+            '--port', str(port), '--end_host', LOCALHOST,
+            '--end_port', str(backend_port), '--engine', engine]
+    if workers:
+        args += ['--workers', str(workers)]
+    proxy = subprocess.Popen(args, stderr=subprocess.PIPE)
+    listening = 0
+    while listening < max(workers, 1):
+        line = proxy.stderr.readline()
+        if not line:
+            raise RuntimeError('the proxy exited before it was ready')
+        listening += b'Listening for new connections' in line
+    # keep the pipe from filling up and blocking the proxy
+    threading.Thread(target=proxy.stderr.read, daemon=True).start()
+    return proxy
+
+
+def run(worker_counts, engine, connections, duration, processes, port,
+        backend_port):
+    """Load the backend directly and then through the proxy, reporting"""
+    print('{} CPUs'.format(os.cpu_count()), file=sys.stderr)
+    backend = subprocess.Popen(
+        [sys.executable, BACKEND, '--host', LOCALHOST, '--port',
+         str(backend_port)], stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port((LOCALHOST, backend_port))
+        print('{:<10}{:>10}{:>14}{:>10}{:>10}{:>8}'.format(
+            'target', 'requests', 'requests/sec', 'p50 ms', 'p99 ms',
+            'failed'))
+        targets = [('backend', None)] + [
+            ('{} worker{}'.format(n, 's' if n != 1 else '') if n else 'proxy',
+             n) for n in worker_counts]
+        for name, workers in targets:
+            proxy = None
+            if workers is not None:
+                proxy = start_proxy(port, backend_port, workers, engine)
+            try:
+                latencies, failed, elapsed = measure(
+                    (LOCALHOST, backend_port if proxy is None else port),
+                    connections, duration, processes)
+            finally:
+                if proxy is not None:
+                    proxy.terminate()
+                    proxy.wait()
+            print('{:<10}{:>10}{:>14,.0f}{:>10.2f}{:>10.2f}{:>8}'.format(
+                name, len(latencies) + failed, len(latencies) / elapsed,
+                percentile(latencies, 50) * 1e3,
+                percentile(latencies, 99) * 1e3, failed))
+    finally:
+        backend.terminate()
+        backend.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark the proxy against its number of workers')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='worker counts to measure, 0 for none, default '
+                             '0 1 2 4')
+    parser.add_argument('--engine', default='select',
+                        help='event loop to run the proxy on, default '
+                             '"select"')
+    parser.add_argument('--connections', type=int, default=64,
+                        help='number of concurrent client connections, '
+                             'default 64')
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds to generate load for, default 5')
+    parser.add_argument('--load', type=int, default=2, metavar='PROCESSES',
+                        help='processes to generate load from, default 2')
+    parser.add_argument('--port', type=int, default=8100,
+                        help='port to run the proxy on, default 8100')
+    parser.add_argument('--backend-port', type=int, default=9100,
+                        help='port to run the backend on, default 9100')
+    args = parser.parse_args()
+
+    run(args.workers, args.engine, args.connections, args.duration,
+        args.load, args.port, args.backend_port)